@@ -2,20 +2,44 @@
 # SPDX-License-Identifier: MIT-0
 
 class Order:
-    key=''
+    #slots instead of a per instance __dict__, list endpoints hold one Order per item of the tenant
+    __slots__ = ('shardId', 'orderId', 'orderName', 'orderProducts')
+
     def __init__(self, shardId, orderId, orderName, orderProducts):
         self.shardId = shardId
         self.orderId = orderId
-        self.key = shardId + ':' +  orderId
         self.orderName = orderName
         self.orderProducts = orderProducts
 
+    @property
+    def key(self):
+        return self.shardId + ':' +  self.orderId
+
+    @classmethod
+    def from_item(cls, item):
+        """ Creates the order from a dynamodb item
+        """
+        order = cls.__new__(cls)
+        order.shardId = item['shardId']
+        order.orderId = item['orderId']
+        order.orderName = item['orderName']
+        order.orderProducts = item['orderProducts']
+        return order
+
+    def for_json(self):
+        """ Attributes written to the response body by utils.encode_to_json_object
+        """
+        return {
+            'shardId': self.shardId,
+            'orderId': self.orderId,
+            'key': self.key,
+            'orderName': self.orderName,
+            'orderProducts': self.orderProducts
+        }
+
 class  OrderProduct:
 
     def __init__(self, productId, price, quantity):
         self.productId = productId
         self.price = price
         self.quantity = quantity
-
-
-
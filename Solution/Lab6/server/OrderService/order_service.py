@@ -6,12 +6,15 @@ import utils
 import logger
 import metrics_manager
 import order_service_dal
+import batch_manager
 from decimal import Decimal
 from types import SimpleNamespace
 from aws_lambda_powertools import Tracer
 tracer = Tracer()
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def get_order(event, context):
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
@@ -19,7 +22,7 @@ def get_order(event, context):
     logger.log_with_tenant_context(event, "Request received to get a order")
     params = event['pathParameters']
     key = params['id']
-    logger.log_with_tenant_context(event, params)
+    logger.debug_with_tenant_context(event, params)
     order = order_service_dal.get_order(event, key)
 
     logger.log_with_tenant_context(event, "Request completed to get a order")
@@ -27,6 +30,8 @@ def get_order(event, context):
     return utils.generate_response(order)
     
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def create_order(event, context):  
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
@@ -39,6 +44,8 @@ def create_order(event, context):
     return utils.generate_response(order)
     
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def update_order(event, context):
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
@@ -53,6 +60,8 @@ def update_order(event, context):
     return utils.generate_response(order)
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def delete_order(event, context):
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
@@ -66,14 +75,81 @@ def delete_order(event, context):
     return utils.create_success_response("Successfully deleted the order")
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
+def batch_write_orders(event, context):
+    tenantId = event['requestContext']['authorizer']['tenantId']
+    tracer.put_annotation(key="TenantId", value=tenantId)
+
+    logger.log_with_tenant_context(event, "Request received to batch write orders")
+    payload = json.loads(event['body'], object_hook=lambda d: SimpleNamespace(**d), parse_float=Decimal)
+    operations = getattr(payload, 'items', None)
+    if (not isinstance(operations, list) or len(operations) == 0 or len(operations) > batch_manager.batch_max_items):
+        message = 'items should be a list of 1 to {0} operations'.format(batch_manager.batch_max_items)
+        logger.log_with_tenant_context(event, "Request completed as bad request. " + message)
+        return utils.create_badrequest_response(message)
+
+    results = order_service_dal.batch_write_orders(event, operations)
+    __record_batch_metrics(event, results)
+    failed = sum(1 for result in results if result['status'] == 'failed')
+    logger.log_with_tenant_context(event, "Request completed to batch write orders")
+    return utils.generate_response({'results': results, 'succeeded': len(results) - failed, 'failed': failed})
+
+def __record_batch_metrics(event, results):
+    metric_names = {'create': "OrderCreated", 'update': "OrderUpdated", 'delete': "OrderDeleted"}
+    counts = {}
+    for result in results:
+        if (result['status'] == 'succeeded'):
+            counts[result['operation']] = counts.get(result['operation'], 0) + 1
+    if len(counts) > 0:
+        metrics_manager.record_metrics(event, [(metric_names[operation], "Count", count) for operation, count in counts.items()])
+
+@tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def get_orders(event, context):
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
     
     logger.log_with_tenant_context(event, "Request received to get all orders")
+    ids = utils.get_query_string_parameter(event, 'ids')
+    if (ids is not None):
+        return __get_orders_by_ids(event, ids, utils.get_query_string_parameter(event, 'fields'))
+
+    limit = utils.get_query_string_parameter(event, 'limit')
+    cursor = utils.get_query_string_parameter(event, 'cursor')
+    if (limit is not None or cursor is not None):
+        return __get_orders_page(event, tenantId, limit, cursor)
+
     response = order_service_dal.get_orders(event, tenantId)
     metrics_manager.record_metric(event, "OrdersRetrieved", "Count", len(response))
     logger.log_with_tenant_context(event, "Request completed to get all orders")
     return utils.generate_response(response)
 
-  
\ No newline at end of file
+def __get_orders_page(event, tenantId, limit, cursor):
+    try:
+        page_limit = utils.get_page_limit(limit)
+        page_cursor = utils.decode_cursor(cursor) if cursor else None
+        orders, next_cursor = order_service_dal.get_orders_page(event, tenantId, page_limit, page_cursor)
+    except ValueError as e:
+        logger.log_with_tenant_context(event, "Request completed as bad request. " + str(e.args[0]))
+        return utils.create_badrequest_response(str(e.args[0]))
+
+    metrics_manager.record_metric(event, "OrdersRetrieved", "Count", len(orders))
+    logger.log_with_tenant_context(event, "Request completed to get all orders")
+    return utils.generate_response({'items': orders, 'nextCursor': utils.encode_cursor(next_cursor)})
+
+def __get_orders_by_ids(event, ids, fields):
+    try:
+        keys = [key for key in ids.split(',') if key]
+        if (len(keys) == 0 or len(keys) > batch_manager.batch_max_ids):
+            raise ValueError('ids should be a list of 1 to {0} keys'.format(batch_manager.batch_max_ids))
+        attributes = [field for field in fields.split(',') if field] if fields else None
+        orders, missing_keys, failed_keys = order_service_dal.get_orders_by_keys(event, keys, attributes)
+    except ValueError as e:
+        logger.log_with_tenant_context(event, "Request completed as bad request. " + str(e.args[0]))
+        return utils.create_badrequest_response(str(e.args[0]))
+
+    metrics_manager.record_metric(event, "OrdersRetrieved", "Count", len(orders))
+    logger.log_with_tenant_context(event, "Request completed to get orders by ids")
+    return utils.generate_response({'items': orders, 'missingKeys': missing_keys, 'unprocessedKeys': failed_keys})
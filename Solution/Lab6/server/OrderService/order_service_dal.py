@@ -3,7 +3,6 @@
 
 from pprint import pprint
 import os
-import boto3
 from botocore.exceptions import ClientError
 import uuid
 from order_models import Order
@@ -11,32 +10,47 @@ import json
 import utils
 from types import SimpleNamespace
 import logger
-import random
-import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Key
 import metrics_manager
+import client_manager
+import shard_manager
+import batch_manager
 
 is_pooled_deploy = os.environ['IS_POOLED_DEPLOY']
 table_name = os.environ['ORDER_TABLE_NAME']
-dynamodb = None
 
-suffix_start = 1 
-suffix_end = 10
+#silo deployments always use the credentials of the function, so create the resource during init
+if (is_pooled_deploy != 'true'):
+    client_manager.get_default_dynamodb_resource()
+
+#attributes which can be requested from get_orders_by_keys
+order_attributes = ['orderName', 'orderProducts']
+
+#shared by all invocations of the execution environment, so shard queries reuse the worker threads
+shard_query_workers = int(os.environ.get('SHARD_QUERY_WORKERS', str(shard_manager.DEFAULT_SHARD_COUNT)))
+shard_query_executor = ThreadPoolExecutor(max_workers=shard_query_workers)
  
 
 def get_order(event, key):
-    table = __get_dynamodb_table(event, dynamodb)
+    table = __get_dynamodb_table(event)
 
     try:
         shardId = key.split(":")[0]
         orderId = key.split(":")[1] 
-        logger.log_with_tenant_context(event, shardId)
-        logger.log_with_tenant_context(event, orderId)
-        response = table.get_item(Key={'shardId': shardId, 'orderId': orderId}, ReturnConsumedCapacity='TOTAL')
+        logger.debug_with_tenant_context(event, shardId)
+        logger.debug_with_tenant_context(event, orderId)
+        capacity_units = 0
+        for shardId in shard_manager.get_item_shard_ids(event, orderId, shardId):
+            response = table.get_item(Key={'shardId': shardId, 'orderId': orderId}, ReturnConsumedCapacity='TOTAL')
+            capacity_units += response['ConsumedCapacity']['CapacityUnits']
+            if 'Item' in response:
+                break
         item = response['Item']
-        order = Order(item['shardId'], item['orderId'], item['orderName'], item['orderProducts'])
+        order = Order.from_item(item)
 
-        metrics_manager.record_metric(event, "ReadCapacityUnits", "Count", response['ConsumedCapacity']['CapacityUnits'])
+        metrics_manager.record_metric(event, "ReadCapacityUnits", "Count", capacity_units)
 
     except ClientError as e:
         logger.error(e.response['Error']['Message'])
@@ -45,14 +59,19 @@ def get_order(event, key):
         return order
 
 def delete_order(event, key):
-    table = __get_dynamodb_table(event, dynamodb)
+    table = __get_dynamodb_table(event)
     
     try:
         shardId = key.split(":")[0]
         orderId = key.split(":")[1] 
-        response = table.delete_item(Key={'shardId':shardId, 'orderId': orderId}, ReturnConsumedCapacity='TOTAL')
+        capacity_units = 0
+        shardId, otherShardIds = shard_manager.get_item_write_shard_ids(event, orderId, shardId)
+        # the shard a reshard moves the order to is deleted last, so the order cannot be moved back into it
+        for shardId in otherShardIds + [shardId]:
+            response = table.delete_item(Key={'shardId':shardId, 'orderId': orderId}, ReturnConsumedCapacity='TOTAL')
+            capacity_units += response['ConsumedCapacity']['CapacityUnits']
 
-        metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", response['ConsumedCapacity']['CapacityUnits'])
+        metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", capacity_units)
     except ClientError as e:
         logger.error(e.response['Error']['Message'])
         raise Exception('Error deleting a order', e)
@@ -63,18 +82,19 @@ def delete_order(event, key):
 
 def create_order(event, payload):
     tenantId = event['requestContext']['authorizer']['tenantId']
-    table = __get_dynamodb_table(event, dynamodb)
-    suffix = random.randrange(suffix_start, suffix_end)
-    shardId = tenantId+"-"+str(suffix)
+    table = __get_dynamodb_table(event)
+    orderId = str(uuid.uuid4())
+    shardId = shard_manager.get_shard_id(tenantId, orderId, shard_manager.get_shard_count(event))
     
-    order = Order(shardId, str(uuid.uuid4()), payload.orderName, payload.orderProducts)
+    order = Order(shardId, orderId, payload.orderName, payload.orderProducts)
 
     try:
         response = table.put_item(Item={
         'shardId':shardId,
         'orderId': order.orderId, 
         'orderName': order.orderName,
-        'orderProducts': get_order_products_dict(order.orderProducts)
+        'orderProducts': get_order_products_dict(order.orderProducts),
+        'itemVersion': shard_manager.new_item_version()
         }, ReturnConsumedCapacity='TOTAL')
 
         metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", response['ConsumedCapacity']['CapacityUnits'])
@@ -86,24 +106,31 @@ def create_order(event, payload):
         return order
 
 def update_order(event, payload, key):
-    table = __get_dynamodb_table(event, dynamodb)
+    table = __get_dynamodb_table(event)
     
     try:
         shardId = key.split(":")[0]
         orderId = key.split(":")[1] 
-        logger.log_with_tenant_context(event, shardId)
-        logger.log_with_tenant_context(event, orderId)
+        logger.debug_with_tenant_context(event, shardId)
+        logger.debug_with_tenant_context(event, orderId)
+        shardId, otherShardIds = shard_manager.get_item_write_shard_ids(event, orderId, shardId)
         order = Order(shardId, orderId,payload.orderName, payload.orderProducts)
-        response = table.update_item(Key={'shardId':order.shardId, 'orderId': order.orderId},
-        UpdateExpression="set orderName=:orderName, "
-        +"orderProducts=:orderProducts",
-        ExpressionAttributeValues={
-            ':orderName': order.orderName,
-            ':orderProducts': get_order_products_dict(order.orderProducts)
-        },
-        ReturnValues="UPDATED_NEW", ReturnConsumedCapacity='TOTAL')
+        if (len(otherShardIds) > 0):
+            # the order can still be in the shard of its key or of the previous shard count
+            capacity_units = __write_moved_order(table, order, otherShardIds)
+        else:
+            response = table.update_item(Key={'shardId':order.shardId, 'orderId': order.orderId},
+            UpdateExpression="set orderName=:orderName, "
+            +"orderProducts=:orderProducts, itemVersion=:itemVersion",
+            ExpressionAttributeValues={
+                ':orderName': order.orderName,
+                ':orderProducts': get_order_products_dict(order.orderProducts),
+                ':itemVersion': shard_manager.new_item_version()
+            },
+            ReturnValues="UPDATED_NEW", ReturnConsumedCapacity='TOTAL')
+            capacity_units = response['ConsumedCapacity']['CapacityUnits']
 
-        metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", response['ConsumedCapacity']['CapacityUnits'])
+        metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", capacity_units)
     except ClientError as e:
         logger.error(e.response['Error']['Message'])
         raise Exception('Error updating a order', e)
@@ -111,47 +138,321 @@ def update_order(event, payload, key):
         logger.info("UpdateItem succeeded:")
         return order
 
+def get_orders_by_keys(event, keys, attributes=None):
+    """ Get orders by key with BatchGetItem
+
+    Args:
+        event: lambda event
+        keys (list): order keys in the shardId:orderId format
+        attributes (list): order attributes to return, None for the whole order
+
+    Returns:
+        tuple: orders in the order of the keys, keys which do not exist and keys which could not be read
+
+    Raises:
+        ValueError: if a key or an attribute is not valid
+    """
+    tenantId = event['requestContext']['authorizer']['tenantId']
+    parsed_keys = [__parse_key(tenantId, key) for key in keys]
+    if attributes is not None:
+        for attribute in attributes:
+            if attribute not in order_attributes:
+                raise ValueError('Invalid field ' + attribute)
+    table = __get_dynamodb_table(event)
+
+    #every shard which can hold an order is read, the order is taken from the first one holding it
+    candidate_keys = {parsed_key: [(shardId, parsed_key[1]) for shardId in shard_manager.get_item_shard_ids(event, parsed_key[1], parsed_key[0])]
+        for parsed_key in parsed_keys}
+
+    try:
+        unique_keys = [{'shardId': shardId, 'orderId': orderId} for shardId, orderId in dict.fromkeys(
+            candidate_key for parsed_key in candidate_keys for candidate_key in candidate_keys[parsed_key])]
+        items, unprocessed_keys, capacity_units = batch_manager.batch_get_items(table, ['shardId', 'orderId'], unique_keys, attributes)
+
+        metrics_manager.record_metric(event, "ReadCapacityUnits", "Count", capacity_units)
+    except ClientError as e:
+        logger.error(e.response['Error']['Message'])
+        raise Exception('Error getting orders by key', e)
+
+    unprocessed_keys = set((key['shardId'], key['orderId']) for key in unprocessed_keys)
+    orders = []
+    missing_keys = []
+    failed_keys = []
+    for key, parsed_key in zip(keys, parsed_keys):
+        item = next((items[candidate_key] for candidate_key in candidate_keys[parsed_key] if candidate_key in items), None)
+        if item is not None:
+            orders.append(__get_order_from_item(item, attributes))
+        elif any(candidate_key in unprocessed_keys for candidate_key in candidate_keys[parsed_key]):
+            failed_keys.append(key)
+        else:
+            missing_keys.append(key)
+    logger.info("BatchGetItem succeeded")
+    return orders, missing_keys, failed_keys
+
+def __get_order_from_item(item, attributes):
+    if attributes is None:
+        return Order.from_item(item)
+    # projected orders are returned with the same attribute names as Order
+    order = {'shardId': item['shardId'], 'orderId': item['orderId'], 'key': item['shardId'] + ':' + item['orderId']}
+    for attribute in attributes:
+        if attribute in item:
+            order[attribute] = item[attribute]
+    return order
+
+def batch_write_orders(event, operations):
+    """ Creates, updates and deletes orders with BatchWriteItem. 
+        Updates replace the whole order, like update_order they create the order if the key does not exist.
+        Updates of orders which can still be in other shards move the order with a transaction each.
+
+    Args:
+        event: lambda event
+        operations (list): payloads with an operation attribute of create, update or delete.
+            Update and delete payloads carry the key of the order
+
+    Returns:
+        list: result of every operation, in the order of the operations
+    """
+    tenantId = event['requestContext']['authorizer']['tenantId']
+    table = __get_dynamodb_table(event)
+    shard_count = shard_manager.get_shard_count(event)
+
+    results = []
+    #(result index, write request) of every operation, written in two rounds. Deletes remove the order from the shard 
+    #a reshard moves it to last, so it cannot be moved back into it
+    first_requests = []
+    second_requests = []
+    #(result index, order, other shard ids) of updates which move the order into its shard
+    moved_orders = []
+    orderIds = set()
+    for payload in operations:
+        operation = getattr(payload, 'operation', None)
+        try:
+            if (operation == 'create'):
+                orderId = str(uuid.uuid4())
+                shardId = shard_manager.get_shard_id(tenantId, orderId, shard_count)
+                order = __get_order_from_payload(shardId, orderId, payload)
+                requests = [{'PutRequest': {'Item': __get_order_item(order)}}], []
+            elif (operation == 'update'):
+                keyShardId, orderId = __parse_key(tenantId, __get_attribute(payload, 'key'))
+                shardId, otherShardIds = shard_manager.get_item_write_shard_ids(event, orderId, keyShardId)
+                order = __get_order_from_payload(shardId, orderId, payload)
+                if (len(otherShardIds) > 0):
+                    requests = [], []
+                else:
+                    requests = [{'PutRequest': {'Item': __get_order_item(order)}}], []
+            elif (operation == 'delete'):
+                keyShardId, orderId = __parse_key(tenantId, __get_attribute(payload, 'key'))
+                shardId, otherShardIds = shard_manager.get_item_write_shard_ids(event, orderId, keyShardId)
+                if (len(otherShardIds) > 0):
+                    requests = __get_delete_requests(otherShardIds, orderId), __get_delete_requests([shardId], orderId)
+                else:
+                    requests = __get_delete_requests([shardId], orderId), []
+            else:
+                raise ValueError('operation should be create, update or delete')
+            if (orderId in orderIds):
+                raise ValueError('Duplicate key in batch')
+        except ValueError as e:
+            results.append({'operation': operation, 'key': getattr(payload, 'key', None), 'status': 'failed', 'error': str(e.args[0])})
+            continue
+
+        orderIds.add(orderId)
+        if (operation == 'update' and len(otherShardIds) > 0):
+            moved_orders.append((len(results), order, otherShardIds))
+        first_requests.extend((len(results), request) for request in requests[0])
+        second_requests.extend((len(results), request) for request in requests[1])
+        results.append({'operation': operation, 'key': shardId + ':' + orderId, 'status': 'succeeded'})
+
+    capacity_units = __write_requests(table, results, first_requests)
+    capacity_units += __write_requests(table, results, [(result_index, request) for result_index, request in second_requests 
+        if results[result_index]['status'] == 'succeeded'])
+    for result_index, order, otherShardIds in moved_orders:
+        try:
+            capacity_units += __write_moved_order(table, order, otherShardIds)
+        except ClientError as e:
+            logger.error(e.response['Error']['Message'])
+            results[result_index]['status'] = 'failed'
+            results[result_index]['error'] = e.response['Error']['Message']
+
+    metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", capacity_units)
+    logger.info("BatchWriteItem completed")
+    return results
+
+def __write_requests(table, results, indexed_requests):
+    # a failed request fails the result of its operation
+    errors, capacity_units = batch_manager.batch_write_items(table, ['shardId', 'orderId'], [request for result_index, request in indexed_requests])
+    for (result_index, request), error in zip(indexed_requests, errors):
+        if error is not None:
+            results[result_index]['status'] = 'failed'
+            results[result_index]['error'] = error
+    return capacity_units
+
+def __write_moved_order(table, order, otherShardIds):
+    """ Writes the order to its shard and deletes it from the other shards which can hold it in one transaction,
+        so list queries never return the order twice
+
+    Returns:
+        float: write capacity units consumed
+    """
+    response = table.meta.client.transact_write_items(TransactItems=
+        [{'Put': {'TableName': table.name, 'Item': __get_order_item(order)}}] +
+        [{'Delete': {'TableName': table.name, 'Key': {'shardId': shardId, 'orderId': order.orderId}}} for shardId in otherShardIds],
+        ReturnConsumedCapacity='TOTAL')
+    return sum(consumed_capacity['CapacityUnits'] for consumed_capacity in response.get('ConsumedCapacity', []))
+
+def __get_delete_requests(shardIds, orderId):
+    return [{'DeleteRequest': {'Key': {'shardId': shardId, 'orderId': orderId}}} for shardId in shardIds]
+
+def __get_order_from_payload(shardId, orderId, payload):
+    orderProducts = __get_attribute(payload, 'orderProducts')
+    if not isinstance(orderProducts, list) or not all(isinstance(orderProduct, SimpleNamespace) for orderProduct in orderProducts):
+        raise ValueError('orderProducts should be a list of products')
+    return Order(shardId, orderId, __get_attribute(payload, 'orderName'), orderProducts)
+
+def __get_order_item(order):
+    return {
+        'shardId': order.shardId,
+        'orderId': order.orderId,
+        'orderName': order.orderName,
+        'orderProducts': get_order_products_dict(order.orderProducts),
+        'itemVersion': shard_manager.new_item_version()
+    }
+
+def __get_attribute(payload, name):
+    if not hasattr(payload, name):
+        raise ValueError('Missing attribute ' + name)
+    return getattr(payload, name)
+
+def __parse_key(tenantId, key):
+    # keys of other tenants would fail the whole BatchWriteItem call in pooled deployments, so they are rejected per item
+    parts = key.split(":") if isinstance(key, str) else []
+    if (len(parts) != 2 or not parts[0].startswith(tenantId + '-')):
+        raise ValueError('Invalid key')
+    return parts[0], parts[1]
+
 def get_orders(event, tenantId):
-    table = __get_dynamodb_table(event, dynamodb)
-    get_all_products_response = []
+    table = __get_dynamodb_table(event)
+    get_all_orders_response = []
 
     try:
-        __query_all_partitions(tenantId,get_all_products_response, table, event)
+        shard_states = __get_initial_shard_states(event)
+        __query_all_partitions(tenantId, shard_states, None, get_all_orders_response, table, event)
     except ClientError as e:
         logger.error("Error getting all orders")
         raise Exception('Error getting all orders', e) 
     else:
         logger.info("Get orders succeeded")
-        return get_all_products_response
+        return get_all_orders_response
 
-def __query_all_partitions(tenantId,get_all_products_response, table, event):
-    threads = []    
-    
-    for suffix in range(suffix_start, suffix_end):
-        partition_id = tenantId+'-'+str(suffix)
-        
-        thread = threading.Thread(target=__get_tenant_data, args=[partition_id, get_all_products_response, table, event])
-        threads.append(thread)
-        
-    # Start threads
-    for thread in threads:
-        thread.start()
-    # Ensure all threads are finished
-    for thread in threads:
-        thread.join()
+def get_orders_page(event, tenantId, limit, cursor):
+    """ Get one page of orders merged from all the shards of the tenant
+
+    Args:
+        event: lambda event
+        tenantId (string): tenant id
+        limit (int): maximum number of orders in the page
+        cursor (dict): decoded cursor returned with the previous page, None for the first page
+
+    Returns:
+        tuple: orders of the page and the cursor for the next page, None if this is the last page
+    """
+    if cursor is not None and not __is_valid_cursor(event, cursor):
+        raise ValueError('Invalid cursor')
+    table = __get_dynamodb_table(event)
+    get_orders_page_response = []
+    try:
+        shard_states = cursor if cursor is not None else __get_initial_shard_states(event)
+        __query_all_partitions(tenantId, shard_states, limit, get_orders_page_response, table, event)
+    except ClientError as e:
+        logger.error(e.response['Error']['Message'])
+        raise Exception('Error getting orders page', e)
+    else:
+        logger.info("Get orders page succeeded")
+        next_cursor = shard_states if len(shard_states) > 0 else None
+        return get_orders_page_response, next_cursor
+
+def __get_initial_shard_states(event):
+    # shard suffix -> last evaluated orderId of the shard, None if the shard has not been read yet.
+    # Exhausted shards are removed.
+    return {suffix: None for suffix in shard_manager.get_shard_suffixes(shard_manager.get_read_shard_count(event))}
+
+def __is_valid_cursor(event, cursor):
+    valid_suffixes = __get_initial_shard_states(event).keys()
+    for suffix, start_key in cursor.items():
+        if suffix not in valid_suffixes or not (start_key is None or isinstance(start_key, str)):
+            return False
+    return True
+
+def __query_all_partitions(tenantId, shard_states, limit, get_all_orders_response, table, event):
+    for orders in __iter_partition_pages(tenantId, shard_states, limit, table, event):
+        get_all_orders_response.extend(orders)
+
+def __iter_partition_pages(tenantId, shard_states, limit, table, event):
+    """ Reads the shards in rounds, one query per remaining shard in each round, until the limit is reached
+        or all the shards are exhausted, and yields the items of every shard query in shard order. 
+        When there is a limit, the per shard query limit is chosen so that a round never returns more 
+        items than still fit in the page.
+        Consumed capacity and latency of all the shard queries are recorded as one metric document.
+    """
+    consumed_capacity_units = 0
+    max_shard_latency = 0
+    shard_queries = 0
+    item_count = 0
+    try:
+        while (len(shard_states) > 0 and (limit is None or item_count < limit)):
+            suffixes = sorted(shard_states.keys(), key=int)
+            shard_limit = None
+            if (limit is not None):
+                remaining = limit - item_count
+                suffixes = suffixes[:remaining]
+                shard_limit = remaining // len(suffixes)
+
+            futures = []
+            for suffix in suffixes:
+                partition_id = tenantId+'-'+suffix
+                futures.append(shard_query_executor.submit(__get_tenant_data, partition_id, shard_states[suffix], shard_limit, table))
+
+            # Gather the results in shard order and move the shard positions forward
+            for suffix, future in zip(suffixes, futures):
+                orders, last_evaluated_key, capacity_units, latency = future.result()
+                consumed_capacity_units += capacity_units
+                max_shard_latency = max(max_shard_latency, latency)
+                shard_queries += 1
+                if last_evaluated_key is None:
+                    del shard_states[suffix]
+                else:
+                    shard_states[suffix] = last_evaluated_key['orderId']
+                item_count += len(orders)
+                yield orders
+    finally:
+        metrics_manager.record_metrics(event, [
+            ("ReadCapacityUnits", "Count", consumed_capacity_units),
+            ("ShardQueries", "Count", shard_queries),
+            ("ShardQueryMaxLatency", "Milliseconds", max_shard_latency)
+        ])
            
-def __get_tenant_data(partition_id, get_all_products_response, table, event):    
-    logger.info(partition_id)
-    response = table.query(KeyConditionExpression=Key('shardId').eq(partition_id), ReturnConsumedCapacity='TOTAL')    
-    if (len(response['Items']) > 0):
-        for item in response['Items']:
-            order = Order(item['shardId'], item['orderId'], item['orderName'], item['orderProducts'])
-            get_all_products_response.append(order)
+def __get_tenant_data(partition_id, start_sort_key, shard_limit, table):    
+    logger.debug(partition_id)
+    query_params = {
+        'KeyConditionExpression': Key('shardId').eq(partition_id),
+        'ReturnConsumedCapacity': 'TOTAL'
+    }
+    if start_sort_key is not None:
+        query_params['ExclusiveStartKey'] = {'shardId': partition_id, 'orderId': start_sort_key}
+    if shard_limit is not None:
+        query_params['Limit'] = shard_limit
+
+    start_time = time.perf_counter()
+    response = table.query(**query_params)
+    latency = (time.perf_counter() - start_time) * 1000
+    orders = []
+    for item in response['Items']:
+        orders.append(Order.from_item(item))
 
-    metrics_manager.record_metric(event, "ReadCapacityUnits", "Count", response['ConsumedCapacity']['CapacityUnits'])        
+    return orders, response.get('LastEvaluatedKey'), response['ConsumedCapacity']['CapacityUnits'], latency
 
-def __get_dynamodb_table(event, dynamodb):
-    """ Determine the table name based upo pooled vs silo model
+def __get_dynamodb_table(event):
+    """ Determine the table based upon pooled vs silo model. 
+        Pooled deployments access the table with the tenant scoped credentials passed by the authorizer
 
     Args:
         event ([type]): [description]
@@ -159,20 +460,7 @@ def __get_dynamodb_table(event, dynamodb):
     Returns:
         [type]: [description]
     """
-    if (is_pooled_deploy=='true'):
-        accesskey = event['requestContext']['authorizer']['accesskey']
-        secretkey = event['requestContext']['authorizer']['secretkey']
-        sessiontoken = event['requestContext']['authorizer']['sessiontoken']    
-        dynamodb = boto3.resource('dynamodb',
-                aws_access_key_id=accesskey,
-                aws_secret_access_key=secretkey,
-                aws_session_token=sessiontoken
-                )        
-    else:
-        if not dynamodb:
-            dynamodb = boto3.resource('dynamodb')
-        
-    return dynamodb.Table(table_name)
+    return client_manager.get_dynamodb_table(event, table_name, is_pooled_deploy)
 
 def get_order_products_dict(orderProducts):
     orderProductList = []
@@ -2,24 +2,48 @@
 # SPDX-License-Identifier: MIT-0
 
 class Product:
-    key =''
+    #slots instead of a per instance __dict__, list endpoints hold one Product per item of the tenant
+    __slots__ = ('shardId', 'productId', 'sku', 'name', 'price', 'category')
+
     def __init__(self, shardId, productId, sku, name, price, category):
         self.shardId = shardId
         self.productId = productId
-        self.key = shardId + ':' +  productId
         self.sku = sku
         self.name = name
         self.price = price
         self.category = category
 
+    @property
+    def key(self):
+        return self.shardId + ':' +  self.productId
+
+    @classmethod
+    def from_item(cls, item):
+        """ Creates the product from a dynamodb item
+        """
+        product = cls.__new__(cls)
+        product.shardId = item['shardId']
+        product.productId = item['productId']
+        product.sku = item['sku']
+        product.name = item['name']
+        product.price = item['price']
+        product.category = item['category']
+        return product
+
+    def for_json(self):
+        """ Attributes written to the response body by utils.encode_to_json_object
+        """
+        return {
+            'shardId': self.shardId,
+            'productId': self.productId,
+            'key': self.key,
+            'sku': self.sku,
+            'name': self.name,
+            'price': self.price,
+            'category': self.category
+        }
+
 class Category:
     def __init__(self, id, name):
         self.id = id
         self.name = name
-                
-
-        
-
-               
-
-        
@@ -6,21 +6,24 @@ import utils
 import logger
 import metrics_manager
 import product_service_dal
+import batch_manager
 from aws_lambda_powertools import Tracer
 from decimal import Decimal
 from types import SimpleNamespace
 tracer = Tracer()
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def get_product(event, context):
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
     
     logger.log_with_tenant_context(event, "Request received to get a product")
     params = event['pathParameters']
-    logger.log_with_tenant_context(event, params)
+    logger.debug_with_tenant_context(event, params)
     key = params['id']
-    logger.log_with_tenant_context(event, key)
+    logger.debug_with_tenant_context(event, key)
     product = product_service_dal.get_product(event, key)
 
     logger.log_with_tenant_context(event, "Request completed to get a product")
@@ -28,6 +31,8 @@ def get_product(event, context):
     return utils.generate_response(product)
     
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def create_product(event, context):    
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
@@ -40,6 +45,8 @@ def create_product(event, context):
     return utils.generate_response(product)
     
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def update_product(event, context):
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
@@ -54,6 +61,8 @@ def update_product(event, context):
     return utils.generate_response(product)
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def delete_product(event, context):
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
@@ -67,14 +76,81 @@ def delete_product(event, context):
     return utils.create_success_response("Successfully deleted the product")
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
+def batch_write_products(event, context):
+    tenantId = event['requestContext']['authorizer']['tenantId']
+    tracer.put_annotation(key="TenantId", value=tenantId)
+
+    logger.log_with_tenant_context(event, "Request received to batch write products")
+    payload = json.loads(event['body'], object_hook=lambda d: SimpleNamespace(**d), parse_float=Decimal)
+    operations = getattr(payload, 'items', None)
+    if (not isinstance(operations, list) or len(operations) == 0 or len(operations) > batch_manager.batch_max_items):
+        message = 'items should be a list of 1 to {0} operations'.format(batch_manager.batch_max_items)
+        logger.log_with_tenant_context(event, "Request completed as bad request. " + message)
+        return utils.create_badrequest_response(message)
+
+    results = product_service_dal.batch_write_products(event, operations)
+    __record_batch_metrics(event, results)
+    failed = sum(1 for result in results if result['status'] == 'failed')
+    logger.log_with_tenant_context(event, "Request completed to batch write products")
+    return utils.generate_response({'results': results, 'succeeded': len(results) - failed, 'failed': failed})
+
+def __record_batch_metrics(event, results):
+    metric_names = {'create': "ProductCreated", 'update': "ProductUpdated", 'delete': "ProductDeleted"}
+    counts = {}
+    for result in results:
+        if (result['status'] == 'succeeded'):
+            counts[result['operation']] = counts.get(result['operation'], 0) + 1
+    if len(counts) > 0:
+        metrics_manager.record_metrics(event, [(metric_names[operation], "Count", count) for operation, count in counts.items()])
+
+@tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def get_products(event, context):
     tenantId = event['requestContext']['authorizer']['tenantId']
     tracer.put_annotation(key="TenantId", value=tenantId)
     
     logger.log_with_tenant_context(event, "Request received to get all products")
+    ids = utils.get_query_string_parameter(event, 'ids')
+    if (ids is not None):
+        return __get_products_by_ids(event, ids, utils.get_query_string_parameter(event, 'fields'))
+
+    limit = utils.get_query_string_parameter(event, 'limit')
+    cursor = utils.get_query_string_parameter(event, 'cursor')
+    if (limit is not None or cursor is not None):
+        return __get_products_page(event, tenantId, limit, cursor)
+
     response = product_service_dal.get_products(event, tenantId)
     metrics_manager.record_metric(event, "ProductsRetrieved", "Count", len(response))
     logger.log_with_tenant_context(event, "Request completed to get all products")
     return utils.generate_response(response)
 
-  
\ No newline at end of file
+def __get_products_page(event, tenantId, limit, cursor):
+    try:
+        page_limit = utils.get_page_limit(limit)
+        page_cursor = utils.decode_cursor(cursor) if cursor else None
+        products, next_cursor = product_service_dal.get_products_page(event, tenantId, page_limit, page_cursor)
+    except ValueError as e:
+        logger.log_with_tenant_context(event, "Request completed as bad request. " + str(e.args[0]))
+        return utils.create_badrequest_response(str(e.args[0]))
+
+    metrics_manager.record_metric(event, "ProductsRetrieved", "Count", len(products))
+    logger.log_with_tenant_context(event, "Request completed to get all products")
+    return utils.generate_response({'items': products, 'nextCursor': utils.encode_cursor(next_cursor)})
+
+def __get_products_by_ids(event, ids, fields):
+    try:
+        keys = [key for key in ids.split(',') if key]
+        if (len(keys) == 0 or len(keys) > batch_manager.batch_max_ids):
+            raise ValueError('ids should be a list of 1 to {0} keys'.format(batch_manager.batch_max_ids))
+        attributes = [field for field in fields.split(',') if field] if fields else None
+        products, missing_keys, failed_keys = product_service_dal.get_products_by_keys(event, keys, attributes)
+    except ValueError as e:
+        logger.log_with_tenant_context(event, "Request completed as bad request. " + str(e.args[0]))
+        return utils.create_badrequest_response(str(e.args[0]))
+
+    metrics_manager.record_metric(event, "ProductsRetrieved", "Count", len(products))
+    logger.log_with_tenant_context(event, "Request completed to get products by ids")
+    return utils.generate_response({'items': products, 'missingKeys': missing_keys, 'unprocessedKeys': failed_keys})
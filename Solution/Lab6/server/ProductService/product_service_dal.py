@@ -3,14 +3,16 @@
 
 from pprint import pprint
 import os
-import boto3
 from botocore.exceptions import ClientError
 import uuid
 import json
 import logger
-import random
-import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import metrics_manager
+import client_manager
+import shard_manager
+import batch_manager
 
 from product_models import Product
 from types import SimpleNamespace
@@ -19,40 +21,57 @@ from boto3.dynamodb.conditions import Key
 
 is_pooled_deploy = os.environ['IS_POOLED_DEPLOY']
 table_name = os.environ['PRODUCT_TABLE_NAME']
-dynamodb = None
 
-suffix_start = 1 
-suffix_end = 10
+#silo deployments always use the credentials of the function, so create the resource during init
+if (is_pooled_deploy != 'true'):
+    client_manager.get_default_dynamodb_resource()
+
+#attributes which can be requested from get_products_by_keys
+product_attributes = ['sku', 'name', 'price', 'category']
+
+#shared by all invocations of the execution environment, so shard queries reuse the worker threads
+shard_query_workers = int(os.environ.get('SHARD_QUERY_WORKERS', str(shard_manager.DEFAULT_SHARD_COUNT)))
+shard_query_executor = ThreadPoolExecutor(max_workers=shard_query_workers)
 
 def get_product(event, key):
-    table = __get_dynamodb_table(event, dynamodb)
+    table = __get_dynamodb_table(event)
     
     try:
         shardId = key.split(":")[0]
         productId = key.split(":")[1] 
-        logger.log_with_tenant_context(event, shardId)
-        logger.log_with_tenant_context(event, productId)
-        response = table.get_item(Key={'shardId': shardId, 'productId': productId}, ReturnConsumedCapacity='TOTAL')
+        logger.debug_with_tenant_context(event, shardId)
+        logger.debug_with_tenant_context(event, productId)
+        capacity_units = 0
+        for shardId in shard_manager.get_item_shard_ids(event, productId, shardId):
+            response = table.get_item(Key={'shardId': shardId, 'productId': productId}, ReturnConsumedCapacity='TOTAL')
+            capacity_units += response['ConsumedCapacity']['CapacityUnits']
+            if 'Item' in response:
+                break
         item = response['Item']
-        product = Product(item['shardId'], item['productId'], item['sku'], item['name'], item['price'], item['category'])
+        product = Product.from_item(item)
 
-        metrics_manager.record_metric(event, "ReadCapacityUnits", "Count", response['ConsumedCapacity']['CapacityUnits'])
+        metrics_manager.record_metric(event, "ReadCapacityUnits", "Count", capacity_units)
     except ClientError as e:
         logger.error(e.response['Error']['Message'])
         raise Exception('Error getting a product', e)
     else:
-        logger.info("GetItem succeeded:"+ str(product))
+        logger.debug("GetItem succeeded: %s", product)
         return product
 
 def delete_product(event, key):
-    table = __get_dynamodb_table(event, dynamodb)
+    table = __get_dynamodb_table(event)
     
     try:
         shardId = key.split(":")[0]
         productId = key.split(":")[1] 
-        response = table.delete_item(Key={'shardId':shardId, 'productId': productId}, ReturnConsumedCapacity='TOTAL')
+        capacity_units = 0
+        shardId, otherShardIds = shard_manager.get_item_write_shard_ids(event, productId, shardId)
+        # the shard a reshard moves the product to is deleted last, so the product cannot be moved back into it
+        for shardId in otherShardIds + [shardId]:
+            response = table.delete_item(Key={'shardId':shardId, 'productId': productId}, ReturnConsumedCapacity='TOTAL')
+            capacity_units += response['ConsumedCapacity']['CapacityUnits']
 
-        metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", response['ConsumedCapacity']['CapacityUnits'])
+        metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", capacity_units)
     except ClientError as e:
         logger.error(e.response['Error']['Message'])
         raise Exception('Error deleting a product', e)
@@ -63,13 +82,13 @@ def delete_product(event, key):
 
 def create_product(event, payload):
     tenantId = event['requestContext']['authorizer']['tenantId']    
-    table = __get_dynamodb_table(event, dynamodb)
+    table = __get_dynamodb_table(event)
 
     
-    suffix = random.randrange(suffix_start, suffix_end)
-    shardId = tenantId+"-"+str(suffix)
+    productId = str(uuid.uuid4())
+    shardId = shard_manager.get_shard_id(tenantId, productId, shard_manager.get_shard_count(event))
 
-    product = Product(shardId, str(uuid.uuid4()), payload.sku,payload.name, payload.price, payload.category)
+    product = Product(shardId, productId, payload.sku,payload.name, payload.price, payload.category)
     
     try:
         response = table.put_item(
@@ -80,7 +99,8 @@ def create_product(event, payload):
                     'sku': product.sku,
                     'name': product.name,
                     'price': product.price,
-                    'category': product.category
+                    'category': product.category,
+                    'itemVersion': shard_manager.new_item_version()
                 }, ReturnConsumedCapacity='TOTAL'
         )
 
@@ -93,28 +113,35 @@ def create_product(event, payload):
         return product
 
 def update_product(event, payload, key):
-    table = __get_dynamodb_table(event, dynamodb)
+    table = __get_dynamodb_table(event)
     
     try:
         shardId = key.split(":")[0]
         productId = key.split(":")[1] 
-        logger.log_with_tenant_context(event, shardId)
-        logger.log_with_tenant_context(event, productId)
+        logger.debug_with_tenant_context(event, shardId)
+        logger.debug_with_tenant_context(event, productId)
+        shardId, otherShardIds = shard_manager.get_item_write_shard_ids(event, productId, shardId)
 
         product = Product(shardId,productId,payload.sku, payload.name, payload.price, payload.category)
 
-        response = table.update_item(Key={'shardId':product.shardId, 'productId': product.productId},
-        UpdateExpression="set sku=:sku, #n=:productName, price=:price, category=:category",
-        ExpressionAttributeNames= {'#n':'name'},
-        ExpressionAttributeValues={
-            ':sku': product.sku,
-            ':productName': product.name,
-            ':price': product.price,
-            ':category': product.category
-        },
-        ReturnValues="UPDATED_NEW", ReturnConsumedCapacity='TOTAL')
+        if (len(otherShardIds) > 0):
+            # the product can still be in the shard of its key or of the previous shard count
+            capacity_units = __write_moved_product(table, product, otherShardIds)
+        else:
+            response = table.update_item(Key={'shardId':product.shardId, 'productId': product.productId},
+            UpdateExpression="set sku=:sku, #n=:productName, price=:price, category=:category, itemVersion=:itemVersion",
+            ExpressionAttributeNames= {'#n':'name'},
+            ExpressionAttributeValues={
+                ':sku': product.sku,
+                ':productName': product.name,
+                ':price': product.price,
+                ':category': product.category,
+                ':itemVersion': shard_manager.new_item_version()
+            },
+            ReturnValues="UPDATED_NEW", ReturnConsumedCapacity='TOTAL')
+            capacity_units = response['ConsumedCapacity']['CapacityUnits']
 
-        metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", response['ConsumedCapacity']['CapacityUnits'])
+        metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", capacity_units)
     except ClientError as e:
         logger.error(e.response['Error']['Message'])
         raise Exception('Error updating a product', e)
@@ -122,11 +149,203 @@ def update_product(event, payload, key):
         logger.info("UpdateItem succeeded:")
         return product        
 
+def get_products_by_keys(event, keys, attributes=None):
+    """ Get products by key with BatchGetItem
+
+    Args:
+        event: lambda event
+        keys (list): product keys in the shardId:productId format
+        attributes (list): product attributes to return, None for the whole product
+
+    Returns:
+        tuple: products in the order of the keys, keys which do not exist and keys which could not be read
+
+    Raises:
+        ValueError: if a key or an attribute is not valid
+    """
+    tenantId = event['requestContext']['authorizer']['tenantId']
+    parsed_keys = [__parse_key(tenantId, key) for key in keys]
+    if attributes is not None:
+        for attribute in attributes:
+            if attribute not in product_attributes:
+                raise ValueError('Invalid field ' + attribute)
+    table = __get_dynamodb_table(event)
+
+    #every shard which can hold a product is read, the product is taken from the first one holding it
+    candidate_keys = {parsed_key: [(shardId, parsed_key[1]) for shardId in shard_manager.get_item_shard_ids(event, parsed_key[1], parsed_key[0])]
+        for parsed_key in parsed_keys}
+
+    try:
+        unique_keys = [{'shardId': shardId, 'productId': productId} for shardId, productId in dict.fromkeys(
+            candidate_key for parsed_key in candidate_keys for candidate_key in candidate_keys[parsed_key])]
+        items, unprocessed_keys, capacity_units = batch_manager.batch_get_items(table, ['shardId', 'productId'], unique_keys, attributes)
+
+        metrics_manager.record_metric(event, "ReadCapacityUnits", "Count", capacity_units)
+    except ClientError as e:
+        logger.error(e.response['Error']['Message'])
+        raise Exception('Error getting products by key', e)
+
+    unprocessed_keys = set((key['shardId'], key['productId']) for key in unprocessed_keys)
+    products = []
+    missing_keys = []
+    failed_keys = []
+    for key, parsed_key in zip(keys, parsed_keys):
+        item = next((items[candidate_key] for candidate_key in candidate_keys[parsed_key] if candidate_key in items), None)
+        if item is not None:
+            products.append(__get_product_from_item(item, attributes))
+        elif any(candidate_key in unprocessed_keys for candidate_key in candidate_keys[parsed_key]):
+            failed_keys.append(key)
+        else:
+            missing_keys.append(key)
+    logger.info("BatchGetItem succeeded")
+    return products, missing_keys, failed_keys
+
+def __get_product_from_item(item, attributes):
+    if attributes is None:
+        return Product.from_item(item)
+    # projected products are returned with the same attribute names as Product
+    product = {'shardId': item['shardId'], 'productId': item['productId'], 'key': item['shardId'] + ':' + item['productId']}
+    for attribute in attributes:
+        if attribute in item:
+            product[attribute] = item[attribute]
+    return product
+
+def batch_write_products(event, operations):
+    """ Creates, updates and deletes products with BatchWriteItem. 
+        Updates replace the whole product, like update_product they create the product if the key does not exist.
+        Updates of products which can still be in other shards move the product with a transaction each.
+
+    Args:
+        event: lambda event
+        operations (list): payloads with an operation attribute of create, update or delete.
+            Update and delete payloads carry the key of the product
+
+    Returns:
+        list: result of every operation, in the order of the operations
+    """
+    tenantId = event['requestContext']['authorizer']['tenantId']
+    table = __get_dynamodb_table(event)
+    shard_count = shard_manager.get_shard_count(event)
+
+    results = []
+    #(result index, write request) of every operation, written in two rounds. Deletes remove the product from the shard 
+    #a reshard moves it to last, so it cannot be moved back into it
+    first_requests = []
+    second_requests = []
+    #(result index, product, other shard ids) of updates which move the product into its shard
+    moved_products = []
+    productIds = set()
+    for payload in operations:
+        operation = getattr(payload, 'operation', None)
+        try:
+            if (operation == 'create'):
+                productId = str(uuid.uuid4())
+                shardId = shard_manager.get_shard_id(tenantId, productId, shard_count)
+                product = __get_product_from_payload(shardId, productId, payload)
+                requests = [{'PutRequest': {'Item': __get_product_item(product)}}], []
+            elif (operation == 'update'):
+                keyShardId, productId = __parse_key(tenantId, __get_attribute(payload, 'key'))
+                shardId, otherShardIds = shard_manager.get_item_write_shard_ids(event, productId, keyShardId)
+                product = __get_product_from_payload(shardId, productId, payload)
+                if (len(otherShardIds) > 0):
+                    requests = [], []
+                else:
+                    requests = [{'PutRequest': {'Item': __get_product_item(product)}}], []
+            elif (operation == 'delete'):
+                keyShardId, productId = __parse_key(tenantId, __get_attribute(payload, 'key'))
+                shardId, otherShardIds = shard_manager.get_item_write_shard_ids(event, productId, keyShardId)
+                if (len(otherShardIds) > 0):
+                    requests = __get_delete_requests(otherShardIds, productId), __get_delete_requests([shardId], productId)
+                else:
+                    requests = __get_delete_requests([shardId], productId), []
+            else:
+                raise ValueError('operation should be create, update or delete')
+            if (productId in productIds):
+                raise ValueError('Duplicate key in batch')
+        except ValueError as e:
+            results.append({'operation': operation, 'key': getattr(payload, 'key', None), 'status': 'failed', 'error': str(e.args[0])})
+            continue
+
+        productIds.add(productId)
+        if (operation == 'update' and len(otherShardIds) > 0):
+            moved_products.append((len(results), product, otherShardIds))
+        first_requests.extend((len(results), request) for request in requests[0])
+        second_requests.extend((len(results), request) for request in requests[1])
+        results.append({'operation': operation, 'key': shardId + ':' + productId, 'status': 'succeeded'})
+
+    capacity_units = __write_requests(table, results, first_requests)
+    capacity_units += __write_requests(table, results, [(result_index, request) for result_index, request in second_requests 
+        if results[result_index]['status'] == 'succeeded'])
+    for result_index, product, otherShardIds in moved_products:
+        try:
+            capacity_units += __write_moved_product(table, product, otherShardIds)
+        except ClientError as e:
+            logger.error(e.response['Error']['Message'])
+            results[result_index]['status'] = 'failed'
+            results[result_index]['error'] = e.response['Error']['Message']
+
+    metrics_manager.record_metric(event, "WriteCapacityUnits", "Count", capacity_units)
+    logger.info("BatchWriteItem completed")
+    return results
+
+def __write_requests(table, results, indexed_requests):
+    # a failed request fails the result of its operation
+    errors, capacity_units = batch_manager.batch_write_items(table, ['shardId', 'productId'], [request for result_index, request in indexed_requests])
+    for (result_index, request), error in zip(indexed_requests, errors):
+        if error is not None:
+            results[result_index]['status'] = 'failed'
+            results[result_index]['error'] = error
+    return capacity_units
+
+def __write_moved_product(table, product, otherShardIds):
+    """ Writes the product to its shard and deletes it from the other shards which can hold it in one transaction,
+        so list queries never return the product twice
+
+    Returns:
+        float: write capacity units consumed
+    """
+    response = table.meta.client.transact_write_items(TransactItems=
+        [{'Put': {'TableName': table.name, 'Item': __get_product_item(product)}}] +
+        [{'Delete': {'TableName': table.name, 'Key': {'shardId': shardId, 'productId': product.productId}}} for shardId in otherShardIds],
+        ReturnConsumedCapacity='TOTAL')
+    return sum(consumed_capacity['CapacityUnits'] for consumed_capacity in response.get('ConsumedCapacity', []))
+
+def __get_delete_requests(shardIds, productId):
+    return [{'DeleteRequest': {'Key': {'shardId': shardId, 'productId': productId}}} for shardId in shardIds]
+
+def __get_product_from_payload(shardId, productId, payload):
+    return Product(shardId, productId, __get_attribute(payload, 'sku'), __get_attribute(payload, 'name'), 
+        __get_attribute(payload, 'price'), __get_attribute(payload, 'category'))
+
+def __get_product_item(product):
+    return {
+        'shardId': product.shardId,
+        'productId': product.productId,
+        'sku': product.sku,
+        'name': product.name,
+        'price': product.price,
+        'category': product.category,
+        'itemVersion': shard_manager.new_item_version()
+    }
+
+def __get_attribute(payload, name):
+    if not hasattr(payload, name):
+        raise ValueError('Missing attribute ' + name)
+    return getattr(payload, name)
+
+def __parse_key(tenantId, key):
+    # keys of other tenants would fail the whole BatchWriteItem call in pooled deployments, so they are rejected per item
+    parts = key.split(":") if isinstance(key, str) else []
+    if (len(parts) != 2 or not parts[0].startswith(tenantId + '-')):
+        raise ValueError('Invalid key')
+    return parts[0], parts[1]
+
 def get_products(event, tenantId):    
-    table = __get_dynamodb_table(event, dynamodb)
+    table = __get_dynamodb_table(event)
     get_all_products_response =[]
     try:
-        __query_all_partitions(tenantId,get_all_products_response, table, event)
+        shard_states = __get_initial_shard_states(event)
+        __query_all_partitions(tenantId, shard_states, None, get_all_products_response, table, event)
     except ClientError as e:
         logger.error(e.response['Error']['Message'])
         raise Exception('Error getting all products', e)
@@ -134,44 +353,121 @@ def get_products(event, tenantId):
         logger.info("Get products succeeded")
         return get_all_products_response
 
-def __query_all_partitions(tenantId,get_all_products_response, table, event):
-    threads = []    
-    
-    for suffix in range(suffix_start, suffix_end):
-        partition_id = tenantId+'-'+str(suffix)
-        
-        thread = threading.Thread(target=__get_tenant_data, args=[partition_id, get_all_products_response, table, event])
-        threads.append(thread)
-        
-    # Start threads
-    for thread in threads:
-        thread.start()
-    # Ensure all threads are finished
-    for thread in threads:
-        thread.join()
-           
-def __get_tenant_data(partition_id, get_all_products_response, table, event):    
-    logger.info(partition_id)
-    response = table.query(KeyConditionExpression=Key('shardId').eq(partition_id), ReturnConsumedCapacity='TOTAL')    
-    if (len(response['Items']) > 0):
-        for item in response['Items']:
-            product = Product(item['shardId'], item['productId'], item['sku'], item['name'], item['price'], item['category'])
-            get_all_products_response.append(product)
-
-    metrics_manager.record_metric(event, "ReadCapacityUnits", "Count", response['ConsumedCapacity']['CapacityUnits'])        
-
-def __get_dynamodb_table(event, dynamodb):    
-    if (is_pooled_deploy=='true'):
-        accesskey = event['requestContext']['authorizer']['accesskey']
-        secretkey = event['requestContext']['authorizer']['secretkey']
-        sessiontoken = event['requestContext']['authorizer']['sessiontoken']    
-        dynamodb = boto3.resource('dynamodb',
-                aws_access_key_id=accesskey,
-                aws_secret_access_key=secretkey,
-                aws_session_token=sessiontoken
-                )       
+def get_products_page(event, tenantId, limit, cursor):
+    """ Get one page of products merged from all the shards of the tenant
+
+    Args:
+        event: lambda event
+        tenantId (string): tenant id
+        limit (int): maximum number of products in the page
+        cursor (dict): decoded cursor returned with the previous page, None for the first page
+
+    Returns:
+        tuple: products of the page and the cursor for the next page, None if this is the last page
+    """
+    if cursor is not None and not __is_valid_cursor(event, cursor):
+        raise ValueError('Invalid cursor')
+    table = __get_dynamodb_table(event)
+    get_products_page_response = []
+    try:
+        shard_states = cursor if cursor is not None else __get_initial_shard_states(event)
+        __query_all_partitions(tenantId, shard_states, limit, get_products_page_response, table, event)
+    except ClientError as e:
+        logger.error(e.response['Error']['Message'])
+        raise Exception('Error getting products page', e)
     else:
-        if not dynamodb:
-            dynamodb = boto3.resource('dynamodb')
-        
-    return dynamodb.Table(table_name)
+        logger.info("Get products page succeeded")
+        next_cursor = shard_states if len(shard_states) > 0 else None
+        return get_products_page_response, next_cursor
+
+def __get_initial_shard_states(event):
+    # shard suffix -> last evaluated productId of the shard, None if the shard has not been read yet.
+    # Exhausted shards are removed.
+    return {suffix: None for suffix in shard_manager.get_shard_suffixes(shard_manager.get_read_shard_count(event))}
+
+def __is_valid_cursor(event, cursor):
+    valid_suffixes = __get_initial_shard_states(event).keys()
+    for suffix, start_key in cursor.items():
+        if suffix not in valid_suffixes or not (start_key is None or isinstance(start_key, str)):
+            return False
+    return True
+
+def __query_all_partitions(tenantId, shard_states, limit, get_all_products_response, table, event):
+    for products in __iter_partition_pages(tenantId, shard_states, limit, table, event):
+        get_all_products_response.extend(products)
+
+def __iter_partition_pages(tenantId, shard_states, limit, table, event):
+    """ Reads the shards in rounds, one query per remaining shard in each round, until the limit is reached
+        or all the shards are exhausted, and yields the items of every shard query in shard order. 
+        When there is a limit, the per shard query limit is chosen so that a round never returns more 
+        items than still fit in the page.
+        Consumed capacity and latency of all the shard queries are recorded as one metric document.
+    """
+    consumed_capacity_units = 0
+    max_shard_latency = 0
+    shard_queries = 0
+    item_count = 0
+    try:
+        while (len(shard_states) > 0 and (limit is None or item_count < limit)):
+            suffixes = sorted(shard_states.keys(), key=int)
+            shard_limit = None
+            if (limit is not None):
+                remaining = limit - item_count
+                suffixes = suffixes[:remaining]
+                shard_limit = remaining // len(suffixes)
+
+            futures = []
+            for suffix in suffixes:
+                partition_id = tenantId+'-'+suffix
+                futures.append(shard_query_executor.submit(__get_tenant_data, partition_id, shard_states[suffix], shard_limit, table))
+
+            # Gather the results in shard order and move the shard positions forward
+            for suffix, future in zip(suffixes, futures):
+                products, last_evaluated_key, capacity_units, latency = future.result()
+                consumed_capacity_units += capacity_units
+                max_shard_latency = max(max_shard_latency, latency)
+                shard_queries += 1
+                if last_evaluated_key is None:
+                    del shard_states[suffix]
+                else:
+                    shard_states[suffix] = last_evaluated_key['productId']
+                item_count += len(products)
+                yield products
+    finally:
+        metrics_manager.record_metrics(event, [
+            ("ReadCapacityUnits", "Count", consumed_capacity_units),
+            ("ShardQueries", "Count", shard_queries),
+            ("ShardQueryMaxLatency", "Milliseconds", max_shard_latency)
+        ])
+           
+def __get_tenant_data(partition_id, start_sort_key, shard_limit, table):    
+    logger.debug(partition_id)
+    query_params = {
+        'KeyConditionExpression': Key('shardId').eq(partition_id),
+        'ReturnConsumedCapacity': 'TOTAL'
+    }
+    if start_sort_key is not None:
+        query_params['ExclusiveStartKey'] = {'shardId': partition_id, 'productId': start_sort_key}
+    if shard_limit is not None:
+        query_params['Limit'] = shard_limit
+
+    start_time = time.perf_counter()
+    response = table.query(**query_params)
+    latency = (time.perf_counter() - start_time) * 1000
+    products = []
+    for item in response['Items']:
+        products.append(Product.from_item(item))
+
+    return products, response.get('LastEvaluatedKey'), response['ConsumedCapacity']['CapacityUnits'], latency
+
+def __get_dynamodb_table(event):
+    """ Determine the table based upon pooled vs silo model. 
+        Pooled deployments access the table with the tenant scoped credentials passed by the authorizer
+
+    Args:
+        event ([type]): [description]
+
+    Returns:
+        [type]: [description]
+    """
+    return client_manager.get_dynamodb_table(event, table_name, is_pooled_deploy)
@@ -2,15 +2,18 @@
 # SPDX-License-Identifier: MIT-0
 
 import re
-import json
 import os
-import urllib.request
 import boto3
 import time
 import logger
-from jose import jwk, jwt
+import metrics_manager
+from jose import jwt
 from jose.utils import base64url_decode
 import auth_manager
+import credentials_manager
+import jwks_manager
+import shard_manager
+import tenant_details_manager
 import utils
 
 region = os.environ['AWS_REGION']
@@ -21,6 +24,8 @@ user_pool_operation_user = os.environ['OPERATION_USERS_USER_POOL']
 app_client_operation_user = os.environ['OPERATION_USERS_APP_CLIENT']
 api_key_operation_user = os.environ['OPERATION_USERS_API_KEY']
 
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def lambda_handler(event, context):
     
     #get JWT token after Bearer from authorization
@@ -32,41 +37,38 @@ def lambda_handler(event, context):
     
     #only to get tenant id to get user pool info
     unauthorized_claims = jwt.get_unverified_claims(jwt_bearer_token)
-    logger.info(unauthorized_claims)
+    logger.debug(unauthorized_claims)
 
     if(auth_manager.isSaaSProvider(unauthorized_claims['custom:userRole'])):
         userpool_id = user_pool_operation_user
         appclient_id = app_client_operation_user   
         api_key = api_key_operation_user  
+        shard_count = shard_manager.DEFAULT_SHARD_COUNT
+        read_shard_count = shard_manager.DEFAULT_SHARD_COUNT
+        previous_shard_count = shard_manager.DEFAULT_SHARD_COUNT
     else:
         #get tenant user pool and app client to validate jwt token against
-        tenant_details = table_tenant_details.get_item( 
-            Key ={
-                'tenantId': unauthorized_claims['custom:tenantId']
-            }
-        )
-        logger.info(tenant_details)
-        userpool_id = tenant_details['Item']['userPoolId']
-        appclient_id = tenant_details['Item']['appClientId']
-        apigateway_url = tenant_details['Item']['apiGatewayUrl']
-        api_key = tenant_details['Item']['apiKey']
+        tenant_details = tenant_details_manager.get_tenant_details(table_tenant_details, unauthorized_claims['custom:tenantId'])
+        logger.debug(tenant_details)
+        if (tenant_details is None):
+            logger.error('Unauthorized')
+            raise Exception('Unauthorized')
+        userpool_id = tenant_details['userPoolId']
+        appclient_id = tenant_details['appClientId']
+        apigateway_url = tenant_details['apiGatewayUrl']
+        api_key = tenant_details['apiKey']
+        shard_count, read_shard_count, previous_shard_count = shard_manager.get_shard_counts_from_tenant_details(tenant_details)
         
 
-    #get keys for tenant user pool to validate
-    keys_url = 'https://cognito-idp.{}.amazonaws.com/{}/.well-known/jwks.json'.format(region, userpool_id)
-    with urllib.request.urlopen(keys_url) as f:
-        response = f.read()
-    keys = json.loads(response.decode('utf-8'))['keys']
-
-    #authenticate against cognito user pool using the key
-    response = validateJWT(jwt_bearer_token, appclient_id, keys)
+    #authenticate against cognito user pool using the cached keys of the user pool
+    response = validateJWT(jwt_bearer_token, appclient_id, userpool_id)
     
     #get authenticated claims
     if (response == False):
         logger.error('Unauthorized')
         raise Exception('Unauthorized')
     else:
-        logger.info(response)
+        logger.debug(response)
         principal_id = response["sub"]
         user_name = response["cognito:username"]
         tenant_id = response["custom:tenantId"]
@@ -99,28 +101,27 @@ def lambda_handler(event, context):
     #   Another option is to generate the STS token inside the lambda function itself, as mentioned in this blog post: https://aws.amazon.com/blogs/apn/isolating-saas-tenants-with-dynamically-generated-iam-policies/
     #   Finally, you can also consider creating one Authorizer per microservice in cases where you want the IAM policy specific to that service 
     
-    iam_policy = auth_manager.getPolicyForUser(user_role, utils.Service_Identifier.BUSINESS_SERVICES.value, tenant_id, region, aws_account_id)
-    logger.info(iam_policy)
+    #   Credentials are reused per tenant, role and service until shortly before they expire
     
     role_arn = "arn:aws:iam::{}:role/authorizer-access-role".format(aws_account_id)
     
-    assumed_role = sts_client.assume_role(
-        RoleArn=role_arn,
-        RoleSessionName="tenant-aware-session",
-        Policy=iam_policy,
-    )
-    credentials = assumed_role["Credentials"]
+    credentials = credentials_manager.get_credentials(sts_client, role_arn, tenant_id, user_role, 
+        utils.Service_Identifier.BUSINESS_SERVICES.value, region, aws_account_id)
 
     #pass sts credentials to lambda
     context = {
         'accesskey': credentials['AccessKeyId'], # $context.authorizer.key -> value
         'secretkey' : credentials['SecretAccessKey'],
         'sessiontoken' : credentials["SessionToken"],
+        'sessionexpiration' : int(credentials['Expiration'].timestamp()),
         'userName': user_name,
         'tenantId': tenant_id,
         'userPoolId': userpool_id,
         'apiKey': api_key,
-        'userRole': user_role
+        'userRole': user_role,
+        'shardCount': shard_count,
+        'readShardCount': read_shard_count,
+        'previousShardCount': previous_shard_count
     }
     
     authResponse['context'] = context
@@ -134,21 +135,14 @@ def isTenantAuthorizedForThisAPI(apigateway_url, current_api_id):
     else:
         return True
 
-def validateJWT(token, app_client_id, keys):
+def validateJWT(token, app_client_id, user_pool_id):
     # get the kid from the headers prior to verification
     headers = jwt.get_unverified_headers(token)
     kid = headers['kid']
-    # search for the kid in the downloaded public keys
-    key_index = -1
-    for i in range(len(keys)):
-        if kid == keys[i]['kid']:
-            key_index = i
-            break
-    if key_index == -1:
-        logger.info('Public key not found in jwks.json')
+    # get the public key for the kid, jwks.json is only downloaded when it is not cached
+    public_key = jwks_manager.get_public_key(user_pool_id, kid)
+    if public_key is None:
         return False
-    # construct the public key
-    public_key = jwk.construct(keys[key_index])
     # get the last two sections of the token,
     # message and signature (encoded in base64)
     message, encoded_signature = str(token).rsplit('.', 1)
@@ -171,7 +165,7 @@ def validateJWT(token, app_client_id, keys):
         logger.info('Token was not issued for this audience')
         return False
     # now we can use the claims
-    logger.info(claims)
+    logger.debug(claims)
     return claims
 
 
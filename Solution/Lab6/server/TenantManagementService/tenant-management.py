@@ -11,6 +11,9 @@ from botocore.exceptions import ClientError
 import logger
 import metrics_manager
 import auth_manager
+import client_manager
+import scan_manager
+import idempotency_manager
 import requests
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 
@@ -21,6 +24,9 @@ tracer = Tracer()
 region = os.environ['AWS_REGION']
 
 #This method has been locked down to be only
+@metrics_manager.buffer_metrics
+@logger.tenant_context
+@idempotency_manager.idempotent_request
 def create_tenant(event, context):
     api_gateway_url = ''       
     tenant_details = json.loads(event['body'])
@@ -62,19 +68,23 @@ def create_tenant(event, context):
     else:
         return utils.create_success_response("Tenant Created")
 
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def get_tenants(event, context):
     
     table_tenant_details = __getTenantManagementTable(event)
 
     try:
-        response = table_tenant_details.scan()
+        tenants = list(scan_manager.scan_items(table_tenant_details))
     except Exception as e:
         raise Exception('Error getting all tenants', e)
     else:
-        return utils.generate_response(response['Items'])    
+        return utils.generate_response(tenants)    
 
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def update_tenant(event, context):
     
     table_tenant_details = __getTenantManagementTable(event)
@@ -117,8 +127,7 @@ def update_tenant(event, context):
             ReturnValues="UPDATED_NEW"
             )             
             
-        
-        logger.log_with_tenant_context(event, response_update)     
+        logger.debug_with_tenant_context(event, response_update)     
 
         logger.log_with_tenant_context(event, "Request completed to update tenant")
         return utils.create_success_response("Tenant Updated")
@@ -127,6 +136,8 @@ def update_tenant(event, context):
         return utils.create_unauthorized_response()
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def get_tenant(event, context):
     table_tenant_details = __getTenantManagementTable(event)
     
@@ -152,7 +163,7 @@ def get_tenant(event, context):
         )             
         item = tenant_details['Item']
         tenant_info = TenantInfo(item['tenantName'], item['tenantAddress'],item['tenantEmail'], item['tenantPhone'])
-        logger.log_with_tenant_context(event, tenant_info)
+        logger.debug_with_tenant_context(event, tenant_info)
         
         logger.log_with_tenant_context(event, "Request completed to get tenant details")
         return utils.create_success_response(tenant_info.__dict__)
@@ -161,6 +172,8 @@ def get_tenant(event, context):
         return utils.create_unauthorized_response()  
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def deactivate_tenant(event, context):
     table_tenant_details = __getTenantManagementTable(event)
     
@@ -192,7 +205,7 @@ def deactivate_tenant(event, context):
             ReturnValues="ALL_NEW"
             )             
         
-        logger.log_with_tenant_context(event, response)
+        logger.debug_with_tenant_context(event, response)
 
         if (response["Attributes"]["dedicatedTenancy"].upper() == "TRUE"):
             update_details = {}
@@ -206,7 +219,7 @@ def deactivate_tenant(event, context):
         update_details['requestingTenantId'] = requesting_tenant_id
         update_details['userRole'] = user_role
         update_user_response = __invoke_disable_users(update_details, headers, auth, host, stage_name, url_disable_users)
-        logger.log_with_tenant_context(event, update_user_response)
+        logger.debug_with_tenant_context(event, update_user_response)
 
         logger.log_with_tenant_context(event, "Request completed to deactivate tenant")
         return utils.create_success_response("Tenant Deactivated")
@@ -215,6 +228,8 @@ def deactivate_tenant(event, context):
         return utils.create_unauthorized_response()    
 
 @tracer.capture_lambda_handler
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def activate_tenant(event, context):
     table_tenant_details = __getTenantManagementTable(event)
     
@@ -246,13 +261,13 @@ def activate_tenant(event, context):
             ReturnValues="ALL_NEW"
             )             
         
-        logger.log_with_tenant_context(event, response)
+        logger.debug_with_tenant_context(event, response)
 
         if (response["Attributes"]["dedicatedTenancy"].upper() == "TRUE"):
             update_details = {}
             update_details['tenantId'] = tenant_id            
             provision_response = __invoke_provision_tenant(update_details, headers, auth, host, stage_name, url_provision_tenant)
-            logger.log_with_tenant_context(event, provision_response)
+            logger.debug_with_tenant_context(event, provision_response)
         
         update_details = {}
         update_details['userPoolId'] = response["Attributes"]['userPoolId']
@@ -260,7 +275,7 @@ def activate_tenant(event, context):
         update_details['requestingTenantId'] = requesting_tenant_id
         update_details['userRole'] = user_role
         update_user_response = __invoke_enable_users(update_details, headers, auth, host, stage_name, url_enable_users)
-        logger.log_with_tenant_context(event, update_user_response)
+        logger.debug_with_tenant_context(event, update_user_response)
 
         logger.log_with_tenant_context(event, "Request completed to activate tenant")
         return utils.create_success_response("Tenant Activated")
@@ -268,6 +283,8 @@ def activate_tenant(event, context):
         logger.log_with_tenant_context(event, "Request completed as unauthorized. Only system admin can activate tenant!")        
         return utils.create_unauthorized_response()    
 
+@metrics_manager.buffer_metrics
+@logger.tenant_context
 def load_tenant_config(event, context):
     params = event['pathParameters']
     tenantName = urllib.parse.unquote(params['tenantname'])
@@ -361,10 +378,7 @@ def __getApiKey(tenant_tier):
         return os.environ['BASIC_TIER_API_KEY']
         
 def __getTenantManagementTable(event):
-    accesskey = event['requestContext']['authorizer']['accesskey']
-    secretkey = event['requestContext']['authorizer']['secretkey']
-    sessiontoken = event['requestContext']['authorizer']['sessiontoken']    
-    dynamodb = boto3.resource('dynamodb', aws_access_key_id=accesskey, aws_secret_access_key=secretkey, aws_session_token=sessiontoken)
+    dynamodb = client_manager.get_tenant_dynamodb_resource(event)
     table_tenant_details = dynamodb.Table('ServerlessSaaS-TenantDetails')#TODO: read table names from env vars
     
     return table_tenant_details
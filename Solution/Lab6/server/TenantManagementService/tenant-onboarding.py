@@ -0,0 +1,205 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import boto3
+import os
+import time
+import random
+import utils
+import logger
+import requests
+from botocore.exceptions import ClientError
+import idempotency_manager
+from aws_lambda_powertools import Tracer
+tracer = Tracer()
+
+region = os.environ['AWS_REGION']
+
+#Attempts of a step per invocation, retried with exponential backoff and full jitter
+onboarding_max_attempts = int(os.environ.get('ONBOARDING_MAX_ATTEMPTS', '5'))
+onboarding_base_backoff_seconds = float(os.environ.get('ONBOARDING_BASE_BACKOFF_SECONDS', '1'))
+onboarding_max_backoff_seconds = float(os.environ.get('ONBOARDING_MAX_BACKOFF_SECONDS', '20'))
+#API Gateway ends integrations after 29 seconds
+step_request_timeout_seconds = 35
+
+REGISTRATION_PENDING = 'PENDING'
+REGISTRATION_IN_PROGRESS = 'IN_PROGRESS'
+REGISTRATION_COMPLETE = 'COMPLETE'
+REGISTRATION_FAILED = 'FAILED'
+
+STEP_PENDING = 'PENDING'
+STEP_COMPLETE = 'COMPLETE'
+STEP_FAILED = 'FAILED'
+
+#Errors of a step are stored and returned by get_registration as one of these categories,
+#the response bodies are only logged
+ERROR_TIMEOUT = 'Timeout'
+ERROR_CONNECTION = 'ConnectionError'
+ERROR_THROTTLED = 'Throttled'
+ERROR_SERVER = 'ServerError'
+ERROR_CLIENT = 'ClientError'
+error_categories = [ERROR_TIMEOUT, ERROR_CONNECTION, ERROR_THROTTLED, ERROR_SERVER, ERROR_CLIENT]
+
+dynamodb = boto3.resource('dynamodb')
+table_tenant_registration = dynamodb.Table('ServerlessSaaS-TenantRegistration')
+
+
+@tracer.capture_lambda_handler
+def onboard_tenant(event, context):
+    """ Onboards the tenant of a registration: creates the tenant admin user, the tenant
+        and, for dedicated tenancy, provisions the tenant stack. Invoked asynchronously by register_tenant.
+
+        The state of every step is stored with the registration, so an invocation which timed out
+        or failed is resumed from the first step which is not complete, by the retries of the
+        asynchronous invocation or by invoking the function again with the registration id.
+        Steps are called with an idempotency key, so a step whose response was lost is not run twice.
+        Only one invocation works on a registration at a time.
+
+    Args:
+        event: {"registrationId": "..."}
+    """
+    registration_id = event['registrationId']
+    registration = __claim_registration(registration_id, context)
+    if registration is None:
+        logger.info("Registration " + registration_id + " is complete or being onboarded by another invocation")
+        return
+
+    try:
+        tenant_details = registration['tenantDetails']
+        steps = registration.get('steps') or __get_initial_steps(tenant_details)
+        auth = utils.get_auth(registration['host'], region)
+        for step_name, resource_path in __get_onboarding_steps(tenant_details):
+            if steps[step_name]['stepStatus'] == STEP_COMPLETE:
+                continue
+            url = ''.join(['https://', registration['host'], '/', registration['stageName'], resource_path])
+            response_json, error = __call_step(url, tenant_details, auth, registration_id + '#' + step_name, steps[step_name])
+            if error is not None:
+                steps[step_name].update({'stepStatus': STEP_FAILED, 'lastError': error})
+                __save_progress(registration_id, REGISTRATION_FAILED, steps, tenant_details, release=True)
+                logger.error("Onboarding of registration " + registration_id + " failed at step " + step_name + ": " + error)
+                return
+
+            logger.info(response_json)
+            if step_name == 'CreateTenantAdminUser':
+                tenant_details['userPoolId'] = response_json['message']['userPoolId']
+                tenant_details['appClientId'] = response_json['message']['appClientId']
+                tenant_details['tenantAdminUserName'] = response_json['message']['tenantAdminUserName']
+            steps[step_name].update({'stepStatus': STEP_COMPLETE, 'lastError': '', 'completedAt': int(time.time())})
+            __save_progress(registration_id, REGISTRATION_IN_PROGRESS, steps, tenant_details)
+
+        __save_progress(registration_id, REGISTRATION_COMPLETE, steps, tenant_details, release=True)
+        logger.info("Onboarding of registration " + registration_id + " complete")
+    except Exception:
+        # let the retry of the asynchronous invocation resume right away
+        __release_registration(registration_id)
+        raise
+
+@tracer.capture_lambda_handler
+def get_registration(event, context):
+    """ Returns the status of a registration and of its onboarding steps
+    """
+    registration_id = event['pathParameters']['registrationid']
+    registration = table_tenant_registration.get_item(Key={'registrationId': registration_id}).get('Item')
+    if registration is None:
+        return utils.create_notfound_response("Registration not found")
+
+    steps = registration.get('steps') or __get_initial_steps(registration['tenantDetails'])
+    return utils.generate_response({
+        'registrationId': registration_id,
+        'registrationStatus': registration['registrationStatus'],
+        'steps': [dict(steps[step_name], stepName=step_name, lastError=__get_error_category(steps[step_name]['lastError']))
+            for step_name, resource_path in __get_onboarding_steps(registration['tenantDetails'])],
+        'createdAt': registration['createdAt'],
+        'updatedAt': registration['updatedAt']
+    })
+
+def __get_onboarding_steps(tenant_details):
+    # step name and resource path, in the order the steps run
+    onboarding_steps = [
+        ('CreateTenantAdminUser', os.environ['CREATE_TENANT_ADMIN_USER_RESOURCE_PATH']),
+        ('CreateTenant', os.environ['CREATE_TENANT_RESOURCE_PATH'])
+    ]
+    if (tenant_details['dedicatedTenancy'].upper() == 'TRUE'):
+        onboarding_steps.append(('ProvisionTenant', os.environ['PROVISION_TENANT_RESOURCE_PATH']))
+    return onboarding_steps
+
+def __get_error_category(last_error):
+    # registrations onboarded before the categories stored the response body of the step
+    if (last_error == '' or last_error in error_categories):
+        return last_error
+    return ERROR_CLIENT
+
+def __get_initial_steps(tenant_details):
+    return {step_name: {'stepStatus': STEP_PENDING, 'attempts': 0, 'lastError': ''} for step_name, resource_path in __get_onboarding_steps(tenant_details)}
+
+def __call_step(url, tenant_details, auth, idempotency_key, step):
+    """ Calls a step with retries. Connection errors, throttling and server errors are retried,
+        other client errors fail the step right away.
+
+    Returns:
+        tuple: the json response and None, or None and the error category of the last attempt
+    """
+    headers = {'Content-Type': 'application/json', idempotency_manager.IDEMPOTENCY_KEY_HEADER: idempotency_key}
+    error = None
+    for attempt in range(onboarding_max_attempts):
+        if attempt > 0:
+            time.sleep(random.uniform(0, min(onboarding_max_backoff_seconds, onboarding_base_backoff_seconds * (2 ** attempt))))
+        step['attempts'] += 1
+        try:
+            response = requests.post(url, data=json.dumps(tenant_details), auth=auth, headers=headers, timeout=step_request_timeout_seconds)
+        except requests.exceptions.RequestException as e:
+            error = ERROR_TIMEOUT if isinstance(e, requests.exceptions.Timeout) else ERROR_CONNECTION
+            logger.error("Request " + idempotency_key + " failed: " + str(e))
+            continue
+        if response.status_code == 200:
+            return response.json(), None
+        logger.error("Request " + idempotency_key + " failed with status " + str(response.status_code) + ": " + response.text)
+        if response.status_code == 429:
+            error = ERROR_THROTTLED
+        elif response.status_code >= 500:
+            error = ERROR_SERVER
+        else:
+            error = ERROR_CLIENT
+            break
+    return None, error
+
+def __claim_registration(registration_id, context):
+    # the claim expires when the invocation times out, so the retry of a timed out invocation can claim it
+    now = int(time.time())
+    try:
+        response = table_tenant_registration.update_item(
+            Key={'registrationId': registration_id},
+            UpdateExpression="set registrationStatus = :inProgress, claimedUntil = :claimedUntil, updatedAt = :now",
+            ConditionExpression="attribute_exists(registrationId) and registrationStatus <> :complete and (attribute_not_exists(claimedUntil) or claimedUntil < :now)",
+            ExpressionAttributeValues={
+                ':inProgress': REGISTRATION_IN_PROGRESS,
+                ':complete': REGISTRATION_COMPLETE,
+                ':claimedUntil': now + context.get_remaining_time_in_millis() // 1000 + 1,
+                ':now': now
+            },
+            ReturnValues="ALL_NEW")
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    return response['Attributes']
+
+def __release_registration(registration_id):
+    table_tenant_registration.update_item(
+        Key={'registrationId': registration_id},
+        UpdateExpression="remove claimedUntil")
+
+def __save_progress(registration_id, status, steps, tenant_details, release=False):
+    update_expression = "set registrationStatus = :status, steps = :steps, tenantDetails = :tenantDetails, updatedAt = :now"
+    if release:
+        update_expression += " remove claimedUntil"
+    table_tenant_registration.update_item(
+        Key={'registrationId': registration_id},
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues={
+            ':status': status,
+            ':steps': steps,
+            ':tenantDetails': tenant_details,
+            ':now': int(time.time())
+        })
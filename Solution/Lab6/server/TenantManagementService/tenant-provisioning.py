@@ -6,6 +6,7 @@ import boto3
 import utils
 from botocore.exceptions import ClientError
 import logger
+import idempotency_manager
 import os
 from aws_lambda_powertools import Tracer
 tracer = Tracer()
@@ -19,6 +20,7 @@ table_tenant_stack_mapping = dynamodb.Table(tenant_stack_mapping_table_name)
 
 stack_name = 'stack-{0}'
 @tracer.capture_lambda_handler
+@idempotency_manager.idempotent_request
 def provision_tenant(event, context):
     tenant_details = json.loads(event['body'])
     
@@ -4,26 +4,33 @@
 import json
 import boto3
 import os
+import time
 import utils
 import uuid
 import logger
-import requests
 import re
 
 region = os.environ['AWS_REGION']
-create_tenant_admin_user_resource_path = os.environ['CREATE_TENANT_ADMIN_USER_RESOURCE_PATH']
-create_tenant_resource_path = os.environ['CREATE_TENANT_RESOURCE_PATH']
-provision_tenant_resource_path = os.environ['PROVISION_TENANT_RESOURCE_PATH']
+onboard_tenant_function_name = os.environ['ONBOARD_TENANT_FUNCTION_NAME']
 
 platinum_tier_api_key = os.environ['PLATINUM_TIER_API_KEY']
 premium_tier_api_key = os.environ['PREMIUM_TIER_API_KEY']
 standard_tier_api_key = os.environ['STANDARD_TIER_API_KEY']
 basic_tier_api_key = os.environ['BASIC_TIER_API_KEY']
 
+#Registrations are kept for this long after they were received
+registration_ttl_seconds = 30 * 24 * 60 * 60
+
 lambda_client = boto3.client('lambda')
+dynamodb = boto3.resource('dynamodb')
+table_tenant_registration = dynamodb.Table('ServerlessSaaS-TenantRegistration')
 
 
 def register_tenant(event, context):
+    """ Records a registration and starts onboarding the tenant in the background,
+        with the onboarding function of tenant-onboarding. Returns the registration id right away,
+        the progress of the onboarding is returned by the registration status endpoint.
+    """
     try:
         api_key=''
         tenant_id = uuid.uuid1().hex
@@ -39,70 +46,35 @@ def register_tenant(event, context):
             api_key = standard_tier_api_key
         elif (tenant_details['tenantTier'].upper() == utils.TenantTier.BASIC.value.upper()):
             api_key = basic_tier_api_key
-        
+
         tenant_details['tenantId'] = tenant_id
         tenant_details['apiKey'] = api_key
-        
-        logger.info(tenant_details)
 
-        stage_name = event['requestContext']['stage']
-        host = event['headers']['Host']
-        auth = utils.get_auth(host, region)
-        headers = utils.get_headers(event)
-        create_user_response = __create_tenant_admin_user(tenant_details, headers, auth, host, stage_name)
-        
-        logger.info (create_user_response)
-        tenant_details['userPoolId'] = create_user_response['message']['userPoolId']
-        tenant_details['appClientId'] = create_user_response['message']['appClientId']
-        tenant_details['tenantAdminUserName'] = create_user_response['message']['tenantAdminUserName']
+        logger.info(tenant_details)
 
-        create_tenant_response = __create_tenant(tenant_details, headers, auth, host, stage_name)
-        logger.info (create_tenant_response)
+        registration_id = uuid.uuid4().hex
+        now = int(time.time())
+        table_tenant_registration.put_item(
+            Item={
+                'registrationId': registration_id,
+                'tenantId': tenant_id,
+                'registrationStatus': 'PENDING',
+                'tenantDetails': tenant_details,
+                # the onboarding calls the tenant services through the api the registration was received by
+                'host': event['headers']['Host'],
+                'stageName': event['requestContext']['stage'],
+                'createdAt': now,
+                'updatedAt': now,
+                'expiresAt': now + registration_ttl_seconds
+            }
+        )
 
-        if (tenant_details['dedicatedTenancy'].upper() == 'TRUE'):
-            provision_tenant_response = __provision_tenant(tenant_details, headers, auth, host, stage_name)
-            logger.info(provision_tenant_response)
+        lambda_client.invoke(FunctionName=onboard_tenant_function_name, InvocationType='Event',
+            Payload=json.dumps({'registrationId': registration_id}))
+        logger.info("Onboarding started for registration " + registration_id)
 
-        
     except Exception as e:
         logger.error('Error registering a new tenant')
         raise Exception('Error registering a new tenant', e)
     else:
-        return utils.create_success_response("You have been registered in our system")
-
-def __create_tenant_admin_user(tenant_details, headers, auth, host, stage_name):
-    try:
-        url = ''.join(['https://', host, '/', stage_name, create_tenant_admin_user_resource_path])
-        logger.info(url)
-        response = requests.post(url, data=json.dumps(tenant_details), auth=auth, headers=headers) 
-        response_json = response.json()
-    except Exception as e:
-        logger.error('Error occured while calling the create tenant admin user service')
-        raise Exception('Error occured while calling the create tenant admin user service', e)
-    else:
-        return response_json
-
-def __create_tenant(tenant_details, headers, auth, host, stage_name):
-    try:
-        url = ''.join(['https://', host, '/', stage_name, create_tenant_resource_path])
-        response = requests.post(url, data=json.dumps(tenant_details), auth=auth, headers=headers) 
-        response_json = response.json()
-    except Exception as e:
-        logger.error('Error occured while creating the tenant record in table')
-        raise Exception('Error occured while creating the tenant record in table', e) 
-    else:
-        return response_json
-
-def __provision_tenant(tenant_details, headers, auth, host, stage_name):
-    try:
-        url = ''.join(['https://', host, '/', stage_name, provision_tenant_resource_path])
-        logger.info(url)
-        response = requests.post(url, data=json.dumps(tenant_details), auth=auth, headers=headers) 
-        response_json = response.json()['message']
-    except Exception as e:
-        logger.error('Error occured while provisioning the tenant')
-        raise Exception('Error occured while creating the tenant record in table', e) 
-    else:
-        return response_json
-
-              
+        return utils.create_success_response({"registrationId": registration_id, "registrationStatus": "PENDING"})
@@ -0,0 +1,237 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import time
+import uuid
+import datetime
+import boto3
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
+import logger
+import shard_manager
+from aws_lambda_powertools import Tracer
+tracer = Tracer()
+
+#authorizers cache tenant details and API Gateway caches authorizer results, so new shard counts
+#take a while to reach every writer. Items are moved only after that, so no writer still routes
+#items to shards which are being drained.
+propagation_seconds = int(os.environ.get('RESHARD_PROPAGATION_SECONDS', '120'))
+#Items read per shard query, the position of the job is saved after every page
+reshard_page_size = int(os.environ.get('RESHARD_PAGE_SIZE', '100'))
+#The job continues in a new invocation when less time than this is left
+reshard_min_remaining_millis = int(os.environ.get('RESHARD_MIN_REMAINING_MILLIS', str(60 * 1000)))
+#Attempts to move an item which is written while it is being moved
+move_max_attempts = 5
+scheduler_role_arn = os.environ['RESHARD_SCHEDULER_ROLE_ARN']
+
+RESHARD_IN_PROGRESS = 'IN_PROGRESS'
+RESHARD_COMPLETE = 'COMPLETE'
+
+dynamodb = boto3.resource('dynamodb')
+table_tenant_details = dynamodb.Table('ServerlessSaaS-TenantDetails')
+lambda_client = boto3.client('lambda')
+scheduler_client = boto3.client('scheduler')
+
+resharded_tables = [('Product', 'productId'), ('Order', 'orderId')]
+
+@tracer.capture_lambda_handler
+def reshard_tenant(event, context):
+    """ Changes the number of shards of a tenant while the tenant keeps serving requests.
+        New writes are routed with the new shard count right away, reads look the items up in the shards
+        of both shard counts and list queries keep reading the larger of both shard counts until
+        the items whose shard changed have been moved.
+
+        The items are moved by continuations of the job. The first one is scheduled with EventBridge Scheduler
+        for when the new shard count reached every writer. The position in every table is saved after every page,
+        a continuation running out of time invokes the next one, which resumes from there. A job stopped
+        by an error is resumed by invoking the function again with the reshard id.
+
+    Args:
+        event: {"tenantId": "...", "shardCount": n} to start a reshard,
+            {"tenantId": "...", "reshardId": "..."} to continue it
+
+    Returns:
+        dict: reshard id and status of the reshard
+    """
+    tenant_id = event['tenantId']
+    tracer.put_annotation(key="TenantId", value=tenant_id)
+    if 'reshardId' in event:
+        return __continue_reshard(tenant_id, event['reshardId'], context)
+    return __start_reshard(tenant_id, int(event['shardCount']), context)
+
+def __start_reshard(tenant_id, new_shard_count, context):
+    if (new_shard_count < 1 or new_shard_count > shard_manager.MAX_SHARD_COUNT):
+        raise Exception('shardCount must be between 1 and ' + str(shard_manager.MAX_SHARD_COUNT))
+    logger.info("Request received to reshard tenant " + tenant_id)
+
+    tenant_details = table_tenant_details.get_item(Key={'tenantId': tenant_id}, ConsistentRead=True)['Item']
+    old_shard_count, old_read_shard_count, _ = shard_manager.get_shard_counts_from_tenant_details(tenant_details)
+    reshard_id = uuid.uuid4().hex
+    move_after = int(time.time()) + propagation_seconds
+    try:
+        table_tenant_details.update_item(
+            Key={
+                'tenantId': tenant_id,
+            },
+            UpdateExpression="set shardCount = :shardCount, readShardCount = :readShardCount, previousShardCount = :previousShardCount, #reshard = :reshard",
+            ConditionExpression="attribute_not_exists(#reshard)",
+            ExpressionAttributeNames={'#reshard': 'reshard'},
+            ExpressionAttributeValues={
+                    ':shardCount': new_shard_count,
+                    ':readShardCount': max(old_read_shard_count, new_shard_count),
+                    ':previousShardCount': old_shard_count,
+                    # position of the job in every table, by table name
+                    ':reshard': {'reshardId': reshard_id, 'moveAfter': move_after, 'positions': {}}
+                }
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise Exception('Tenant ' + tenant_id + ' is already being resharded')
+        raise
+
+    scheduler_client.create_schedule(
+        Name='reshard-' + reshard_id,
+        ScheduleExpression='at(' + datetime.datetime.utcfromtimestamp(move_after).strftime('%Y-%m-%dT%H:%M:%S') + ')',
+        FlexibleTimeWindow={'Mode': 'OFF'},
+        Target={
+            'Arn': context.invoked_function_arn,
+            'RoleArn': scheduler_role_arn,
+            'Input': json.dumps({'tenantId': tenant_id, 'reshardId': reshard_id})
+        },
+        ActionAfterCompletion='DELETE')
+    logger.info("Reshard " + reshard_id + " of tenant " + tenant_id + " from " + str(old_shard_count) + " to " + str(new_shard_count) + " shards scheduled")
+    return {'reshardId': reshard_id, 'status': RESHARD_IN_PROGRESS}
+
+def __continue_reshard(tenant_id, reshard_id, context):
+    tenant_details = table_tenant_details.get_item(Key={'tenantId': tenant_id}, ConsistentRead=True)['Item']
+    reshard = tenant_details.get('reshard')
+    if (reshard is None or reshard['reshardId'] != reshard_id):
+        logger.info("Reshard " + reshard_id + " of tenant " + tenant_id + " is complete")
+        return {'reshardId': reshard_id, 'status': RESHARD_COMPLETE}
+    if (time.time() < reshard['moveAfter']):
+        logger.info("Items of tenant " + tenant_id + " are moved by the scheduled continuation")
+        return {'reshardId': reshard_id, 'status': RESHARD_IN_PROGRESS}
+
+    shard_count, read_shard_count, previous_shard_count = shard_manager.get_shard_counts_from_tenant_details(tenant_details)
+    if (tenant_details['dedicatedTenancy'].lower() == 'true'):
+        table_suffix = tenant_id
+    else:
+        table_suffix = 'pooled'
+
+    for table_prefix, sort_key_name in resharded_tables:
+        table = dynamodb.Table(table_prefix + '-' + table_suffix)
+        if not __move_items(table, sort_key_name, tenant_id, reshard, read_shard_count, shard_count, context):
+            lambda_client.invoke(FunctionName=context.invoked_function_arn, InvocationType='Event',
+                Payload=json.dumps({'tenantId': tenant_id, 'reshardId': reshard_id}))
+            logger.info("Reshard " + reshard_id + " of tenant " + tenant_id + " continues in a new invocation")
+            return {'reshardId': reshard_id, 'status': RESHARD_IN_PROGRESS}
+
+    try:
+        table_tenant_details.update_item(
+            Key={
+                'tenantId': tenant_id,
+            },
+            UpdateExpression="set readShardCount = :shardCount remove previousShardCount, #reshard",
+            ConditionExpression="#reshard.reshardId = :reshardId",
+            ExpressionAttributeNames={'#reshard': 'reshard'},
+            ExpressionAttributeValues={
+                    ':shardCount': shard_count,
+                    ':reshardId': reshard_id
+                }
+            )
+    except ClientError as e:
+        # completed by another continuation
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    logger.info("Request completed to reshard tenant " + tenant_id + " from " + str(previous_shard_count) + " to " + str(shard_count) + " shards")
+    return {'reshardId': reshard_id, 'status': RESHARD_COMPLETE}
+
+def __move_items(table, sort_key_name, tenant_id, reshard, read_shard_count, shard_count, context):
+    """ Moves the items of the tenant whose shard changed, one page at a time from the saved position
+
+    Returns:
+        bool: True when all the shards of the table were read, False when the invocation ran out of time
+    """
+    position = reshard['positions'].get(table.name, {'shardSuffix': 1})
+    suffix = int(position['shardSuffix'])
+    start_key = position.get('lastEvaluatedKey')
+    moved = 0
+    try:
+        while suffix <= read_shard_count:
+            if context.get_remaining_time_in_millis() < reshard_min_remaining_millis:
+                return False
+            shard_id = tenant_id + '-' + str(suffix)
+            query_args = {'KeyConditionExpression': Key('shardId').eq(shard_id), 'Limit': reshard_page_size, 'ConsistentRead': True}
+            if start_key is not None:
+                query_args['ExclusiveStartKey'] = start_key
+            response = table.query(**query_args)
+            for item in response['Items']:
+                new_shard_id = shard_manager.get_shard_id(tenant_id, item[sort_key_name], shard_count)
+                if (new_shard_id != shard_id):
+                    moved += __move_item(table, sort_key_name, item, new_shard_id)
+
+            start_key = response.get('LastEvaluatedKey')
+            if start_key is None:
+                suffix += 1
+                position = {'shardSuffix': suffix}
+            else:
+                position = {'shardSuffix': suffix, 'lastEvaluatedKey': start_key}
+            __save_position(tenant_id, reshard['reshardId'], table.name, position)
+        return True
+    finally:
+        logger.info("Moved " + str(moved) + " items of tenant " + tenant_id + " in " + table.name)
+
+def __move_item(table, sort_key_name, item, new_shard_id):
+    """ Moves an item with a transaction which writes the copy in the new shard and deletes the item
+        only if it was not written since it was read, so no write is lost. An item written in the meantime
+        is read and moved again. A copy which already exists in the new shard was written by a request
+        with the new shard count, the item is only deleted then.
+
+    Returns:
+        int: 1 if the item was moved, 0 if it was deleted or replaced in the meantime
+    """
+    for attempt in range(move_max_attempts):
+        key = {'shardId': item['shardId'], sort_key_name: item[sort_key_name]}
+        try:
+            table.meta.client.transact_write_items(TransactItems=[
+                {'Put': {'TableName': table.name, 'Item': dict(item, shardId=new_shard_id), 'ConditionExpression': 'attribute_not_exists(shardId)'}},
+                {'Delete': dict(__get_version_condition(item), TableName=table.name, Key=key)}
+            ])
+            return 1
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = [reason['Code'] for reason in e.response.get('CancellationReasons', [])]
+            if (reasons == ['ConditionalCheckFailed', 'None']):
+                try:
+                    table.delete_item(Key=key, **__get_version_condition(item))
+                    return 0
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+        item = table.get_item(Key=key, ConsistentRead=True).get('Item')
+        if item is None:
+            return 0
+    raise Exception('Item ' + item['shardId'] + ':' + item[sort_key_name] + ' of ' + table.name + ' is being written, resume the reshard later')
+
+def __get_version_condition(item):
+    if 'itemVersion' in item:
+        return {'ConditionExpression': 'itemVersion = :itemVersion', 'ExpressionAttributeValues': {':itemVersion': item['itemVersion']}}
+    # items written before versions were stored
+    return {'ConditionExpression': 'attribute_exists(shardId) and attribute_not_exists(itemVersion)'}
+
+def __save_position(tenant_id, reshard_id, table_name, position):
+    table_tenant_details.update_item(
+        Key={
+            'tenantId': tenant_id,
+        },
+        UpdateExpression="set #reshard.positions.#table = :position",
+        ConditionExpression="#reshard.reshardId = :reshardId",
+        ExpressionAttributeNames={'#reshard': 'reshard', '#table': table_name},
+        ExpressionAttributeValues={
+                ':position': position,
+                ':reshardId': reshard_id
+            }
+        )
@@ -9,6 +9,7 @@ import logger
 import utils
 import metrics_manager
 import auth_manager
+import idempotency_manager
 from boto3.dynamodb.conditions import Key
 from aws_lambda_powertools import Tracer
 tracer = Tracer()
@@ -18,6 +19,7 @@ dynamodb = boto3.resource('dynamodb')
 table_tenant_user_map = dynamodb.Table('ServerlessSaaS-TenantUserMapping')
 table_tenant_details = dynamodb.Table('ServerlessSaaS-TenantDetails')
 
+@idempotency_manager.idempotent_request
 def create_tenant_admin_user(event, context):
     tenant_user_pool_id = os.environ['TENANT_USER_POOL_ID']
     tenant_app_client_id = os.environ['TENANT_APP_CLIENT_ID']
@@ -28,15 +30,22 @@ def create_tenant_admin_user(event, context):
 
     user_mgmt = UserManagement()
 
+    # resources created by an earlier attempt which failed part way are reused,
+    # so the tenant onboarding can retry this step
     if (tenant_details['dedicatedTenancy'] == 'true'):
-        user_pool_response = user_mgmt.create_user_pool(tenant_id)
-        user_pool_id = user_pool_response['UserPool']['Id']
+        user_pool_id = user_mgmt.get_user_pool_id(tenant_id)
+        if user_pool_id is None:
+            user_pool_response = user_mgmt.create_user_pool(tenant_id)
+            user_pool_id = user_pool_response['UserPool']['Id']
         logger.info (user_pool_id)
         
-        app_client_response = user_mgmt.create_user_pool_client(user_pool_id)
-        logger.info(app_client_response)
-        app_client_id = app_client_response['UserPoolClient']['ClientId']
-        user_pool_domain_response = user_mgmt.create_user_pool_domain(user_pool_id, tenant_id)
+        app_client_id = user_mgmt.get_user_pool_client_id(user_pool_id)
+        if app_client_id is None:
+            app_client_response = user_mgmt.create_user_pool_client(user_pool_id)
+            logger.info(app_client_response)
+            app_client_id = app_client_response['UserPoolClient']['ClientId']
+        if not user_mgmt.has_user_pool_domain(user_pool_id):
+            user_pool_domain_response = user_mgmt.create_user_pool_domain(user_pool_id, tenant_id)
         
         logger.info ("New Tenant Created")
     else:
@@ -44,13 +53,13 @@ def create_tenant_admin_user(event, context):
         app_client_id = tenant_app_client_id
 
     #Add tenant admin now based upon user pool
-    tenant_user_group_response = user_mgmt.create_user_group(user_pool_id,tenant_id,"User group for tenant {0}".format(tenant_id))
+    user_mgmt.create_user_group(user_pool_id,tenant_id,"User group for tenant {0}".format(tenant_id))
 
     tenant_admin_user_name = 'tenant-admin-{0}'.format(tenant_details['tenantId'])
 
     create_tenant_admin_response = user_mgmt.create_tenant_admin(user_pool_id, tenant_admin_user_name, tenant_details)
     
-    add_tenant_admin_to_group_response = user_mgmt.add_user_to_group(user_pool_id, tenant_admin_user_name, tenant_user_group_response['Group']['GroupName'])
+    add_tenant_admin_to_group_response = user_mgmt.add_user_to_group(user_pool_id, tenant_admin_user_name, tenant_id)
     
     tenant_user_mapping_response = user_mgmt.create_user_tenant_mapping(tenant_admin_user_name,tenant_id)
     
@@ -380,6 +389,34 @@ def get_user_info(event, user_pool_id, user_name):
     return user_info
 
 class UserManagement:
+    def get_user_pool_name(self, tenant_id):
+        return tenant_id + '-ServerlessSaaSUserPool'
+
+    def get_user_pool_id(self, tenant_id):
+        """ Id of the user pool of a tenant, None when it does not exist
+        """
+        user_pool_name = self.get_user_pool_name(tenant_id)
+        paginator = client.get_paginator('list_user_pools')
+        for page in paginator.paginate(MaxResults=60):
+            for user_pool in page['UserPools']:
+                if (user_pool['Name'] == user_pool_name):
+                    return user_pool['Id']
+        return None
+
+    def get_user_pool_client_id(self, user_pool_id):
+        """ Id of the app client of a tenant user pool, None when it does not exist
+        """
+        paginator = client.get_paginator('list_user_pool_clients')
+        for page in paginator.paginate(UserPoolId=user_pool_id, MaxResults=60):
+            for user_pool_client in page['UserPoolClients']:
+                if (user_pool_client['ClientName'] == 'ServerlessSaaSClient'):
+                    return user_pool_client['ClientId']
+        return None
+
+    def has_user_pool_domain(self, user_pool_id):
+        response = client.describe_user_pool(UserPoolId=user_pool_id)
+        return bool(response['UserPool'].get('Domain'))
+
     def create_user_pool(self, tenant_id):
         application_site_url = os.environ['TENANT_USER_POOL_CALLBACK_URL']
         email_message = ''.join(["Login into tenant UI application at ", 
@@ -387,7 +424,7 @@ class UserManagement:
                         " with username {username} and temporary password {####}"])
         email_subject = "Your temporary password for tenant UI application"  
         response = client.create_user_pool(
-            PoolName= tenant_id + '-ServerlessSaaSUserPool',
+            PoolName= self.get_user_pool_name(tenant_id),
             AutoVerifiedAttributes=['email'],
             AccountRecoverySetting={
                 'RecoveryMechanisms': [
@@ -462,15 +499,26 @@ class UserManagement:
         return response
 
     def create_user_group(self, user_pool_id, group_name, group_description):
-        response = client.create_group(
-            GroupName=group_name,
-            UserPoolId=user_pool_id,
-            Description= group_description,
-            Precedence=0
-        )
+        try:
+            response = client.create_group(
+                GroupName=group_name,
+                UserPoolId=user_pool_id,
+                Description= group_description,
+                Precedence=0
+            )
+        except client.exceptions.GroupExistsException:
+            logger.info("User group " + group_name + " exists already")
+            return None
         return response
 
     def create_tenant_admin(self, user_pool_id, tenant_admin_user_name, user_details):
+        try:
+            return self.__admin_create_user(user_pool_id, tenant_admin_user_name, user_details)
+        except client.exceptions.UsernameExistsException:
+            logger.info("Tenant admin " + tenant_admin_user_name + " exists already")
+            return None
+
+    def __admin_create_user(self, user_pool_id, tenant_admin_user_name, user_details):
         response = client.admin_create_user(
             Username=tenant_admin_user_name,
             UserPoolId=user_pool_id,
@@ -3,6 +3,8 @@
 
 import { Construct } from 'constructs';
 import * as cdk from 'aws-cdk-lib';
+import * as fs from 'fs';
+import * as path from 'path';
 
 import * as s3 from 'aws-cdk-lib/aws-s3';
 import * as codecommit from 'aws-cdk-lib/aws-codecommit';
@@ -29,14 +31,42 @@ export class ServerlessSaaSStack extends cdk.Stack {
         lambdaPolicy.addActions("*")
         lambdaPolicy.addResources("*")
 
+    //This function is not deployed with the layers of the SAM stacks, the layer modules it imports
+    //are copied into its asset next to the handler
+    const layerModules = ['scan_manager.py'];
+
     const lambdaFunction = new Function(this, "deploy-tenant-stack", {
         handler: "lambda-deploy-tenant-stack.lambda_handler",
         runtime: Runtime.PYTHON_3_9,
-        code: new AssetCode(`./resources`),
+        code: new AssetCode(`./resources`, {
+            //hash the bundled files, so a change to a copied layer module redeploys the function
+            assetHashType: cdk.AssetHashType.OUTPUT,
+            bundling: {
+                image: Runtime.PYTHON_3_9.bundlingImage,
+                local: {
+                    tryBundle(outputDir: string) {
+                        for (const file of fs.readdirSync(`./resources`)) {
+                            fs.copyFileSync(path.join(`./resources`, file), path.join(outputDir, file));
+                        }
+                        for (const layerModule of layerModules) {
+                            fs.copyFileSync(path.join(`../layers`, layerModule), path.join(outputDir, layerModule));
+                        }
+                        return true;
+                    }
+                }
+            }
+        }),
         memorySize: 512,
-        timeout: Duration.seconds(10),
+        timeout: Duration.seconds(300),
         environment: {
             BUCKET: artifactsBucket.bucketName,
+            ROLLOUT_WAVE_SIZE: '10',
+            ROLLOUT_API_CONCURRENCY: '8',
+            ROLLOUT_CANARY_SIZE: '1',
+            ROLLOUT_CANARY_BAKE_SECONDS: '600',
+            ROLLOUT_WAVE_BAKE_SECONDS: '120',
+            ROLLOUT_MAX_ERROR_RATE: '0.05',
+            ROLLOUT_MAX_API_ERRORS: '5',
         },
         initialPolicy: [lambdaPolicy],
     })
@@ -5,11 +5,18 @@ from boto3.session import Session
 
 import json
 import boto3
+import boto3.dynamodb.conditions
 import zipfile
 import tempfile
 import botocore
 import traceback
 import time
+import os
+import datetime
+import hashlib
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+import scan_manager
 
 
 
@@ -17,10 +24,62 @@ print('Loading function')
 
 cf = boto3.client('cloudformation')
 code_pipeline = boto3.client('codepipeline')
+cloudwatch = boto3.client('cloudwatch')
 dynamodb = boto3.resource('dynamodb')
 table_tenant_stack_mapping = dynamodb.Table('ServerlessSaaS-TenantStackMapping')
 table_tenant_details = dynamodb.Table('ServerlessSaaS-TenantDetails')
 table_tenant_settings = dynamodb.Table('ServerlessSaaS-Settings')
+table_tenant_stack_rollout = dynamodb.Table('ServerlessSaaS-TenantStackRollout')
+
+#Stacks are updated in waves, the next wave starts when every stack of the previous one completed
+#and passed its gate. A release is rolled out by one pipeline job, which continues until the last wave completed.
+rollout_wave_size = int(os.environ.get('ROLLOUT_WAVE_SIZE', '10'))
+rollout_canary_size = int(os.environ.get('ROLLOUT_CANARY_SIZE', '1'))
+#Time a wave runs with the release before its error rate is checked
+rollout_canary_bake_seconds = int(os.environ.get('ROLLOUT_CANARY_BAKE_SECONDS', '600'))
+rollout_wave_bake_seconds = int(os.environ.get('ROLLOUT_WAVE_BAKE_SECONDS', '120'))
+#Share of the invocations of the Lambda functions of a wave which may fail during the bake time
+rollout_max_error_rate = float(os.environ.get('ROLLOUT_MAX_ERROR_RATE', '0.05'))
+#CloudFormation calls made in parallel by one invocation
+rollout_api_concurrency = int(os.environ.get('ROLLOUT_API_CONCURRENCY', '8'))
+#Continuations in a row in which the status of a stack could not be read, before the rollout halts
+rollout_max_api_errors = int(os.environ.get('ROLLOUT_MAX_API_ERRORS', '5'))
+#Rollout state is kept for this long after the rollout started
+rollout_state_ttl_seconds = 30 * 24 * 60 * 60
+
+ROLLOUT_PENDING = 'PENDING'
+ROLLOUT_CREATING_CHANGE_SET = 'CREATING_CHANGE_SET'
+ROLLOUT_IN_PROGRESS = 'IN_PROGRESS'
+ROLLOUT_BAKING = 'BAKING'
+ROLLOUT_COMPLETE = 'COMPLETE'
+ROLLOUT_FAILED = 'FAILED'
+ROLLOUT_ROLLING_BACK = 'ROLLING_BACK'
+ROLLOUT_ROLLED_BACK = 'ROLLED_BACK'
+ROLLOUT_ROLLBACK_FAILED = 'ROLLBACK_FAILED'
+
+#Waves are stored next to the stacks of a rollout, under this prefix instead of a tenant id
+WAVE_KEY_PREFIX = 'WAVE#'
+#Wave of the stacks whose template and parameters did not change since their last release.
+#They are not rolled out, no wave is created for them.
+UNCHANGED_WAVE = -1
+
+#Rings of the tenant tiers, the values of utils.TenantTier in the server layers. Tenants of lower
+#rings get a release first. The ring attribute of a tenant stack mapping overrides the tier, ring 0
+#is the canary ring. The pooled stack serves all pooled tenants, so it gets the release last.
+tier_rings = {'basic': 1, 'standard': 2, 'premium': 3, 'platinum': 4}
+unknown_tier_ring = 4
+pooled_ring = 5
+
+# UPDATE_ROLLBACK_COMPLETE is included, so a stack whose last update was rolled back gets the next release
+updatable_stack_statuses = ['CREATE_COMPLETE', 'ROLLBACK_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
+# a stack created from a change set is in REVIEW_IN_PROGRESS until the change set is executed
+review_stack_status = 'REVIEW_IN_PROGRESS'
+in_progress_change_set_statuses = ['CREATE_PENDING', 'CREATE_IN_PROGRESS']
+# status reasons of change sets which were not created because the stack is up to date
+no_changes_reasons = ["didn't contain changes", 'No updates are to be performed']
+in_progress_stack_statuses = ['UPDATE_IN_PROGRESS', 'UPDATE_ROLLBACK_IN_PROGRESS', 
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'CREATE_IN_PROGRESS', 
+    'ROLLBACK_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS']
 
 
 def find_artifact(artifacts, name):
@@ -41,19 +100,23 @@ def find_artifact(artifacts, name):
             
     raise Exception('Input artifact named "{0}" not found in event'.format(name))
 
-def get_template_url(s3, artifact, file_in_zip):
+def get_template_url(s3, artifact, file_in_zip, rollout_id):
     """Gets the template artifact
     
     Downloads the artifact from the S3 artifact store to a temporary file
     then extracts the zip and returns the file containing the CloudFormation
-    template.
+    template. The template is uploaded once per rollout, under a key of its own,
+    so stacks still updating with the template of an earlier rollout are not affected.
+    Templates packaged by sam reference their nested templates and code by content
+    hashed keys, so the hash of the template changes with any of them.
     
     Args:
         artifact: The artifact to download
         file_in_zip: The path to the file within the zip containing the template
+        rollout_id: The rollout the template is uploaded for
         
     Returns:
-        The CloudFormation template as a string
+        The URL of the uploaded template and the SHA-256 hash of its content
         
     Raises:
         Exception: Any exception thrown while downloading the artifact or unzipping it
@@ -69,9 +132,12 @@ def get_template_url(s3, artifact, file_in_zip):
         s3.download_file(bucket, key, tmp_file.name)
         with zipfile.ZipFile(tmp_file.name, 'r') as zip:
             extracted_file = zip.extract(file_in_zip, '/tmp/')
-            s3.upload_file(extracted_file, bucket, file_in_zip)
-            template_url =''.join(['https://', bucket,'.s3.amazonaws.com/',file_in_zip])
-            return template_url  
+            template_key = ''.join(['rollouts/', rollout_id, '/', file_in_zip])
+            s3.upload_file(extracted_file, bucket, template_key)
+            template_url =''.join(['https://', bucket,'.s3.amazonaws.com/',template_key])
+            with open(extracted_file, 'rb') as template:
+                template_hash = hashlib.sha256(template.read()).hexdigest()
+            return template_url, template_hash
 
             
    
@@ -123,18 +189,6 @@ def stack_exists(stack):
         else:
             raise e
 
-def create_stack(stack, template_url, params):
-    """Starts a new CloudFormation stack creation
-    
-    Args:
-        stack: The stack to be created
-        template_url: The template for the stack to be created with
-        
-    Throws:
-        Exception: Any exception thrown by .create_stack()
-    """
-    cf.create_stack(StackName=stack, TemplateURL=template_url, Capabilities=['CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'], Parameters=params)
- 
 def get_stack_status(stack):
     """Get the status of an existing CloudFormation stack
     
@@ -181,7 +235,7 @@ def put_job_failure(job, message):
     print(message)
     code_pipeline.put_job_failure_result(jobId=job, failureDetails={'message': message, 'type': 'JobFailed'})
  
-def continue_job_later(job, message):
+def continue_job_later(job, message, rollout_id, template_url):
     """Notify CodePipeline of a continuing job
     
     This will cause CodePipeline to invoke the function again with the
@@ -190,7 +244,8 @@ def continue_job_later(job, message):
     Args:
         job: The JobID
         message: A message to be logged relating to the job status
-        continuation_token: The continuation token
+        rollout_id: The rollout the job continues
+        template_url: The template the stacks of the rollout are updated with
         
     Raises:
         Exception: Any exception thrown by .put_job_success_result()
@@ -199,76 +254,518 @@ def continue_job_later(job, message):
     
     # Use the continuation token to keep track of any job execution state
     # This data will be available when a new job is scheduled to continue the current execution
-    continuation_token = json.dumps({'previous_job_id': job})
+    continuation_token = json.dumps({'previous_job_id': job, 'rollout_id': rollout_id, 'template_url': template_url})
     
     print('Putting job continuation')
     print(message)
     code_pipeline.put_job_success_result(jobId=job, continuationToken=continuation_token)
 
-def start_update_or_create(job_id, stack, template_url, params):
-    """Starts the stack update or create process
+def start_update_or_create(stack, template_url, params, change_set_name):
+    """Starts the stack update or create process with a change set
     
-    If the stack exists then update, otherwise create.
+    If the stack exists then a change set to update it is created, otherwise a
+    change set which creates it. The change set is executed once it is created,
+    by check_change_set.
     
     Args:
-        job_id: The ID of the CodePipeline job
         stack: The stack to create or update
         template_url: The template to create/update the stack with
+        params: The parameters of the stack
+        change_set_name: The name of the change set, unique per rollout
+        
+    Returns:
+        The rollout status of the stack and a reason: CREATING_CHANGE_SET when a change set
+        was requested and FAILED when the stack cannot be updated
     
     """
+    change_set_type = 'CREATE'
     if stack_exists(stack):
         status = get_stack_status(stack)
-        if status not in ['CREATE_COMPLETE', 'ROLLBACK_COMPLETE', 'UPDATE_COMPLETE']:
-            # If the CloudFormation stack is not in a state where
-            # it can be updated again then fail the job right away.
-            put_job_failure(job_id, 'Stack cannot be updated when status is: ' + status)
-            return
-        
-        were_updates = update_stack(stack, template_url, params)
+        if status != review_stack_status:
+            if status not in updatable_stack_statuses:
+                # If the CloudFormation stack is not in a state where
+                # it can be updated again then fail the stack right away.
+                return ROLLOUT_FAILED, 'Stack cannot be updated when status is: ' + status
+            change_set_type = 'UPDATE'
+
+    try:
+        cf.create_change_set(StackName=stack, ChangeSetName=change_set_name, ChangeSetType=change_set_type, TemplateURL=template_url,
+            Capabilities=['CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'], Parameters=params)
+    except botocore.exceptions.ClientError as e:
+        # an invocation which timed out may have created the change set already
+        if e.response['Error']['Code'] != 'AlreadyExistsException':
+            raise e
+    return ROLLOUT_CREATING_CHANGE_SET, 'Change set requested'
+
+def check_change_set(stack, change_set_name):
+    """Monitor the creation of a change set, and execute it once it is created
+    
+    The changes of the change set are logged as a preview of the update. A change
+    set without changes is deleted, the stack is complete without an update.
+    
+    Args:
+        stack: The stack of the change set
+        change_set_name: The name of the change set
         
-        if were_updates:
-            # If there were updates then continue the job so it can monitor
-            # the progress of the update.
-            continue_job_later(job_id, 'Stack update started')  
-            
-        else:
-            # If there were no updates then succeed the job immediately 
-            put_job_success(job_id, 'There were no stack updates')    
-    else:
-        # If the stack doesn't already exist then create it instead
-        # of updating it.
-        create_stack(stack, template_url, params)
-        # Continue the job so the pipeline will wait for the CloudFormation
-        # stack to be created.
-        continue_job_later(job_id, 'Stack create started') 
-
-def check_stack_update_status(job_id, stack):
-    """Monitor an already-running CloudFormation update/create
+    Returns:
+        The rollout status of the stack, CREATING_CHANGE_SET, IN_PROGRESS, COMPLETE or FAILED, and a reason
     
-    Succeeds, fails or continues the job depending on the stack status.
+    """
+    changes = []
+    describe_args = {'StackName': stack, 'ChangeSetName': change_set_name}
+    while True:
+        change_set = cf.describe_change_set(**describe_args)
+        changes.extend(change['ResourceChange'] for change in change_set.get('Changes', []))
+        if 'NextToken' not in change_set:
+            break
+        describe_args['NextToken'] = change_set['NextToken']
+
+    status = change_set['Status']
+    if status in in_progress_change_set_statuses:
+        return ROLLOUT_CREATING_CHANGE_SET, 'Change set creation still in progress'
+    if status != 'CREATE_COMPLETE':
+        reason = change_set.get('StatusReason', '')
+        if any(no_changes_reason in reason for no_changes_reason in no_changes_reasons):
+            cf.delete_change_set(StackName=stack, ChangeSetName=change_set_name)
+            return ROLLOUT_COMPLETE, 'There were no stack updates'
+        return ROLLOUT_FAILED, 'Change set failed: ' + reason
+    if change_set['ExecutionStatus'] != 'AVAILABLE':
+        # executed by a continuation whose check ended in an exception
+        return ROLLOUT_IN_PROGRESS, 'Change set executed'
+
+    for change in changes:
+        print('{0}: {1} {2} ({3}), replacement: {4}'.format(stack, change['Action'], change['LogicalResourceId'],
+            change['ResourceType'], change.get('Replacement', 'N/A')))
+    cf.execute_change_set(StackName=stack, ChangeSetName=change_set_name)
+    replacements = sum(1 for change in changes if change.get('Replacement') == 'True')
+    return ROLLOUT_IN_PROGRESS, 'Change set executed: {0} changes, {1} replacements'.format(len(changes), replacements)
+
+def check_stack_update_status(stack):
+    """Monitor an already-running CloudFormation update/create
     
     Args:
-        job_id: The CodePipeline job ID
         stack: The stack to monitor
+        
+    Returns:
+        The rollout status of the stack, COMPLETE, IN_PROGRESS or FAILED, and a reason
     
     """
     status = get_stack_status(stack)
     if status in ['UPDATE_COMPLETE', 'CREATE_COMPLETE']:
-        # If the update/create finished successfully then
-        # succeed the job and don't continue.
-        put_job_success(job_id, 'Stack update complete')
+        return ROLLOUT_COMPLETE, 'Stack update complete'
         
-    elif status in ['UPDATE_IN_PROGRESS', 'UPDATE_ROLLBACK_IN_PROGRESS', 
-    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'CREATE_IN_PROGRESS', 
-    'ROLLBACK_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS']:
-        # If the job isn't finished yet then continue it
-        continue_job_later(job_id, 'Stack update still in progress') 
+    elif status in in_progress_stack_statuses:
+        return ROLLOUT_IN_PROGRESS, 'Stack update still in progress'
        
     else:
         # If the Stack is a state which isn't "in progress" or "complete"
-        # then the stack update/create has failed so end the job with
-        # a failed result.
-        put_job_failure(job_id, 'Update failed: ' + status)
+        # then the stack update/create has failed.
+        return ROLLOUT_FAILED, 'Update failed: ' + status
+
+def start_rollout(rollout_id, template_hash):
+    """Records the stacks of every tenant which applies the latest release as pending stacks
+    of a new rollout, scheduled in waves
+    
+    The deployment hash of a stack is the hash of its template and parameters. It is recorded
+    in the tenant stack mapping once the stack is on the release. Stacks whose deployment hash
+    did not change are complete right away, without CloudFormation calls, and are not scheduled.
+    
+    Stacks are grouped into rings, from the ring attribute of their tenant stack mapping
+    or else from the tier of the tenant. The first wave is a canary: the stacks of ring 0,
+    or the first rollout_canary_size stacks of the lowest ring. The other stacks follow
+    ring by ring, in waves of at most rollout_wave_size stacks.
+    
+    Args:
+        rollout_id: The ID of the rollout, the ID of the job which started it
+        template_hash: The hash of the template of the release
+        
+    Returns:
+        The rollout state of the stacks and of the waves
+    
+    """
+    mappings = [mapping for mapping in scan_manager.scan_items(table_tenant_stack_mapping) if mapping['applyLatestRelease']]
+    deployment_hashes = {mapping['tenantId']: get_deployment_hash(template_hash, get_tenant_params(mapping['tenantId'])) for mapping in mappings}
+    unchanged_mappings = [mapping for mapping in mappings if mapping.get('deploymentHash') == deployment_hashes[mapping['tenantId']]]
+    mappings = [mapping for mapping in mappings if mapping.get('deploymentHash') != deployment_hashes[mapping['tenantId']]]
+
+    tenant_tiers = get_tenant_tiers([mapping['tenantId'] for mapping in mappings if 'ring' not in mapping])
+    stacks_by_ring = {}
+    for mapping in sorted(mappings, key=lambda mapping: mapping['tenantId']):
+        stacks_by_ring.setdefault(get_ring(mapping, tenant_tiers), []).append(mapping)
+
+    waves = []
+    rings = sorted(stacks_by_ring)
+    if rings:
+        if rings[0] == 0:
+            waves.append((0, stacks_by_ring.pop(0)))
+            rings = rings[1:]
+        else:
+            waves.append((rings[0], stacks_by_ring[rings[0]][:rollout_canary_size]))
+            stacks_by_ring[rings[0]] = stacks_by_ring[rings[0]][rollout_canary_size:]
+    for ring in rings:
+        ring_stacks = stacks_by_ring[ring]
+        for wave_start in range(0, len(ring_stacks), rollout_wave_size):
+            waves.append((ring, ring_stacks[wave_start:wave_start + rollout_wave_size]))
+
+    expires_at = int(time.time()) + rollout_state_ttl_seconds
+    rollout_stacks = []
+    rollout_waves = []
+    waves = [(None, unchanged_mappings)] + waves
+    for wave, (ring, wave_mappings) in enumerate(waves, UNCHANGED_WAVE):
+        if wave == UNCHANGED_WAVE:
+            for mapping in wave_mappings:
+                rollout_stacks.append(get_rollout_stack(rollout_id, mapping, wave, ROLLOUT_COMPLETE, 'Template and parameters unchanged',
+                    deployment_hashes, expires_at))
+            continue
+        rollout_waves.append({
+            'rolloutId': rollout_id,
+            'tenantId': WAVE_KEY_PREFIX + str(wave).zfill(4),
+            'wave': wave,
+            'ring': ring,
+            'canary': wave == 0,
+            'stackCount': len(wave_mappings),
+            'waveStatus': ROLLOUT_PENDING,
+            'statusReason': '',
+            'expiresAt': expires_at
+        })
+        for mapping in wave_mappings:
+            rollout_stacks.append(get_rollout_stack(rollout_id, mapping, wave, ROLLOUT_PENDING, '', deployment_hashes, expires_at))
+    save_rollout_items(rollout_waves + rollout_stacks)
+    print('Rollout {0} started for {1} stacks in {2} waves, {3} stacks are unchanged'.format(
+        rollout_id, len(mappings), len(rollout_waves), len(unchanged_mappings)))
+    return rollout_stacks, rollout_waves
+
+def get_rollout_stack(rollout_id, mapping, wave, status, reason, deployment_hashes, expires_at):
+    return {
+        'rolloutId': rollout_id,
+        'tenantId': mapping['tenantId'],
+        'stackName': mapping['stackName'],
+        'wave': wave,
+        'rolloutStatus': status,
+        'statusReason': reason,
+        'changed': False,
+        'deploymentHash': deployment_hashes[mapping['tenantId']],
+        'previousCodeCommitId': mapping.get('codeCommitId', ''),
+        'previousTemplateUrl': mapping.get('templateUrl', ''),
+        'previousDeploymentHash': mapping.get('deploymentHash', ''),
+        'expiresAt': expires_at
+    }
+
+def get_deployment_hash(template_hash, params):
+    """Hash of a template and the parameters of a stack, which changes when an update would change the stack
+    """
+    params = sorted((param['ParameterKey'], param['ParameterValue']) for param in params)
+    return hashlib.sha256(json.dumps([template_hash, params]).encode('utf-8')).hexdigest()
+
+def get_tenant_tiers(tenant_ids):
+    """Gets the tiers of tenants from the tenant details, with BatchGetItem
+    
+    Returns:
+        The tier by tenant id, tenants without details are missing
+    
+    """
+    tenant_tiers = {}
+    for chunk_start in range(0, len(tenant_ids), 100):
+        keys = [{'tenantId': tenant_id} for tenant_id in tenant_ids[chunk_start:chunk_start + 100]]
+        while keys:
+            response = dynamodb.batch_get_item(RequestItems={table_tenant_details.name: {
+                'Keys': keys, 'ProjectionExpression': 'tenantId, tenantTier'}})
+            for item in response['Responses'].get(table_tenant_details.name, []):
+                tenant_tiers[item['tenantId']] = item.get('tenantTier', '')
+            keys = response.get('UnprocessedKeys', {}).get(table_tenant_details.name, {}).get('Keys', [])
+            if keys:
+                time.sleep(1)
+    return tenant_tiers
+
+def get_ring(mapping, tenant_tiers):
+    if 'ring' in mapping:
+        return int(mapping['ring'])
+    if mapping['tenantId'] == 'pooled':
+        return pooled_ring
+    return tier_rings.get(tenant_tiers.get(mapping['tenantId'], '').lower(), unknown_tier_ring)
+
+def get_rollout_items(rollout_id):
+    """Gets the rollout state of the stacks and of the waves of a rollout
+    """
+    rollout_items = []
+    query_args = {'KeyConditionExpression': boto3.dynamodb.conditions.Key('rolloutId').eq(rollout_id)}
+    while True:
+        response = table_tenant_stack_rollout.query(**query_args)
+        rollout_items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    rollout_stacks = [item for item in rollout_items if not item['tenantId'].startswith(WAVE_KEY_PREFIX)]
+    rollout_waves = [item for item in rollout_items if item['tenantId'].startswith(WAVE_KEY_PREFIX)]
+    return rollout_stacks, rollout_waves
+
+def save_rollout_items(rollout_items):
+    """Writes the rollout state of stacks and waves with BatchWriteItem
+    """
+    with table_tenant_stack_rollout.batch_writer() as batch:
+        for rollout_item in rollout_items:
+            batch.put_item(Item=rollout_item)
+
+def continue_rollout(job_id, rollout_id, template_url, commit_id, rollout_stacks, rollout_waves):
+    """Advances a rollout and notifies CodePipeline
+    
+    Waves are rolled out one at a time. Once all stacks of a wave are updated, the wave bakes
+    for rollout_canary_bake_seconds or rollout_wave_bake_seconds, then passes its gate when the
+    error rate of the Lambda functions of its stacks stayed at most rollout_max_error_rate.
+    When a stack of the wave failed or the wave did not pass its gate, the rollout halts and the
+    changed stacks of the wave are rolled back to the template of their previous release.
+    Stacks of earlier waves, which passed their gates, keep the release. The job continues until
+    every wave passed its gate, or until the rollback finished and the job fails.
+    
+    Args:
+        job_id: The ID of the CodePipeline job
+        rollout_id: The rollout to advance
+        template_url: The template the stacks are updated with
+        commit_id: The commit of the release, recorded in the tenant stack mapping of complete stacks
+        rollout_stacks: The rollout state of the stacks
+        rollout_waves: The rollout state of the waves
+    
+    """
+    rollout_waves = sorted(rollout_waves, key=lambda rollout_wave: rollout_wave['wave'])
+    while True:
+        rollout_wave = next((rollout_wave for rollout_wave in rollout_waves if rollout_wave['waveStatus'] != ROLLOUT_COMPLETE), None)
+        if rollout_wave is None:
+            print_wave_timings(rollout_waves)
+            put_job_success(job_id, 'Rollout complete for {0} stacks in {1} waves, {2} stacks were unchanged'.format(len(rollout_stacks), len(rollout_waves),
+                sum(1 for rollout_stack in rollout_stacks if rollout_stack['wave'] == UNCHANGED_WAVE)))
+            return
+        wave_stacks = [rollout_stack for rollout_stack in rollout_stacks if rollout_stack['wave'] == rollout_wave['wave']]
+        wave_status = rollout_wave['waveStatus']
+        now = int(time.time())
+
+        if wave_status == ROLLOUT_PENDING:
+            print('Starting wave {0} with {1} stacks'.format(rollout_wave['wave'], len(wave_stacks)))
+            # the stacks are saved as started before the wave, so a wave in progress never has stacks which were not started
+            start_pending_stacks(rollout_id, template_url, commit_id, wave_stacks)
+            set_wave_status(rollout_wave, ROLLOUT_IN_PROGRESS, startedAt=now)
+
+        elif wave_status == ROLLOUT_IN_PROGRESS:
+            # stacks of a wave saved as in progress by an invocation which stopped before saving them
+            start_pending_stacks(rollout_id, template_url, commit_id, wave_stacks)
+            in_progress_stacks = [rollout_stack for rollout_stack in wave_stacks if rollout_stack['rolloutStatus'] in [ROLLOUT_CREATING_CHANGE_SET, ROLLOUT_IN_PROGRESS]]
+            set_rollout_statuses(in_progress_stacks, monitor_stacks(lambda rollout_stack: check_stack_rollout_status(rollout_stack, rollout_id), in_progress_stacks), commit_id, template_url)
+            if any(rollout_stack['rolloutStatus'] in [ROLLOUT_CREATING_CHANGE_SET, ROLLOUT_IN_PROGRESS] for rollout_stack in wave_stacks):
+                continue_job_later(job_id, 'Waiting for the stack updates of wave {0}'.format(rollout_wave['wave']), rollout_id, template_url)
+                return
+            failed_stacks = [rollout_stack for rollout_stack in wave_stacks if rollout_stack['rolloutStatus'] == ROLLOUT_FAILED]
+            if failed_stacks:
+                start_wave_rollback(rollout_wave, wave_stacks, 'Stacks failed: ' + ', '.join(
+                    rollout_stack['stackName'] + ' (' + rollout_stack['statusReason'] + ')' for rollout_stack in failed_stacks))
+            else:
+                bake_seconds = rollout_canary_bake_seconds if rollout_wave['canary'] else rollout_wave_bake_seconds
+                set_wave_status(rollout_wave, ROLLOUT_BAKING, stacksCompletedAt=now, bakeUntil=now + bake_seconds)
+
+        elif wave_status == ROLLOUT_BAKING:
+            if now < rollout_wave['bakeUntil']:
+                continue_job_later(job_id, 'Wave {0} is baking'.format(rollout_wave['wave']), rollout_id, template_url)
+                return
+            error_rate = get_error_rate(wave_stacks, int(rollout_wave['stacksCompletedAt']), now)
+            print('Error rate of wave {0}: {1}'.format(rollout_wave['wave'], error_rate))
+            if error_rate > rollout_max_error_rate:
+                rollout_wave['errorRate'] = Decimal(str(round(error_rate, 6)))
+                start_wave_rollback(rollout_wave, wave_stacks, 'Error rate {0:.2%} exceeds {1:.2%}'.format(error_rate, rollout_max_error_rate))
+            else:
+                set_wave_status(rollout_wave, ROLLOUT_COMPLETE, completedAt=now, errorRate=Decimal(str(round(error_rate, 6))))
+
+        elif wave_status == ROLLOUT_ROLLING_BACK:
+            rolling_back_stacks = [rollout_stack for rollout_stack in wave_stacks if rollout_stack['rolloutStatus'] == ROLLOUT_ROLLING_BACK]
+            set_rollback_statuses(rolling_back_stacks, monitor_stacks(lambda rollout_stack: check_stack_update_status(rollout_stack['stackName']), rolling_back_stacks))
+            if any(rollout_stack['rolloutStatus'] == ROLLOUT_ROLLING_BACK for rollout_stack in wave_stacks):
+                continue_job_later(job_id, 'Rolling back wave {0}'.format(rollout_wave['wave']), rollout_id, template_url)
+                return
+            set_wave_status(rollout_wave, ROLLOUT_ROLLED_BACK, completedAt=now)
+
+        else:
+            print_wave_timings(rollout_waves)
+            put_job_failure(job_id, 'Rollout halted at wave {0}: {1}. Rollback: {2}'.format(rollout_wave['wave'], rollout_wave['statusReason'], ', '.join(
+                rollout_stack['stackName'] + ' ' + rollout_stack['rolloutStatus'] for rollout_stack in wave_stacks)))
+            return
+
+def start_pending_stacks(rollout_id, template_url, commit_id, wave_stacks):
+    # a stack whose change set was requested before the invocation stopped is started again,
+    # requesting the change set again is accepted by start_update_or_create
+    pending_stacks = [rollout_stack for rollout_stack in wave_stacks if rollout_stack['rolloutStatus'] == ROLLOUT_PENDING]
+    set_rollout_statuses(pending_stacks, map_stacks(lambda rollout_stack: start_update_or_create(rollout_stack['stackName'], template_url,
+        get_tenant_params(rollout_stack['tenantId']), get_change_set_name(rollout_id)), pending_stacks), commit_id, template_url)
+
+def get_change_set_name(rollout_id):
+    return 'rollout-' + rollout_id
+
+def check_stack_rollout_status(rollout_stack, rollout_id):
+    if rollout_stack['rolloutStatus'] == ROLLOUT_CREATING_CHANGE_SET:
+        return check_change_set(rollout_stack['stackName'], get_change_set_name(rollout_id))
+    return check_stack_update_status(rollout_stack['stackName'])
+
+def set_wave_status(rollout_wave, status, **attributes):
+    rollout_wave['waveStatus'] = status
+    rollout_wave.update(attributes)
+    if status in [ROLLOUT_COMPLETE, ROLLOUT_ROLLED_BACK]:
+        rollout_wave['durationSeconds'] = rollout_wave['completedAt'] - rollout_wave['startedAt']
+    save_rollout_items([rollout_wave])
+
+def print_wave_timings(rollout_waves):
+    for rollout_wave in rollout_waves:
+        if 'startedAt' not in rollout_wave:
+            continue
+        print('Wave {0} (ring {1}, {2} stacks{3}): {4}, updates took {5}s, {6}s in total, error rate {7}'.format(
+            rollout_wave['wave'], rollout_wave['ring'], rollout_wave['stackCount'], ', canary' if rollout_wave['canary'] else '',
+            rollout_wave['waveStatus'], rollout_wave.get('stacksCompletedAt', rollout_wave.get('completedAt', 0)) - rollout_wave['startedAt'],
+            rollout_wave.get('durationSeconds', '-'), rollout_wave.get('errorRate', '-')))
+
+def start_wave_rollback(rollout_wave, wave_stacks, reason):
+    """Halts the rollout at a wave and rolls the changed stacks of the wave back to their previous release
+    
+    Failed updates were rolled back by CloudFormation already. Stacks without changes need no rollback.
+    Stacks created by the rollout, or whose previous release was not recorded, cannot be rolled back.
+    
+    """
+    print('Rollout halted at wave {0}: {1}'.format(rollout_wave['wave'], reason))
+    set_wave_status(rollout_wave, ROLLOUT_ROLLING_BACK, statusReason=reason)
+
+    def rollback(rollout_stack):
+        if (rollout_stack['rolloutStatus'] == ROLLOUT_FAILED or not rollout_stack['changed']):
+            return ROLLOUT_ROLLED_BACK, rollout_stack['statusReason']
+        if not rollout_stack['previousTemplateUrl']:
+            return ROLLOUT_ROLLBACK_FAILED, 'No previous release recorded for the stack'
+        if update_stack(rollout_stack['stackName'], rollout_stack['previousTemplateUrl'], get_tenant_params(rollout_stack['tenantId'])):
+            return ROLLOUT_ROLLING_BACK, 'Rollback started'
+        return ROLLOUT_ROLLED_BACK, 'There were no stack updates'
+
+    set_rollback_statuses(wave_stacks, map_stacks(rollback, wave_stacks))
+
+def set_rollback_statuses(rollout_stacks, statuses):
+    changed_stacks = []
+    for rollout_stack, (status, reason) in zip(rollout_stacks, statuses):
+        if rollout_stack['rolloutStatus'] == ROLLOUT_ROLLING_BACK:
+            # the stack status of the rollback update
+            status = {ROLLOUT_COMPLETE: ROLLOUT_ROLLED_BACK, ROLLOUT_FAILED: ROLLOUT_ROLLBACK_FAILED}.get(status, ROLLOUT_ROLLING_BACK)
+        if (status == rollout_stack['rolloutStatus'] and reason == rollout_stack['statusReason']):
+            continue
+        if (status == ROLLOUT_ROLLED_BACK and rollout_stack['changed']):
+            # record the release the tenant stack is back on
+            update_tenantstackmapping(rollout_stack['tenantId'], rollout_stack['previousCodeCommitId'], rollout_stack['previousTemplateUrl'],
+                rollout_stack['previousDeploymentHash'])
+        rollout_stack['rolloutStatus'] = status
+        rollout_stack['statusReason'] = reason
+        changed_stacks.append(rollout_stack)
+    save_rollout_items(changed_stacks)
+
+def get_error_rate(rollout_stacks, start_time, end_time):
+    """Error rate of the Lambda functions of stacks, errors divided by invocations, over a period
+    """
+    function_names = [function_name for stack_function_names in map_parallel(
+        lambda rollout_stack: get_stack_function_names(rollout_stack['stackName']), rollout_stacks) for function_name in stack_function_names]
+    period = max(60, (end_time - start_time + 59) // 60 * 60)
+    totals = {'Errors': 0, 'Invocations': 0}
+    queries = []
+    for index, function_name in enumerate(function_names):
+        for metric_name in totals:
+            queries.append({
+                'Id': metric_name.lower() + str(index),
+                'MetricStat': {
+                    'Metric': {'Namespace': 'AWS/Lambda', 'MetricName': metric_name, 'Dimensions': [{'Name': 'FunctionName', 'Value': function_name}]},
+                    'Period': period,
+                    'Stat': 'Sum'
+                }
+            })
+    # GetMetricData accepts at most 500 queries per call
+    for chunk_start in range(0, len(queries), 500):
+        paginator = cloudwatch.get_paginator('get_metric_data')
+        for response in paginator.paginate(MetricDataQueries=queries[chunk_start:chunk_start + 500],
+                StartTime=datetime.datetime.utcfromtimestamp(start_time), EndTime=datetime.datetime.utcfromtimestamp(end_time)):
+            for result in response['MetricDataResults']:
+                totals['Errors' if result['Id'].startswith('errors') else 'Invocations'] += sum(result['Values'])
+    if totals['Invocations'] == 0:
+        return 0.0
+    return totals['Errors'] / totals['Invocations']
+
+def get_stack_function_names(stack):
+    function_names = []
+    paginator = cf.get_paginator('list_stack_resources')
+    for response in paginator.paginate(StackName=stack):
+        for resource in response['StackResourceSummaries']:
+            if resource['ResourceType'] == 'AWS::Lambda::Function':
+                function_names.append(resource['PhysicalResourceId'])
+    return function_names
+
+def map_parallel(function, items):
+    """Calls the function for every item, rollout_api_concurrency items at a time
+    """
+    with ThreadPoolExecutor(max_workers=rollout_api_concurrency) as executor:
+        return list(executor.map(function, items))
+
+def map_stacks(function, rollout_stacks):
+    """Calls the function for every stack, rollout_api_concurrency stacks at a time
+    
+    Returns:
+        The status and reason for every stack. Exceptions fail the stack.
+    
+    """
+    def call(rollout_stack):
+        try:
+            return function(rollout_stack)
+        except Exception as e:
+            print(e)
+            return ROLLOUT_FAILED, 'Function exception: ' + str(e)
+
+    return map_parallel(call, rollout_stacks)
+
+def monitor_stacks(function, rollout_stacks):
+    """Calls a function which reads the status of a stack for every stack, rollout_api_concurrency stacks at a time
+    
+    Only a failed stack or change set status reported by CloudFormation fails a stack. An exception, like
+    throttling after the retries of boto3, leaves the stack at its rollout status, it is checked again
+    by the next continuation. The exceptions in a row are counted in the apiErrors of the stack.
+    
+    Returns:
+        The status and reason for every stack
+        
+    Raises:
+        Exception: When the status of a stack could not be read in rollout_max_api_errors continuations in a row.
+            The rollout halts without a rollback, the stacks may still be updating.
+    
+    """
+    def call(rollout_stack):
+        try:
+            return function(rollout_stack), None
+        except Exception as e:
+            print(e)
+            return (rollout_stack['rolloutStatus'], rollout_stack['statusReason']), e
+
+    results = map_parallel(call, rollout_stacks)
+    counted_stacks = []
+    for rollout_stack, (_, error) in zip(rollout_stacks, results):
+        api_errors = rollout_stack.get('apiErrors', 0) + 1 if error else 0
+        if api_errors != rollout_stack.get('apiErrors', 0):
+            rollout_stack['apiErrors'] = api_errors
+            counted_stacks.append(rollout_stack)
+    save_rollout_items(counted_stacks)
+    for rollout_stack, (_, error) in zip(rollout_stacks, results):
+        if (error and rollout_stack['apiErrors'] >= rollout_max_api_errors):
+            raise Exception('Status of stack {0} could not be read in {1} continuations in a row, the stacks were not rolled back: {2}'.format(
+                rollout_stack['stackName'], rollout_max_api_errors, error))
+    return [status for status, _ in results]
+
+def set_rollout_statuses(rollout_stacks, statuses, commit_id, template_url):
+    changed_stacks = []
+    for rollout_stack, (status, reason) in zip(rollout_stacks, statuses):
+        if (status == rollout_stack['rolloutStatus'] and reason == rollout_stack['statusReason']):
+            continue
+        if (rollout_stack['rolloutStatus'] != ROLLOUT_IN_PROGRESS and status == ROLLOUT_IN_PROGRESS):
+            # the change set was executed
+            rollout_stack['changed'] = True
+        rollout_stack['rolloutStatus'] = status
+        rollout_stack['statusReason'] = reason
+        changed_stacks.append(rollout_stack)
+        if status == ROLLOUT_COMPLETE:
+            # record the release the tenant stack is on
+            update_tenantstackmapping(rollout_stack['tenantId'], commit_id, template_url, rollout_stack['deploymentHash'])
+    save_rollout_items(changed_stacks)
 
 def get_user_params(job_data):
     """Decodes the JSON user parameters and validates the required properties.
@@ -359,21 +856,25 @@ def add_parameter(params, parameter_key, parameter_value):
 
 
 
-def update_tenantstackmapping(tenantId, commit_id):
-    """Update the tenant stack mapping table with the code pipeline job id
+def update_tenantstackmapping(tenantId, commit_id, template_url, deployment_hash):
+    """Update the tenant stack mapping table with the release the tenant stack is on
 
     Args:
         tenantId ([string]): tenant id for which data needs to be updated
-        job_id ([type]): current code pipeline job id
+        commit_id ([string]): commit of the release
+        template_url ([string]): template of the release, used to roll the stack back to it
+        deployment_hash ([string]): hash of the template and parameters the stack is on, unchanged stacks are not updated
 
     Returns:
         [type]: [description]
     """
     response = table_tenant_stack_mapping.update_item(
             Key={'tenantId': tenantId},
-            UpdateExpression="set codeCommitId=:codeCommitId",
+            UpdateExpression="set codeCommitId=:codeCommitId, templateUrl=:templateUrl, deploymentHash=:deploymentHash",
             ExpressionAttributeValues={
-            ':codeCommitId': commit_id
+            ':codeCommitId': commit_id,
+            ':templateUrl': template_url,
+            ':deploymentHash': deployment_hash
             },
             ReturnValues="NONE") 
     
@@ -382,11 +883,12 @@ def update_tenantstackmapping(tenantId, commit_id):
 def lambda_handler(event, context):
     """The Lambda function handler
     
-    If a continuing job then checks the CloudFormation stack status
-    and updates the job accordingly.
+    If a new job then extract the template and start a rollout of the
+    release to the stacks of all tenants, in waves.
     
-    If a new job then kick of an update or creation of the target
-    CloudFormation stack.
+    If a continuing job then check the CloudFormation stack statuses,
+    start the next wave when the current one is complete, and update
+    the job accordingly.
     
     Args:
         event: The event passed by Lambda
@@ -410,36 +912,25 @@ def lambda_handler(event, context):
         template_file = params['template_file']
         commit_id = params['commit_id']
 
-        # Get all the stacks for each tenant to be updated/created from tenant stack mapping table
-        mappings = table_tenant_stack_mapping.scan()
-        print (mappings)
-        #Update/Create stacks for all tenants
-        for mapping in mappings['Items']:
-            stack = mapping['stackName']
-            tenantId = mapping['tenantId']
-            applyLatestRelease = mapping['applyLatestRelease']
-
-            if (applyLatestRelease):
-                # Get the parameters to be passed to the Cloudformation from tenant table
-                params = get_tenant_params(tenantId)
-                
-                if 'continuationToken' in job_data:
-                    # If we're continuing then the create/update has already been triggered
-                    # we just need to check if it has finished.
-                    check_stack_update_status(job_id, stack)
-                else:
-                    # Get the artifact details
-                    artifact_data = find_artifact(artifacts, artifact)
-                    # Get S3 client to access artifact with
-                    s3 = setup_s3_client(job_data)
-                    # Get the JSON template file out of the artifact
-                    template_url = get_template_url(s3, artifact_data, template_file)
-                    
-                    # Kick off a stack update or create
-                    start_update_or_create(job_id, stack, template_url, params)  
-
-                    # If we are applying the release, update tenant stack mapping with the pipe line id
-                    update_tenantstackmapping(tenantId, commit_id)
+        if 'continuationToken' in job_data:
+            # If we're continuing then the rollout has already been started,
+            # we just need to advance it.
+            continuation = json.loads(job_data['continuationToken'])
+            rollout_id = continuation['rollout_id']
+            template_url = continuation['template_url']
+            rollout_stacks, rollout_waves = get_rollout_items(rollout_id)
+        else:
+            rollout_id = job_id
+            # Get the artifact details
+            artifact_data = find_artifact(artifacts, artifact)
+            # Get S3 client to access artifact with
+            s3 = setup_s3_client(job_data)
+            # Get the template file out of the artifact, once for all stacks
+            template_url, template_hash = get_template_url(s3, artifact_data, template_file, rollout_id)
+            # Get all the stacks for each tenant to be updated/created from tenant stack mapping table
+            rollout_stacks, rollout_waves = start_rollout(rollout_id, template_hash)
+
+        continue_rollout(job_id, rollout_id, template_url, commit_id, rollout_stacks, rollout_waves)
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
         # then fail the job and log the exception message.
@@ -1,8 +1,14 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import os
 import json
 import utils
+from functools import lru_cache
+from string import Template
+
+#rendered policies are memoized per (role, service, tenant, region, account)
+policy_cache_size = int(os.environ.get('POLICY_CACHE_SIZE', '10000'))
 
 # These are the roles being supported in this reference architecture
 class UserRoles:
@@ -47,6 +53,27 @@ def getPolicyForUser(user_role, service_identifier, tenant_id, region, aws_accou
     Returns:
         string: policy that tenant needs to assume
     """
+    return __renderPolicy(user_role, service_identifier, tenant_id, region, aws_account_id)
+
+@lru_cache(maxsize=policy_cache_size)
+def __renderPolicy(user_role, service_identifier, tenant_id, region, aws_account_id):
+    policy_template = __getPolicyTemplate(user_role, service_identifier)
+    return policy_template.substitute(tenant_id=__escape(tenant_id), region=__escape(region), 
+        aws_account_id=__escape(aws_account_id))
+
+@lru_cache(maxsize=32)
+def __getPolicyTemplate(user_role, service_identifier):
+    """ Builds the policy document for a role and service only once, 
+        with slots for the tenant, region and account specific values
+    """
+    iam_policy = __buildPolicy(user_role, service_identifier, '${tenant_id}', '${region}', '${aws_account_id}')
+    return Template(iam_policy)
+
+def __escape(value):
+    # values are rendered inside json strings
+    return json.dumps(value)[1:-1]
+
+def __buildPolicy(user_role, service_identifier, tenant_id, region, aws_account_id):
     iam_policy = ""
     
     if (isSystemAdmin(user_role)):
@@ -69,7 +96,9 @@ def __getPolicyForSystemAdmin(region, aws_account_id):
                     "dynamodb:GetItem",
                     "dynamodb:PutItem",
                     "dynamodb:DeleteItem",
-                    "dynamodb:Query",          
+                    "dynamodb:Query",
+                    "dynamodb:BatchWriteItem",
+                    "dynamodb:BatchGetItem",
                     "dynamodb:Scan"
                   ],
                   "Resource": [
@@ -133,7 +162,9 @@ def __getPolicyForTenantAdmin(tenant_id, sevice_identifier, region, aws_account_
                         "dynamodb:GetItem",
                         "dynamodb:PutItem",
                         "dynamodb:DeleteItem",
-                        "dynamodb:Query"    
+                        "dynamodb:Query",
+                        "dynamodb:BatchWriteItem",
+                        "dynamodb:BatchGetItem"
                     ],
                     "Resource": [
                         "arn:aws:dynamodb:{0}:{1}:table/Product-*".format(region, aws_account_id),                      
@@ -153,7 +184,9 @@ def __getPolicyForTenantAdmin(tenant_id, sevice_identifier, region, aws_account_
                         "dynamodb:GetItem",
                         "dynamodb:PutItem",
                         "dynamodb:DeleteItem",
-                        "dynamodb:Query"       
+                        "dynamodb:Query",
+                        "dynamodb:BatchWriteItem",
+                        "dynamodb:BatchGetItem"
                     ],
                     "Resource": [
                         "arn:aws:dynamodb:{0}:{1}:table/Order-*".format(region, aws_account_id),                      
@@ -182,7 +215,9 @@ def __getPolicyForTenantUser(tenant_id, region, aws_account_id):
                       "dynamodb:GetItem",
                       "dynamodb:PutItem",
                       "dynamodb:DeleteItem",
-                      "dynamodb:Query"      
+                      "dynamodb:Query",
+                      "dynamodb:BatchWriteItem",
+                      "dynamodb:BatchGetItem"
                   ],
                   "Resource": [
                       "arn:aws:dynamodb:{0}:{1}:table/Product-*".format(region, aws_account_id),                      
@@ -202,7 +237,9 @@ def __getPolicyForTenantUser(tenant_id, region, aws_account_id):
                       "dynamodb:GetItem",
                       "dynamodb:PutItem",
                       "dynamodb:DeleteItem",
-                      "dynamodb:Query"               
+                      "dynamodb:Query",
+                      "dynamodb:BatchWriteItem",
+                      "dynamodb:BatchGetItem"
                   ],
                   "Resource": [
                       "arn:aws:dynamodb:{0}:{1}:table/Order-*".format(region, aws_account_id),                      
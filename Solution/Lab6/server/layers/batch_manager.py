@@ -0,0 +1,121 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import time
+import random
+from botocore.exceptions import ClientError
+import logger
+
+#BatchWriteItem accepts at most 25 requests per call
+BATCH_WRITE_MAX_SIZE = 25
+#BatchGetItem accepts at most 100 keys per call
+BATCH_GET_MAX_SIZE = 100
+#Requests of a batch endpoint call, bounded so that a call finishes well within the API Gateway timeout
+batch_max_items = int(os.environ.get('BATCH_MAX_ITEMS', '500'))
+#Keys of a get by ids request. Keys are passed in the query string, which API Gateway limits to a few KB,
+#so fewer keys are accepted than items of a batch request
+batch_max_ids = int(os.environ.get('BATCH_MAX_IDS', '100'))
+batch_max_retries = int(os.environ.get('BATCH_MAX_RETRIES', '8'))
+batch_base_backoff_seconds = float(os.environ.get('BATCH_BASE_BACKOFF_SECONDS', '0.05'))
+batch_max_backoff_seconds = float(os.environ.get('BATCH_MAX_BACKOFF_SECONDS', '2'))
+
+def batch_write_items(table, key_names, write_requests):
+    """ Writes put and delete requests with BatchWriteItem in chunks of 25.
+        Unprocessed items are retried with exponential backoff and full jitter.
+
+    Args:
+        table: dynamodb Table resource
+        key_names (list): names of the key attributes of the table
+        write_requests (list): {'PutRequest': {'Item': ...}} or {'DeleteRequest': {'Key': ...}} dicts,
+            at most one request per key
+
+    Returns:
+        tuple: list with None for every written request or the error message of the failed request,
+            and the write capacity units consumed by all calls
+    """
+    errors = [None] * len(write_requests)
+    capacity_units = 0
+    for chunk_start in range(0, len(write_requests), BATCH_WRITE_MAX_SIZE):
+        chunk = write_requests[chunk_start:chunk_start + BATCH_WRITE_MAX_SIZE]
+        #request key -> index of the request in write_requests
+        indexes = {__get_request_key(request, key_names): chunk_start + i for i, request in enumerate(chunk)}
+        pending = chunk
+        attempt = 0
+        while True:
+            try:
+                response = table.meta.client.batch_write_item(RequestItems={table.name: pending}, ReturnConsumedCapacity='TOTAL')
+            except ClientError as e:
+                logger.error(e.response['Error']['Message'])
+                for request in pending:
+                    errors[indexes[__get_request_key(request, key_names)]] = e.response['Error']['Message']
+                break
+
+            for consumed_capacity in response.get('ConsumedCapacity', []):
+                capacity_units += consumed_capacity['CapacityUnits']
+            pending = response.get('UnprocessedItems', {}).get(table.name, [])
+            if len(pending) == 0:
+                break
+            if attempt >= batch_max_retries:
+                for request in pending:
+                    errors[indexes[__get_request_key(request, key_names)]] = 'Request was throttled, retry the item'
+                break
+            __backoff(attempt)
+            attempt += 1
+
+    return errors, capacity_units
+
+def __get_request_key(request, key_names):
+    if 'PutRequest' in request:
+        item = request['PutRequest']['Item']
+    else:
+        item = request['DeleteRequest']['Key']
+    return tuple(item[key_name] for key_name in key_names)
+
+def __backoff(attempt):
+    time.sleep(random.uniform(0, min(batch_max_backoff_seconds, batch_base_backoff_seconds * (2 ** attempt))))
+
+def batch_get_items(table, key_names, keys, attributes=None):
+    """ Reads items with BatchGetItem in chunks of 100.
+        Unprocessed keys are retried with exponential backoff and full jitter.
+
+    Args:
+        table: dynamodb Table resource
+        key_names (list): names of the key attributes of the table
+        keys (list): key dicts, without duplicates
+        attributes (list): attributes to return, None for all. Key attributes are always returned
+
+    Returns:
+        tuple: dict of the found items by key tuple, list of the keys still unprocessed after
+            all retries, and the read capacity units consumed by all calls
+    """
+    keys_and_attributes = {}
+    if attributes is not None:
+        #names are passed as placeholders, so reserved words like name can be projected
+        projected = list(dict.fromkeys(key_names + attributes))
+        keys_and_attributes['ProjectionExpression'] = ', '.join('#a' + str(i) for i in range(len(projected)))
+        keys_and_attributes['ExpressionAttributeNames'] = {'#a' + str(i): name for i, name in enumerate(projected)}
+
+    items = {}
+    unprocessed_keys = []
+    capacity_units = 0
+    for chunk_start in range(0, len(keys), BATCH_GET_MAX_SIZE):
+        pending = keys[chunk_start:chunk_start + BATCH_GET_MAX_SIZE]
+        attempt = 0
+        while True:
+            request = dict(keys_and_attributes, Keys=pending)
+            response = table.meta.client.batch_get_item(RequestItems={table.name: request}, ReturnConsumedCapacity='TOTAL')
+            for consumed_capacity in response.get('ConsumedCapacity', []):
+                capacity_units += consumed_capacity['CapacityUnits']
+            for item in response['Responses'].get(table.name, []):
+                items[tuple(item[key_name] for key_name in key_names)] = item
+            pending = response.get('UnprocessedKeys', {}).get(table.name, {}).get('Keys', [])
+            if len(pending) == 0:
+                break
+            if attempt >= batch_max_retries:
+                unprocessed_keys.extend(pending)
+                break
+            __backoff(attempt)
+            attempt += 1
+
+    return items, unprocessed_keys, capacity_units
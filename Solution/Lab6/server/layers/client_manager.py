@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import time
+import threading
+from collections import OrderedDict
+import boto3
+from botocore.config import Config
+
+#Creating a boto3 resource builds a session, loads the endpoint and service models and opens a new
+#connection pool, so the resources are cached across warm invocations.
+#In pooled deployments resources are created from the tenant scoped STS credentials of the authorizer,
+#and are cached per access key id until the session token expires.
+max_pool_connections = int(os.environ.get('MAX_POOL_CONNECTIONS', '10'))
+client_cache_max_size = int(os.environ.get('CLIENT_CACHE_MAX_SIZE', '100'))
+#used when the authorizer context does not carry the session expiration
+default_session_ttl_seconds = int(os.environ.get('CLIENT_CACHE_DEFAULT_TTL_SECONDS', '900'))
+
+client_config = Config(max_pool_connections=max_pool_connections)
+
+#access key id -> (expires at, dynamodb resource)
+__tenant_resources = OrderedDict()
+__default_resource = None
+__lock = threading.Lock()
+
+def get_dynamodb_table(event, table_name, is_pooled_deploy):
+    """ Returns the dynamodb table, using tenant scoped credentials for pooled deployments
+        and the credentials of the lambda function for silo deployments
+
+    Args:
+        event: lambda event with the authorizer context
+        table_name (string): name of the table
+        is_pooled_deploy (string): 'true' for pooled deployments
+
+    Returns:
+        dynamodb Table resource
+    """
+    if (is_pooled_deploy == 'true'):
+        dynamodb = get_tenant_dynamodb_resource(event)
+    else:
+        dynamodb = get_default_dynamodb_resource()
+    return dynamodb.Table(table_name)
+
+def get_default_dynamodb_resource():
+    """ Returns the dynamodb resource using the credentials of the lambda function
+    """
+    global __default_resource
+    if __default_resource is None:
+        with __lock:
+            if __default_resource is None:
+                __default_resource = boto3.session.Session().resource('dynamodb', config=client_config)
+    return __default_resource
+
+def get_tenant_dynamodb_resource(event):
+    """ Returns the dynamodb resource for the STS credentials passed by the authorizer
+    """
+    authorizer = event['requestContext']['authorizer']
+    accesskey = authorizer['accesskey']
+    now = time.time()
+
+    with __lock:
+        cached = __tenant_resources.get(accesskey)
+        if (cached is not None):
+            if (cached[0] > now):
+                __tenant_resources.move_to_end(accesskey)
+                return cached[1]
+            del __tenant_resources[accesskey]
+
+    session = boto3.session.Session(aws_access_key_id=accesskey,
+        aws_secret_access_key=authorizer['secretkey'],
+        aws_session_token=authorizer['sessiontoken'])
+    dynamodb = session.resource('dynamodb', config=client_config)
+
+    with __lock:
+        __tenant_resources[accesskey] = (__get_session_expiration(authorizer, now), dynamodb)
+        __tenant_resources.move_to_end(accesskey)
+        while len(__tenant_resources) > client_cache_max_size:
+            __tenant_resources.popitem(last=False)
+
+    return dynamodb
+
+def __get_session_expiration(authorizer, now):
+    expiration = authorizer.get('sessionexpiration')
+    if expiration is None:
+        return now + default_session_ttl_seconds
+    return int(expiration)
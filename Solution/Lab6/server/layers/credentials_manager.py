@@ -0,0 +1,108 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import time
+import threading
+from collections import OrderedDict
+import logger
+import auth_manager
+import metrics_manager
+
+#Credentials are handed to the business services through the authorizer context, so they need
+#to stay valid for a while after being returned. Credentials closer to expiry than the minimum
+#lifetime are never returned, and credentials inside the refresh window are renewed in the background.
+#Lambda freezes the execution environment between invocations, so a background refresh only makes
+#progress while an invocation is running. A refresh which has not finished by the time the credentials
+#reach the minimum lifetime is replaced by a synchronous assume_role.
+min_remaining_seconds = int(os.environ.get('STS_CREDENTIALS_MIN_REMAINING_SECONDS', '300'))
+refresh_window_seconds = int(os.environ.get('STS_CREDENTIALS_REFRESH_WINDOW_SECONDS', '900'))
+cache_max_size = int(os.environ.get('STS_CREDENTIALS_CACHE_MAX_SIZE', '1000'))
+role_session_name = "tenant-aware-session"
+
+#(tenant id, user role, service identifier, role arn) -> credentials returned by assume_role,
+#least recently used first
+__credentials = OrderedDict()
+__refreshing = set()
+__lock = threading.Lock()
+
+def get_credentials(sts_client, role_arn, tenant_id, user_role, service_identifier, region, aws_account_id):
+    """ Returns STS credentials scoped by the IAM policy of the user role for the tenant.
+        assume_role is called only when there are no cached credentials with enough lifetime left.
+
+    Args:
+        sts_client: STS client of the authorizer
+        role_arn (string): role to assume
+        tenant_id (string):
+        user_role (string): UserRoles enum
+        service_identifier (string): Service_Identifier enum
+        region (string):
+        aws_account_id (string):
+
+    Returns:
+        dict: Credentials as returned by assume_role
+    """
+    key = (tenant_id, user_role, service_identifier, role_arn)
+    with __lock:
+        credentials = __credentials.get(key)
+        if credentials is not None:
+            __credentials.move_to_end(key)
+
+    remaining_seconds = __get_remaining_seconds(credentials)
+    if (remaining_seconds > min_remaining_seconds):
+        metrics_manager.record_tenant_metric(tenant_id, "STSCredentialsCacheHit", "Count", 1)
+        if (remaining_seconds < refresh_window_seconds):
+            __refresh_in_background(sts_client, key, region, aws_account_id)
+    else:
+        metrics_manager.record_tenant_metric(tenant_id, "STSCredentialsCacheMiss", "Count", 1)
+        credentials = __assume_role(sts_client, key, region, aws_account_id)
+        remaining_seconds = __get_remaining_seconds(credentials)
+
+    metrics_manager.record_tenant_metric(tenant_id, "STSCredentialsRemainingLifetime", "Seconds", remaining_seconds)
+    return credentials
+
+def clear_cache():
+    with __lock:
+        __credentials.clear()
+
+def __assume_role(sts_client, key, region, aws_account_id):
+    tenant_id, user_role, service_identifier, role_arn = key
+    iam_policy = auth_manager.getPolicyForUser(user_role, service_identifier, tenant_id, region, aws_account_id)
+    logger.debug(iam_policy)
+
+    assumed_role = sts_client.assume_role(
+        RoleArn=role_arn,
+        RoleSessionName=role_session_name,
+        Policy=iam_policy,
+    )
+    credentials = assumed_role["Credentials"]
+    with __lock:
+        __credentials[key] = credentials
+        __credentials.move_to_end(key)
+        while len(__credentials) > cache_max_size:
+            __credentials.popitem(last=False)
+    return credentials
+
+def __refresh_in_background(sts_client, key, region, aws_account_id):
+    with __lock:
+        if key in __refreshing:
+            return
+        __refreshing.add(key)
+
+    def refresh():
+        try:
+            __assume_role(sts_client, key, region, aws_account_id)
+        except Exception as e:
+            #cached credentials are still valid, next request past the minimum lifetime retries synchronously
+            logger.error('Error refreshing STS credentials in background: ' + str(e))
+        finally:
+            with __lock:
+                __refreshing.discard(key)
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+
+def __get_remaining_seconds(credentials):
+    if credentials is None:
+        return 0
+    return int(credentials['Expiration'].timestamp() - time.time())
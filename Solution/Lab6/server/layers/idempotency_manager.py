@@ -0,0 +1,25 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+from aws_lambda_powertools.utilities.idempotency import DynamoDBPersistenceLayer, IdempotencyConfig, idempotent
+
+#Requests sent with the same idempotency key get the response of the first request which succeeded,
+#so a caller can retry a request whose response was lost without running it twice.
+#Requests without the header are not deduplicated.
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+idempotency_table_name = os.environ.get('IDEMPOTENCY_TABLE_NAME', 'ServerlessSaaS-Idempotency')
+idempotency_expires_after_seconds = int(os.environ.get('IDEMPOTENCY_EXPIRES_AFTER_SECONDS', str(24 * 60 * 60)))
+
+__persistence_layer = DynamoDBPersistenceLayer(table_name=idempotency_table_name)
+__config = IdempotencyConfig(
+    event_key_jmespath='headers."' + IDEMPOTENCY_KEY_HEADER + '"',
+    expires_after_seconds=idempotency_expires_after_seconds,
+    raise_on_no_idempotency_key=False)
+
+def idempotent_request(handler):
+    """ Decorator for lambda handlers behind API Gateway. Responses are stored by the Idempotency-Key
+        header of the request in ServerlessSaaS-Idempotency. A request whose key is being processed
+        by another invocation fails, failed requests are not stored and can be retried.
+    """
+    return idempotent(persistence_store=__persistence_layer, config=__config)(handler)
@@ -0,0 +1,101 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import time
+import threading
+import urllib.request
+from jose import jwk
+import logger
+
+region = os.environ.get('AWS_REGION')
+
+#Cognito rotates signing keys rarely, so the key set can be kept for a long time.
+#An unknown kid forces a refresh, but not more often than the minimum refresh interval
+#so that tokens with a bogus kid cannot make us hammer the jwks endpoint.
+jwks_ttl_seconds = int(os.environ.get('JWKS_CACHE_TTL_SECONDS', '3600'))
+jwks_min_refresh_seconds = int(os.environ.get('JWKS_MIN_REFRESH_SECONDS', '30'))
+
+jwks_url = 'https://cognito-idp.{}.amazonaws.com/{}/.well-known/jwks.json'
+
+#user pool id -> {'keys': {kid: jwk dict}, 'fetchedAt': epoch}
+__key_sets = {}
+#(user pool id, kid) -> constructed public key
+__public_keys = {}
+__lock = threading.Lock()
+
+__cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'refreshes': 0
+}
+
+def get_public_key(user_pool_id, kid):
+    """ Returns the constructed public key for the given user pool and kid.
+        Keys are served from the module level cache, so they survive across warm invocations.
+        The jwks.json of the user pool is downloaded only on a cold start, after the TTL expires
+        or when the kid is not part of the cached key set.
+
+    Args:
+        user_pool_id (string): Cognito user pool id which issued the token
+        kid (string): key id from the token header
+
+    Returns:
+        public key object or None if the kid is not part of the user pool key set
+    """
+    public_key = __public_keys.get((user_pool_id, kid))
+    if (public_key is not None and not __is_expired(user_pool_id)):
+        __cache_stats['hits'] += 1
+        return public_key
+
+    __cache_stats['misses'] += 1
+    keys = __get_key_set(user_pool_id, kid)
+    if kid not in keys:
+        logger.info('Public key not found in jwks.json')
+        return None
+
+    public_key = jwk.construct(keys[kid])
+    __public_keys[(user_pool_id, kid)] = public_key
+    return public_key
+
+def get_cache_stats():
+    """ Hit/miss counters of the key cache for the current execution environment
+    """
+    return dict(__cache_stats)
+
+def clear_cache():
+    with __lock:
+        __key_sets.clear()
+        __public_keys.clear()
+
+def __get_key_set(user_pool_id, kid):
+    with __lock:
+        key_set = __key_sets.get(user_pool_id)
+        now = time.time()
+        if (key_set is not None):
+            is_stale = now - key_set['fetchedAt'] > jwks_ttl_seconds
+            is_unknown_kid = kid not in key_set['keys']
+            can_refresh = now - key_set['fetchedAt'] > jwks_min_refresh_seconds
+            if (not is_stale and (not is_unknown_kid or not can_refresh)):
+                return key_set['keys']
+
+        keys = __download_key_set(user_pool_id)
+        __key_sets[user_pool_id] = {'keys': keys, 'fetchedAt': now}
+        #drop keys which are no longer published by the user pool
+        for cached_pool_id, cached_kid in list(__public_keys.keys()):
+            if (cached_pool_id == user_pool_id and cached_kid not in keys):
+                del __public_keys[(cached_pool_id, cached_kid)]
+        return keys
+
+def __download_key_set(user_pool_id):
+    __cache_stats['refreshes'] += 1
+    keys_url = jwks_url.format(region, user_pool_id)
+    with urllib.request.urlopen(keys_url) as f:
+        response = f.read()
+    keys = json.loads(response.decode('utf-8'))['keys']
+    return {key['kid']: key for key in keys}
+
+def __is_expired(user_pool_id):
+    key_set = __key_sets.get(user_pool_id)
+    return key_set is None or time.time() - key_set['fetchedAt'] > jwks_ttl_seconds
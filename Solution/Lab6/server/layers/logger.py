@@ -1,23 +1,94 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import os
+import random
+import threading
+import functools
 from aws_lambda_powertools import Logger
+import metrics_manager
 logger = Logger()
 
-"""Log info messages
+#Debug lines like key, shard and response dumps are written only for a sample of the invocations.
+#Their messages are not formatted at all when the invocation is not sampled.
+debug_sample_rate = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '0'))
+
+#State of the current invocation. tenant_id is the tenant bound to the log keys,
+#lines counts the lines written for the log volume metric.
+__context = {
+    'tenant_id': None,
+    'debug': False,
+    'lines': 0
+}
+__lock = threading.Lock()
+
+def tenant_context(handler):
+    """ Decorator for lambda handlers. Binds the tenant id of the authorizer context to the log keys once
+        per invocation, decides whether the debug lines of the invocation are sampled, and records
+        the number of log lines written for the tenant when the handler exits.
+        Handlers of events without a tenant, like the authorizers, get the sampling decision only.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        __context['debug'] = random.random() < debug_sample_rate
+        __context['lines'] = 0
+        authorizer = (event.get('requestContext') or {}).get('authorizer') or {}
+        if 'tenantId' in authorizer:
+            bind_tenant_context(event)
+        elif __context['tenant_id'] is not None:
+            # do not tag the lines with the tenant of a previous invocation
+            logger.remove_keys(['tenant_id'])
+            __context['tenant_id'] = None
+        try:
+            return handler(event, context)
+        finally:
+            if (__context['tenant_id'] is not None and __context['lines'] > 0):
+                metrics_manager.record_tenant_metric(__context['tenant_id'], "LogLines", "Count", __context['lines'])
+    return wrapper
+
+def bind_tenant_context(event):
+    """ Adds the tenant id from the lambda event to the keys of all following log lines
+    """
+    tenant_id = event['requestContext']['authorizer']['tenantId']
+    if (tenant_id != __context['tenant_id']):
+        logger.append_keys(tenant_id=tenant_id)
+        __context['tenant_id'] = tenant_id
+
+"""Log info messages. Arguments are formatted into the message with % only when the line is written
 """
-def info(log_message):
-    #logger.structure_logs(append=True, tenant_id=tenant_id)   
-    logger.info (log_message)
+def info(log_message, *args):
+    __count_line()
+    logger.info(log_message, *args)
 
 """Log error messages
 """
-def error(log_message):
-    #logger.structure_logs(append=True, tenant_id=tenant_id)   
-    logger.error (log_message)
+def error(log_message, *args):
+    __count_line()
+    logger.error(log_message, *args)
+
+"""Log debug messages, written only for sampled invocations
+"""
+def debug(log_message, *args):
+    if not __context['debug']:
+        return
+    __count_line()
+    #written at info level so sampled lines do not depend on the log level of the function
+    logger.info(log_message, *args)
 
 """Log with tenant context. Extracts tenant context from the lambda events
 """
-def log_with_tenant_context(event, log_message):
-    logger.structure_logs(append=True, tenant_id= event['requestContext']['authorizer']['tenantId'])
-    logger.info (log_message)
\ No newline at end of file
+def log_with_tenant_context(event, log_message, *args):
+    bind_tenant_context(event)
+    info(log_message, *args)
+
+"""Log debug messages with tenant context, written only for sampled invocations
+"""
+def debug_with_tenant_context(event, log_message, *args):
+    if not __context['debug']:
+        return
+    bind_tenant_context(event)
+    debug(log_message, *args)
+
+def __count_line():
+    with __lock:
+        __context['lines'] += 1
@@ -2,10 +2,54 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
+import threading
+import functools
 from aws_lambda_powertools import Metrics
 
 metrics = Metrics()
 
+#Metrics recorded while a handler wrapped with buffer_metrics runs, flushed as one EMF document
+#per tenant when the handler exits. Shard queries record from worker threads, so access is locked.
+#(tenant id, metric name) -> {'Unit', 'Sum', 'Count', 'Min', 'Max'}
+__buffer = None
+__lock = threading.Lock()
+
+def buffer_metrics(handler):
+    """ Decorator for lambda handlers. Metrics recorded during the invocation are aggregated by name
+        and written when the handler exits, instead of one EMF document per record_metric call.
+        The metric value is the sum of the recorded values, count, min and max are written as metadata.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global __buffer
+        with __lock:
+            __buffer = {}
+        try:
+            return handler(event, context)
+        finally:
+            flush_metrics()
+    return wrapper
+
+def flush_metrics():
+    """ Writes the buffered metrics and stops buffering
+    """
+    global __buffer
+    with __lock:
+        buffer = __buffer
+        __buffer = None
+    if not buffer:
+        return
+
+    tenant_metrics = {}
+    for (tenant_id, metric_name), aggregate in buffer.items():
+        tenant_metrics.setdefault(tenant_id, []).append((metric_name, aggregate))
+    for tenant_id, metric_list in tenant_metrics.items():
+        metric_set = {}
+        aggregations = {}
+        for metric_name, aggregate in metric_list:
+            metric_set[metric_name] = {'Unit': aggregate['Unit'], 'Value': [aggregate['Sum']]}
+            aggregations[metric_name] = {'Count': aggregate['Count'], 'Min': aggregate['Min'], 'Max': aggregate['Max']}
+        __print_metric_set(tenant_id, metric_set, {'MetricAggregations': aggregations})
 
 def record_metric(event, metric_name, metric_unit, metric_value):
     """ Record the metric in Cloudwatch using EMF format
@@ -16,9 +60,59 @@ def record_metric(event, metric_name, metric_unit, metric_value):
         metric_unit ([type]): [description]
         metric_value ([type]): [description]
     """
-    metrics.add_dimension(name="tenant_id", value=event['requestContext']['authorizer']['tenantId'])
-    metrics.add_metric(name=metric_name, unit=metric_unit, value=metric_value)
-    metrics_object = metrics.serialize_metric_set()
-    metrics.clear_metrics()
-    print(json.dumps(metrics_object))  
+    record_tenant_metric(event['requestContext']['authorizer']['tenantId'], metric_name, metric_unit, metric_value)
+
+def record_tenant_metric(tenant_id, metric_name, metric_unit, metric_value):
+    """ Record the metric for a tenant in Cloudwatch using EMF format,
+        for callers like the authorizers which do not have the tenant context in the event
+
+    Args:
+        tenant_id (string): tenant the metric is recorded for
+        metric_name (string): name of the metric
+        metric_unit (string): unit of the metric
+        metric_value (number): value of the metric
+    """
+    if __add_to_buffer(tenant_id, [(metric_name, metric_unit, metric_value)]):
+        return
+    __print_metric_set(tenant_id, {metric_name: {'Unit': metric_unit, 'Value': [float(metric_value)]}})
+
+def record_metrics(event, metric_list):
+    """ Record multiple metrics for the tenant in Cloudwatch as a single EMF document
+
+    Args:
+        event: lambda event with the authorizer context
+        metric_list (list): tuples of metric name, metric unit and metric value
+    """
+    tenant_id = event['requestContext']['authorizer']['tenantId']
+    if __add_to_buffer(tenant_id, metric_list):
+        return
+    metric_set = {}
+    for metric_name, metric_unit, metric_value in metric_list:
+        metric_set.setdefault(metric_name, {'Unit': metric_unit, 'Value': []})['Value'].append(float(metric_value))
+    __print_metric_set(tenant_id, metric_set)
+
+def __add_to_buffer(tenant_id, metric_list):
+    with __lock:
+        if __buffer is None:
+            return False
+        for metric_name, metric_unit, metric_value in metric_list:
+            value = float(metric_value)
+            aggregate = __buffer.get((tenant_id, metric_name))
+            if aggregate is None:
+                __buffer[(tenant_id, metric_name)] = {'Unit': metric_unit, 'Sum': value, 'Count': 1, 'Min': value, 'Max': value}
+            else:
+                aggregate['Sum'] += value
+                aggregate['Count'] += 1
+                aggregate['Min'] = min(aggregate['Min'], value)
+                aggregate['Max'] = max(aggregate['Max'], value)
+        return True
 
+def __print_metric_set(tenant_id, metric_set, metadata=None):
+    # the metric set is passed explicitly instead of being added to the shared Metrics object,
+    # so concurrent callers can not mix their metrics
+    dimensions = {'tenant_id': tenant_id}
+    if metrics.service:
+        dimensions['service'] = metrics.service
+    with __lock:
+        metrics_object = metrics.serialize_metric_set(metrics=metric_set, dimensions=dimensions, metadata=metadata or {})
+    print(json.dumps(metrics_object))
@@ -0,0 +1,84 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import queue
+import threading
+
+#Segments read in parallel by a scan, every segment is paginated by a worker thread
+scan_total_segments = int(os.environ.get('SCAN_TOTAL_SEGMENTS', '4'))
+#Pages read ahead of the consumer, per segment, before the workers wait
+scan_prefetch_pages = int(os.environ.get('SCAN_PREFETCH_PAGES', '2'))
+
+#Put by a worker after the last page of its segment
+__SEGMENT_DONE = object()
+
+def scan_items(table, total_segments=None, **scan_args):
+    """ Scans a table and yields its items while the remaining pages are still being read.
+        Follows LastEvaluatedKey, so tables larger than one page of 1 MB are read completely.
+        With more than one segment, the segments are scanned in parallel with Segment and TotalSegments,
+        items are yielded in the order the pages arrive. Closing the generator stops the workers.
+
+    Args:
+        table: dynamodb Table resource
+        total_segments (int): number of segments, scan_total_segments when None, 1 for a sequential scan
+        scan_args: further Scan parameters like FilterExpression or ProjectionExpression
+
+    Returns:
+        generator: the items of the table
+    """
+    if total_segments is None:
+        total_segments = scan_total_segments
+    if total_segments <= 1:
+        for page in __scan_pages(table, scan_args):
+            yield from page
+        return
+
+    pages = queue.Queue(maxsize=total_segments * scan_prefetch_pages)
+    stopped = threading.Event()
+
+    def scan_segment(segment):
+        try:
+            for page in __scan_pages(table, dict(scan_args, Segment=segment, TotalSegments=total_segments)):
+                if not __put(pages, page, stopped):
+                    return
+            __put(pages, __SEGMENT_DONE, stopped)
+        except Exception as e:
+            __put(pages, e, stopped)
+
+    workers = [threading.Thread(target=scan_segment, args=(segment,), daemon=True) for segment in range(total_segments)]
+    for worker in workers:
+        worker.start()
+    try:
+        running = total_segments
+        while running > 0:
+            page = pages.get()
+            if page is __SEGMENT_DONE:
+                running -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+    finally:
+        stopped.set()
+        for worker in workers:
+            worker.join()
+
+def __scan_pages(table, scan_args):
+    # the client of the resource is thread safe and returns deserialized items like the Table resource
+    while True:
+        response = table.meta.client.scan(TableName=table.name, **scan_args)
+        yield response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        scan_args = dict(scan_args, ExclusiveStartKey=response['LastEvaluatedKey'])
+
+def __put(pages, page, stopped):
+    # waits for the consumer, unless it stopped reading
+    while not stopped.is_set():
+        try:
+            pages.put(page, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
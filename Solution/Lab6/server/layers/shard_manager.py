@@ -0,0 +1,115 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import hashlib
+import uuid
+
+#Tenants without a shard count in tenant details use the default, which matches the 9 shards
+#items were spread across before shard counts became configurable.
+DEFAULT_SHARD_COUNT = int(os.environ.get('DEFAULT_SHARD_COUNT', '9'))
+MAX_SHARD_COUNT = 100
+
+#Writes are routed over shardCount shards. readShardCount is the number of shards read by list queries,
+#which is larger than shardCount while a tenant is being resharded to fewer shards.
+#previousShardCount is the shard count before the reshard, items which have not been moved yet are read with it.
+def get_shard_count(event):
+    """ Number of shards new items of the tenant are routed to, passed by the authorizer from tenant details
+    """
+    return int(event['requestContext']['authorizer'].get('shardCount', DEFAULT_SHARD_COUNT))
+
+def get_read_shard_count(event):
+    """ Number of shards which can hold items of the tenant, passed by the authorizer from tenant details
+    """
+    authorizer = event['requestContext']['authorizer']
+    return int(authorizer.get('readShardCount', authorizer.get('shardCount', DEFAULT_SHARD_COUNT)))
+
+def get_previous_shard_count(event):
+    """ Shard count of the tenant before the running reshard, the shard count when the tenant is not being resharded
+    """
+    authorizer = event['requestContext']['authorizer']
+    return int(authorizer.get('previousShardCount', get_shard_count(event)))
+
+def get_shard_counts_from_tenant_details(tenant_details):
+    """ Shard counts stored for a tenant in ServerlessSaaS-TenantDetails
+
+    Returns:
+        tuple: shard count, read shard count and previous shard count
+    """
+    shard_count = int(tenant_details.get('shardCount', DEFAULT_SHARD_COUNT))
+    read_shard_count = int(tenant_details.get('readShardCount', shard_count))
+    previous_shard_count = int(tenant_details.get('previousShardCount', shard_count))
+    return shard_count, read_shard_count, previous_shard_count
+
+def get_shard_suffixes(shard_count):
+    return [str(suffix) for suffix in range(1, shard_count + 1)]
+
+def get_shard_id(tenant_id, item_id, shard_count):
+    """ Deterministic shard for an item. Uses jump consistent hashing, so changing the shard count
+        of a tenant from n to m only moves about |n - m| / max(n, m) of the items.
+
+    Args:
+        tenant_id (string): tenant id
+        item_id (string): product or order id
+        shard_count (int): number of shards of the tenant
+
+    Returns:
+        string: shard id in the <tenantId>-<suffix> format
+    """
+    return tenant_id + '-' + str(get_shard_suffix(item_id, shard_count))
+
+def get_item_shard_ids(event, item_id, key_shard_id):
+    """ Shards which can hold an item, in the order they are read. The shard of the key comes first, it holds the item
+        unless a reshard moved it. Moved items are in the shard of the current shard count, or in the shard of 
+        the previous shard count while the tenant is being resharded. Items created before shards were derived 
+        from the id are found in the shard of their key until they are written.
+
+    Args:
+        event: lambda event
+        item_id (string): product or order id
+        key_shard_id (string): shard id of the key the item was requested with
+
+    Returns:
+        list: shard ids
+    """
+    tenant_id = event['requestContext']['authorizer']['tenantId']
+    shard_ids = []
+    if (key_shard_id.startswith(tenant_id + '-')):
+        shard_ids.append(key_shard_id)
+    shard_ids.append(get_shard_id(tenant_id, item_id, get_shard_count(event)))
+    shard_ids.append(get_shard_id(tenant_id, item_id, get_previous_shard_count(event)))
+    return list(dict.fromkeys(shard_ids))
+
+def get_item_write_shard_ids(event, item_id, key_shard_id):
+    """ Shard an item is written to, which is the shard of the current shard count, and the other shards
+        which can hold the item. A write moves the item out of the other shards.
+
+    Args:
+        event: lambda event
+        item_id (string): product or order id
+        key_shard_id (string): shard id of the key the item was requested with
+
+    Returns:
+        tuple: shard id the item is written to and list of the other shard ids
+    """
+    tenant_id = event['requestContext']['authorizer']['tenantId']
+    shard_id = get_shard_id(tenant_id, item_id, get_shard_count(event))
+    return shard_id, [other_shard_id for other_shard_id in get_item_shard_ids(event, item_id, key_shard_id) if other_shard_id != shard_id]
+
+def new_item_version():
+    """ Version stored with every write of an item, so that moving an item can detect writes made after it was copied
+    """
+    return uuid.uuid4().hex
+
+def get_shard_suffix(item_id, shard_count):
+    key = int.from_bytes(hashlib.md5(item_id.encode('utf-8')).digest()[:8], 'big')
+    return __jump_consistent_hash(key, shard_count) + 1
+
+def __jump_consistent_hash(key, num_buckets):
+    bucket = -1
+    next_bucket = 0
+    while next_bucket < num_buckets:
+        bucket = next_bucket
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        next_bucket = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
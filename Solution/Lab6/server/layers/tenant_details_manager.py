@@ -0,0 +1,61 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import time
+import threading
+from collections import OrderedDict
+import logger
+
+#Entries are kept per execution environment of the authorizers, which no other function can reach.
+#Changes made by tenant management, like a deactivated tenant or a new shard count, take effect
+#only after the TTL, which is in the same range as the authorizer result TTL of API Gateway.
+cache_max_size = int(os.environ.get('TENANT_DETAILS_CACHE_MAX_SIZE', '1000'))
+cache_ttl_seconds = int(os.environ.get('TENANT_DETAILS_CACHE_TTL_SECONDS', '60'))
+negative_cache_ttl_seconds = int(os.environ.get('TENANT_DETAILS_NEGATIVE_CACHE_TTL_SECONDS', '10'))
+
+#tenant id -> (expires at, item or None for unknown tenants)
+__tenant_details = OrderedDict()
+__lock = threading.Lock()
+
+def get_tenant_details(table_tenant_details, tenant_id):
+    """ Returns the tenant details item for a tenant, reading ServerlessSaaS-TenantDetails only on a cache miss.
+        Unknown tenants are cached as well (for a shorter time) so that invalid tokens do not cost a read each.
+
+    Args:
+        table_tenant_details: ServerlessSaaS-TenantDetails table resource
+        tenant_id (string): tenant to look up
+
+    Returns:
+        dict: tenant details item or None if the tenant does not exist
+    """
+    now = time.time()
+    with __lock:
+        cached = __tenant_details.get(tenant_id)
+        if (cached is not None and cached[0] > now):
+            __tenant_details.move_to_end(tenant_id)
+            return cached[1]
+
+    response = table_tenant_details.get_item(
+        Key ={
+            'tenantId': tenant_id
+        }
+    )
+    item = response.get('Item')
+    if (item is None):
+        logger.info('Tenant details not found for tenant ' + tenant_id)
+        expires_at = now + negative_cache_ttl_seconds
+    else:
+        expires_at = now + cache_ttl_seconds
+
+    with __lock:
+        __tenant_details[tenant_id] = (expires_at, item)
+        __tenant_details.move_to_end(tenant_id)
+        while len(__tenant_details) > cache_max_size:
+            __tenant_details.popitem(last=False)
+
+    return item
+
+def clear_cache():
+    with __lock:
+        __tenant_details.clear()
@@ -2,7 +2,8 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
-import jsonpickle
+import base64
+import datetime
 import simplejson
 
 import boto3
@@ -18,9 +19,13 @@ class TenantTier(Enum):
 
 class StatusCodes(Enum):
     SUCCESS    = 200
+    BAD_REQUEST = 400
     UN_AUTHORIZED  = 401
     NOT_FOUND = 404
     
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
 class Service_Identifier(Enum):
     SHARED_SERVICES     = "SharedServices"
     BUSINESS_SERVICES    = "BusinessServices"
@@ -64,6 +69,70 @@ def create_notfound_response(message):
         }),
     }
 
+def create_badrequest_response(message):
+    return {
+        "statusCode": StatusCodes.BAD_REQUEST.value,
+        "headers": {
+            "Access-Control-Allow-Headers" : "Content-Type",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "OPTIONS,POST,GET,PUT"
+        },
+        "body": json.dumps({
+            "message": message
+        }),
+    }
+
+def get_query_string_parameter(event, name):
+    params = event.get('queryStringParameters')
+    if not params:
+        return None
+    return params.get(name)
+
+def get_page_limit(limit):
+    """ Parses the page size requested with the limit query string parameter
+
+    Raises:
+        ValueError: if the limit is not a number between 1 and MAX_PAGE_LIMIT
+    """
+    if limit is None:
+        return DEFAULT_PAGE_LIMIT
+    try:
+        page_limit = int(limit)
+    except ValueError:
+        raise ValueError('Invalid limit')
+    if page_limit < 1 or page_limit > MAX_PAGE_LIMIT:
+        raise ValueError('limit should be between 1 and {0}'.format(MAX_PAGE_LIMIT))
+    return page_limit
+
+def encode_cursor(cursor_state):
+    """ Encodes the pagination state into an opaque, url safe continuation token
+
+    Args:
+        cursor_state (dict): pagination state, None when there are no more pages
+
+    Returns:
+        string: continuation token or None
+    """
+    if cursor_state is None:
+        return None
+    cursor_json = json.dumps(cursor_state, separators=(',', ':'), sort_keys=True)
+    return base64.urlsafe_b64encode(cursor_json.encode('utf-8')).decode('utf-8').rstrip('=')
+
+def decode_cursor(cursor):
+    """ Decodes a continuation token created by encode_cursor
+
+    Raises:
+        ValueError: if the token is not valid
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        cursor_state = json.loads(base64.urlsafe_b64decode(cursor + padding).decode('utf-8'))
+    except Exception as e:
+        raise ValueError('Invalid cursor', e)
+    if not isinstance(cursor_state, dict):
+        raise ValueError('Invalid cursor')
+    return cursor_state
+
 def get_auth(host, region):
     session = boto3.Session()
     credentials = session.get_credentials()
@@ -90,12 +159,38 @@ def generate_response(inputObject):
         "body": encode_to_json_object(inputObject),
     }
 
-def  encode_to_json_object(inputObject):
-    jsonpickle.set_encoder_options('simplejson', use_decimal=True, sort_keys=True)
-    jsonpickle.set_preferred_backend('simplejson')
-    return jsonpickle.encode(inputObject, unpicklable=False, use_decimal=True)
-
-
-
-
+#type -> function returning a json compatible value for the object
+__object_encoders = {}
 
+def  encode_to_json_object(inputObject):
+    """ Encodes the response body. Dicts, lists and Decimals are written by the simplejson C encoder,
+        models with a for_json method like Product and Order are written from its result,
+        other objects like TenantInfo and UserInfo are written as their attributes.
+        The output is the same as the previous jsonpickle encoding (unpicklable=False, simplejson backend),
+        except for dict keys which are not strings, numbers or None: jsonpickle wrote their repr,
+        they are now written as json, like true for True. Items and responses only have string keys.
+    """
+    return __json_encoder.encode(inputObject)
+
+def __encode_object(obj):
+    # called by the encoder only for values that are not json types
+    encoder = __object_encoders.get(type(obj))
+    if encoder is None:
+        encoder = __get_object_encoder(obj)
+        __object_encoders[type(obj)] = encoder
+    return encoder(obj)
+
+def __get_object_encoder(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return __encode_isoformat
+    if isinstance(obj, (set, frozenset)):
+        return list
+    if hasattr(obj, '__dict__'):
+        return vars
+    raise TypeError('Object of type ' + type(obj).__name__ + ' is not JSON serializable')
+
+def __encode_isoformat(obj):
+    return obj.isoformat()
+
+#created once, simplejson.dumps with options creates a new encoder on every call
+__json_encoder = simplejson.JSONEncoder(use_decimal=True, sort_keys=True, for_json=True, default=__encode_object)
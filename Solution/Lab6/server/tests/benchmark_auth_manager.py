@@ -0,0 +1,48 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Compares the time per getPolicyForUser call for 10k distinct tenants, with the policy built
+# on every call as before, rendered from the compiled template and rendered from the memo.
+# Run from this folder with
+#   pip install -r requirements.txt && python benchmark_auth_manager.py
+
+import os
+import sys
+import time
+
+server_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[:0] = [os.path.join(server_path, 'layers')]
+
+import auth_manager
+import utils
+
+TENANT_COUNT = 10000
+ROLES = [(auth_manager.UserRoles.TENANT_ADMIN, utils.Service_Identifier.BUSINESS_SERVICES.value),
+    (auth_manager.UserRoles.TENANT_ADMIN, utils.Service_Identifier.SHARED_SERVICES.value),
+    (auth_manager.UserRoles.TENANT_USER, utils.Service_Identifier.BUSINESS_SERVICES.value)]
+
+build_policy = getattr(auth_manager, '__buildPolicy')
+render_policy = getattr(auth_manager, '__renderPolicy')
+
+
+def micros_per_call(get_policy, calls):
+    start = time.perf_counter()
+    for user_role, service_identifier, tenant_id in calls:
+        get_policy(user_role, service_identifier, tenant_id, 'us-east-1', '123456789012')
+    return (time.perf_counter() - start) * 1000000 / len(calls)
+
+def main():
+    # one role per tenant, so the memo holds every rendered policy with the default POLICY_CACHE_SIZE
+    calls = [ROLES[index % len(ROLES)] + ('tenant' + str(index),) for index in range(TENANT_COUNT)]
+    render_policy.cache_clear()
+    built = micros_per_call(build_policy, calls)
+    render_policy.cache_clear()
+    rendered = micros_per_call(auth_manager.getPolicyForUser, calls)
+    memoized = micros_per_call(auth_manager.getPolicyForUser, calls)
+    print('%d tenants' % TENANT_COUNT)
+    print('built per call   %6.2f us' % built)
+    print('first render     %6.2f us' % rendered)
+    print('memoized render  %6.2f us' % memoized)
+
+if __name__ == '__main__':
+    main()
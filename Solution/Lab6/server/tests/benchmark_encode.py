@@ -0,0 +1,39 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Compares the time to encode product lists with utils.encode_to_json_object and with the
+# jsonpickle encoding it replaced. Run from this folder with
+#   pip install -r requirements.txt && python benchmark_encode.py
+
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+server_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[:0] = [os.path.join(server_path, 'layers'), os.path.join(server_path, 'ProductService')]
+
+import utils
+from product_models import Product
+from legacy import LegacyProduct, jsonpickle_encode
+
+SIZES = [1000, 10000]
+REPEAT = 5
+
+
+def product_args(index):
+    return ('tenant1-' + str(index % 9 + 1), 'product' + str(index), 'sku' + str(index), 'Product ' + str(index), Decimal(str(index) + '.99'), 'category' + str(index % 3))
+
+def best_millis(function):
+    return min(timeit.repeat(function, number=1, repeat=REPEAT)) * 1000
+
+def main():
+    print('items   jsonpickle   encode_to_json_object')
+    for size in SIZES:
+        legacy = [LegacyProduct(*product_args(i)) for i in range(size)]
+        current = [Product(*product_args(i)) for i in range(size)]
+        assert utils.encode_to_json_object(current) == jsonpickle_encode(legacy)
+        print('%-7d %8.1f ms  %8.1f ms' % (size, best_millis(lambda: jsonpickle_encode(legacy)), best_millis(lambda: utils.encode_to_json_object(current))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Measures the memory the list endpoints hold per item for 100k products and orders, with the
+# slotted models built by from_item and with the models they replaced. The attribute values are
+# shared with the dynamodb items, so only the models and the list holding them are counted. Run from this folder with
+#   pip install -r requirements.txt && python benchmark_models.py
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+server_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[:0] = [os.path.join(server_path, 'ProductService'), os.path.join(server_path, 'OrderService')]
+
+from product_models import Product
+from order_models import Order
+from legacy import LegacyProduct, LegacyOrder
+
+ITEM_COUNT = 100000
+
+
+def product_items():
+    return [{'shardId': 'tenant1-' + str(index % 9 + 1), 'productId': '%032x' % index, 'sku': 'sku' + str(index),
+        'name': 'Product ' + str(index), 'price': Decimal(str(index) + '.99'), 'category': 'category' + str(index % 3)}
+        for index in range(ITEM_COUNT)]
+
+def order_items():
+    order_products = [{'productId': 'product1', 'price': Decimal('10.5'), 'quantity': Decimal('2')}]
+    return [{'shardId': 'tenant1-' + str(index % 9 + 1), 'orderId': '%032x' % index, 'orderName': 'Order ' + str(index),
+        'orderProducts': order_products} for index in range(ITEM_COUNT)]
+
+def legacy_product(item):
+    # the dals copied the items field by field
+    return LegacyProduct(item['shardId'], item['productId'], item['sku'], item['name'], item['price'], item['category'])
+
+def legacy_order(item):
+    return LegacyOrder(item['shardId'], item['orderId'], item['orderName'], item['orderProducts'])
+
+def measure(items, create):
+    """ Returns the bytes per item held by the models created from the items and the time to create them
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    models = [create(item) for item in items]
+    millis = (time.perf_counter() - start) * 1000
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del models
+    return size / len(items), millis
+
+def main():
+    print('%d items      bytes per item   build time (traced)' % ITEM_COUNT)
+    for name, items, legacy_create, create in [('Product', product_items(), legacy_product, Product.from_item),
+            ('Order', order_items(), legacy_order, Order.from_item)]:
+        for label, function in [('before', legacy_create), ('from_item', create)]:
+            bytes_per_item, millis = measure(items, function)
+            print('%-8s %-9s %8.0f B      %8.1f ms' % (name, label, bytes_per_item, millis))
+
+if __name__ == '__main__':
+    main()
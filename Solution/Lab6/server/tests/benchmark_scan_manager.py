@@ -0,0 +1,77 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Compares a single scan() with scan_manager.scan_items over 1, 4 and 8 segments on tables of
+# 10k and 100k tenant stack mappings. The table is a local stand-in which pages like DynamoDB,
+# 1 MB per page, and takes PAGE_MILLIS to return a full page. Run from this folder with
+#   pip install -r requirements.txt && python benchmark_scan_manager.py
+
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+server_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[:0] = [os.path.join(server_path, 'layers')]
+
+import scan_manager
+
+ROW_COUNTS = [10000, 100000]
+SEGMENTS = [1, 4, 8]
+ITEM_BYTES = 400
+PAGE_BYTES = 1024 * 1024
+PAGE_MILLIS = 80
+REQUEST_MILLIS = 10
+
+
+class LocalTable:
+    """ Stand-in for a dynamodb table, the items of a segment are a contiguous range of the rows
+    """
+    name = 'ServerlessSaaS-TenantStackMapping'
+
+    def __init__(self, row_count):
+        self.rows = [{'tenantId': 'tenant%06d' % index, 'stackName': 'stack-tenant%06d' % index, 'applyLatestRelease': True}
+            for index in range(row_count)]
+        self.meta = SimpleNamespace(client=self)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def scan(self, TableName=None, Segment=0, TotalSegments=1, ExclusiveStartKey=None, **kwargs):
+        with self.lock:
+            self.requests += 1
+        row_count = len(self.rows)
+        end = row_count * (Segment + 1) // TotalSegments
+        start = ExclusiveStartKey['index'] if ExclusiveStartKey else row_count * Segment // TotalSegments
+        page_end = min(end, start + PAGE_BYTES // ITEM_BYTES)
+        time.sleep((REQUEST_MILLIS + PAGE_MILLIS * (page_end - start) * ITEM_BYTES / PAGE_BYTES) / 1000)
+        response = {'Items': self.rows[start:page_end]}
+        if page_end < end:
+            response['LastEvaluatedKey'] = {'index': page_end}
+        return response
+
+
+def main():
+    print('rows     reader        items    time     first item  requests')
+    for row_count in ROW_COUNTS:
+        table = LocalTable(row_count)
+        start = time.perf_counter()
+        items = table.scan()['Items']
+        elapsed = time.perf_counter() - start
+        # one page only, the rows past it were skipped
+        print('%-8d scan()     %8d %7.2f s %9.2f s %9d' % (row_count, len(items), elapsed, elapsed, 1))
+        for total_segments in SEGMENTS:
+            table.requests = 0
+            start = time.perf_counter()
+            first_item = None
+            tenant_ids = set()
+            for item in scan_manager.scan_items(table, total_segments=total_segments):
+                if first_item is None:
+                    first_item = time.perf_counter() - start
+                tenant_ids.add(item['tenantId'])
+            elapsed = time.perf_counter() - start
+            assert len(tenant_ids) == row_count
+            print('%-8d %d segments %8d %7.2f s %9.2f s %9d' % (row_count, total_segments, len(tenant_ids), elapsed, first_item, table.requests))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# The models and the encoding the response bodies were written with before encode_to_json_object
+# replaced jsonpickle, the tests and benchmarks compare the current code against them.
+
+import jsonpickle
+
+
+class LegacyProduct:
+    # the Product model the jsonpickle bodies were written from
+    key =''
+    def __init__(self, shardId, productId, sku, name, price, category):
+        self.shardId = shardId
+        self.productId = productId
+        self.key = shardId + ':' +  productId
+        self.sku = sku
+        self.name = name
+        self.price = price
+        self.category = category
+
+class LegacyOrder:
+    # the Order model the jsonpickle bodies were written from
+    key=''
+    def __init__(self, shardId, orderId, orderName, orderProducts):
+        self.shardId = shardId
+        self.orderId = orderId
+        self.key = shardId + ':' +  orderId
+        self.orderName = orderName
+        self.orderProducts = orderProducts
+
+
+def jsonpickle_encode(inputObject):
+    # encode_to_json_object before it was replaced
+    jsonpickle.set_encoder_options('simplejson', use_decimal=True, sort_keys=True)
+    jsonpickle.set_preferred_backend('simplejson')
+    return jsonpickle.encode(inputObject, unpicklable=False, use_decimal=True)
@@ -0,0 +1,39 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Checks that the policies rendered from the compiled templates of auth_manager are the same,
+# byte for byte, as the policies built for every call before. Run from this folder with
+#   pip install -r requirements.txt && python -m pytest
+
+import itertools
+import json
+import os
+import sys
+
+import pytest
+
+server_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[:0] = [os.path.join(server_path, 'layers')]
+
+import auth_manager
+import utils
+
+# getPolicyForUser built the policy with these functions on every call, the templates are built by them too
+build_policy = getattr(auth_manager, '__buildPolicy')
+
+USER_ROLES = [auth_manager.UserRoles.SYSTEM_ADMIN, auth_manager.UserRoles.CUSTOMER_SUPPORT,
+    auth_manager.UserRoles.TENANT_ADMIN, auth_manager.UserRoles.TENANT_USER, 'UnknownRole']
+SERVICE_IDENTIFIERS = [service.value for service in utils.Service_Identifier]
+TENANT_IDS = ['tenant1', '8a9c0f2e4b6d4e1f9a7b3c5d2e8f0a1b', 'quote"tenant', 'back\\slash', '${tenant_id}', '{0}', 'tenänt']
+
+@pytest.mark.parametrize('user_role, service_identifier', list(itertools.product(USER_ROLES, SERVICE_IDENTIFIERS)))
+def test_rendered_policy_matches_built_policy(user_role, service_identifier):
+    for tenant_id in TENANT_IDS:
+        assert auth_manager.getPolicyForUser(user_role, service_identifier, tenant_id, 'us-east-1', '123456789012') == \
+            build_policy(user_role, service_identifier, tenant_id, 'us-east-1', '123456789012')
+
+def test_rendered_policy_is_json_with_the_tenant_id():
+    policy = json.loads(auth_manager.getPolicyForUser(auth_manager.UserRoles.TENANT_USER, utils.Service_Identifier.BUSINESS_SERVICES.value,
+        'quote"tenant', 'us-west-2', '123456789012'))
+    assert policy['Statement'][0]['Condition']['ForAllValues:StringLike']['dynamodb:LeadingKeys'] == ['quote"tenant-*']
+    assert policy['Statement'][0]['Resource'] == ['arn:aws:dynamodb:us-west-2:123456789012:table/Product-*']
@@ -0,0 +1,94 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Checks that utils.encode_to_json_object writes the same response bodies, byte for byte,
+# as the jsonpickle encoding it replaced. Run from this folder with
+#   pip install -r requirements.txt && python -m pytest
+
+import datetime
+import os
+import sys
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+server_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[:0] = [os.path.join(server_path, 'layers'), os.path.join(server_path, 'ProductService'), os.path.join(server_path, 'OrderService')]
+
+import utils
+from product_models import Product
+from order_models import Order
+from legacy import LegacyProduct, LegacyOrder, jsonpickle_encode
+
+
+class TenantInfo:
+    def __init__(self, tenant_name, tenant_address, tenant_email, tenant_phone):
+        self.tenant_name = tenant_name
+        self.tenant_address = tenant_address
+        self.tenant_email = tenant_email
+        self.tenant_phone = tenant_phone
+
+
+def product_args(index, price=Decimal('10.5')):
+    return ('tenant1-' + str(index % 10), 'product' + str(index), 'sku' + str(index), 'Product ' + str(index), price, 'category' + str(index % 3))
+
+def order_args(index, order_products):
+    return ('tenant1-' + str(index % 10), 'order' + str(index), 'Order ' + str(index), order_products)
+
+def namespace_order_products():
+    return [SimpleNamespace(productId='product1', price=Decimal('10.5'), quantity=Decimal('2')),
+            SimpleNamespace(productId='product2', price=Decimal('0.99'), quantity=Decimal('1'))]
+
+def dict_order_products():
+    return [{'productId': 'product1', 'price': Decimal('10.5'), 'quantity': Decimal('2')},
+            {'productId': 'product2', 'price': Decimal('0.99'), 'quantity': Decimal('1')}]
+
+DECIMALS = [Decimal('0'), Decimal('-0'), Decimal('10.50'), Decimal('1E+2'), Decimal('1.0E-7'),
+    Decimal('123456789012345678901234567890.123456789'), Decimal('-42')]
+
+# name, value encoded by jsonpickle, value encoded by encode_to_json_object
+CASES = [
+    ('product', LegacyProduct(*product_args(1)), Product(*product_args(1))),
+    ('products', [LegacyProduct(*product_args(i)) for i in range(100)], [Product(*product_args(i)) for i in range(100)]),
+    ('product from item', LegacyProduct(*product_args(1)), Product.from_item(dict(zip(Product.__slots__, product_args(1))))),
+    ('products page', {'items': [LegacyProduct(*product_args(i)) for i in range(3)], 'nextToken': 'abc'},
+        {'items': [Product(*product_args(i)) for i in range(3)], 'nextToken': 'abc'}),
+    ('order with namespace products', LegacyOrder(*order_args(1, namespace_order_products())), Order(*order_args(1, namespace_order_products()))),
+    ('order with dict products', LegacyOrder(*order_args(1, dict_order_products())), Order(*order_args(1, dict_order_products()))),
+    ('orders', [LegacyOrder(*order_args(i, dict_order_products())) for i in range(20)], [Order(*order_args(i, dict_order_products())) for i in range(20)]),
+    ('nested namespace and dict',
+        SimpleNamespace(b={'z': SimpleNamespace(y=[1, {'x': Decimal('1.10')}], a=None)}, a=[True, False, 'text']),
+        SimpleNamespace(b={'z': SimpleNamespace(y=[1, {'x': Decimal('1.10')}], a=None)}, a=[True, False, 'text'])),
+    ('tenant info', TenantInfo('tenant', 'address', 'email', 'phone'), TenantInfo('tenant', 'address', 'email', 'phone')),
+    ('unicode', {'name': 'Café ☃ "quoted" \\ \n'}, {'name': 'Café ☃ "quoted" \\ \n'}),
+    ('datetime', {'date': datetime.datetime(2024, 1, 2, 3, 4, 5, 6)}, {'date': datetime.datetime(2024, 1, 2, 3, 4, 5, 6)}),
+    ('set', {'values': {'a'}}, {'values': {'a'}}),
+    ('number and null keys', {1: 'one', 2.5: 'two', None: 'three'}, {1: 'one', 2.5: 'two', None: 'three'}),
+    ('empty', [], []),
+    ('message', {'message': 'Product deleted'}, {'message': 'Product deleted'}),
+] + [
+    ('decimal ' + str(value), LegacyProduct(*product_args(1, value)), Product(*product_args(1, value))) for value in DECIMALS
+]
+
+@pytest.mark.parametrize('legacy, current', [case[1:] for case in CASES], ids=[case[0] for case in CASES])
+def test_encode_to_json_object_matches_jsonpickle(legacy, current):
+    assert utils.encode_to_json_object(current) == jsonpickle_encode(legacy)
+
+def test_encode_to_json_object_matches_jsonpickle_for_shared_references():
+    order_products = dict_order_products()
+    legacy = [LegacyOrder(*order_args(i, order_products)) for i in range(2)]
+    current = [Order(*order_args(i, order_products)) for i in range(2)]
+    assert utils.encode_to_json_object(current) == jsonpickle_encode(legacy)
+
+def test_generate_response_body():
+    products = [Product(*product_args(i)) for i in range(3)]
+    assert utils.generate_response(products)['body'] == jsonpickle_encode([LegacyProduct(*product_args(i)) for i in range(3)])
+
+def test_encode_to_json_object_writes_other_keys_as_json():
+    # jsonpickle wrote the repr of these keys, dynamodb items and the responses only have string keys
+    assert utils.encode_to_json_object({True: 'yes', Decimal('2.5'): 'two'}) == '{"2.5": "two", "true": "yes"}'
+
+def test_encode_to_json_object_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        utils.encode_to_json_object({'value': object()})
@@ -4,20 +4,109 @@
 import boto3
 import time
 import os
+import json
+import gzip
+import base64
+import io
+import csv
+import random
+import hashlib
+import threading
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
 from decimal import *
 
 cloudformation = boto3.client('cloudformation')
 logs = boto3.client('logs')
 athena = boto3.client('athena')
+s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
 attribution_table = dynamodb.Table("TenantCostAndUsageAttribution")
 
 ATHENA_S3_OUTPUT = os.getenv("ATHENA_S3_OUTPUT")
-RETRY_COUNT = 100
+#Backfill checkpoints and cached CUR costs are kept in the attribution table under this date, which is never attributed
+STATE_ITEMS_DATE = 0
+
+ATHENA_MIN_POLL_SECONDS = 0.5
+ATHENA_MAX_POLL_SECONDS = 8
+ATHENA_QUERY_TIMEOUT_SECONDS = 240
+
+#Billing period of the CUR to attribute, like 2022-10. Set for the sample CUR file, which covers a single
+#period. When empty, each day is attributed the cost of that day in its own billing period.
+CUR_BILLING_PERIOD = os.getenv("CUR_BILLING_PERIOD", "")
+#Cost by product code of the current billing period is queried again after this time
+CUR_CACHE_SECONDS = int(os.getenv("CUR_CACHE_SECONDS", "21600"))
+#billing period -> cached costs, kept across the calls of an invocation and warm invocations
+__service_costs_by_period = {}
+__service_costs_lock = threading.Lock()
+
+LOGS_MAX_CONCURRENT_QUERIES = int(os.getenv("LOGS_MAX_CONCURRENT_QUERIES", "10"))
+LOGS_MIN_POLL_SECONDS = 1
+LOGS_MAX_POLL_SECONDS = 10
+
+#Days a backfill attributes at the same time, which bounds its concurrent Logs Insights and Athena queries
+BACKFILL_MAX_CONCURRENT_DAYS = int(os.getenv("BACKFILL_MAX_CONCURRENT_DAYS", "5"))
+#A backfill stops when less time is left, so it can write its checkpoint before the function times out
+BACKFILL_MIN_REMAINING_MILLIS = 180000
+
+#BatchWriteItem accepts at most 25 requests per call
+BATCH_WRITE_MAX_SIZE = 25
+BATCH_WRITE_MAX_RETRIES = 8
+BATCH_WRITE_BASE_BACKOFF_SECONDS = 0.05
+BATCH_WRITE_MAX_BACKOFF_SECONDS = 2
+
+#Columns of the attribution table written by dry runs
+attribution_csv_columns = ["Date", "TenantId#ServiceName", "TenantId", "TenantServiceCost", "TotalServiceCost",
+    "TenantAttributionPercentage", "TenantTotalRCU", "TotalRCU", "TenantTotalWCU", "TotalWCU",
+    "TenantTotalInvocations", "TotalInvocations"]
+
+#Usage of every tenant in one pass over the logs: the first value of the capacity unit metrics
+#of EMF lines, and the number of "Request completed" lines as invocations. Totals are the sums
+#of the tenant rows. Logs Insights returns 1000 rows unless a higher limit is set.
+usage_by_tenant_query = 'filter @message like /ReadCapacityUnits|WriteCapacityUnits|Request completed/ \
+    | fields tenant_id as TenantId, ReadCapacityUnits.0 as RCapacityUnits, WriteCapacityUnits.0 as WCapacityUnits, \
+    strcontains(@message, "Request completed") as RequestCompleted \
+    | stats sum(RCapacityUnits) as ReadCapacityUnits, sum(WCapacityUnits) as WriteCapacityUnits, \
+    sum(RequestCompleted) as LambdaInvocations by TenantId \
+    | limit 10000'
+
+#Usage counters are maintained per tenant per day by aggregate_tenant_usage_from_logs, from the log lines
+#the pooled functions send through a subscription filter. They are stored next to the attribution
+#results, with "Usage" as service name.
+USAGE_SERVICE_NAME = "Usage"
+USAGE_SUBSCRIPTION_FILTER_NAME = "TenantUsageCounters"
+USAGE_SUBSCRIPTION_FILTER_PATTERN = '?ReadCapacityUnits ?WriteCapacityUnits ?"Request completed"'
+USAGE_AGGREGATOR_FUNCTION_ARN = os.getenv("USAGE_AGGREGATOR_FUNCTION_ARN")
+SECONDS_PER_DAY = 86400
+#TransactWriteItems accepts at most 100 actions, one of them records the delivery
+USAGE_TRANSACTION_MAX_SIZE = 99
+#Deliveries are retried for up to 6 hours, their records are deleted by the table TTL after that
+DELIVERY_RECORD_SECONDS = 2 * SECONDS_PER_DAY
+
+#Functions of the pooled stack whose usage is attributed to tenants
+usage_function_logical_ids = [
+    "CreateProductFunction", "UpdateProductFunction", "GetProductsFunction", "DeleteProductFunction",
+    "BatchWriteProductsFunction",
+    "CreateOrderFunction", "UpdateOrderFunction", "GetOrdersFunction", "DeleteOrderFunction",
+    "BatchWriteOrdersFunction"
+]
 
 #This function needs to be scheduled on daily basis
+#Attributes the DynamoDB and Lambda cost of the day, from one lookup of the usage of the day.
+#Invoked with {"dryRun": true}, the attribution is written as CSV to S3 instead of the table, for reconciliation.
+def calculate_daily_attribution_by_tenant(event, context):
+    start_date_time = __get_start_date_time() #current day epoch
+    end_date_time =  __get_end_date_time() #next day epoch
+
+    total_dynamodb_cost = __get_total_service_cost('AmazonDynamoDB', start_date_time, end_date_time)
+    total_lambda_cost = __get_total_service_cost('AWSLambda', start_date_time, end_date_time)
+
+    usage_by_tenant = __get_usage_by_tenant_by_day([(start_date_time, end_date_time)])[start_date_time]
+    return __write_attribution_items(event, __get_dynamodb_attribution_items(start_date_time, usage_by_tenant, total_dynamodb_cost)
+        + __get_lambda_attribution_items(start_date_time, usage_by_tenant, total_lambda_cost))
+
 def calculate_daily_dynamodb_attribution_by_tenant(event, context):
     start_date_time = __get_start_date_time() #current day epoch
     end_date_time =  __get_end_date_time() #next day epoch
@@ -25,171 +114,559 @@ def calculate_daily_dynamodb_attribution_by_tenant(event, context):
     #Get total dynamodb cost for the given duration
     total_dynamodb_cost = __get_total_service_cost('AmazonDynamoDB', start_date_time, end_date_time)
 
-    log_group_names = __get_list_of_log_group_names()
-    print( log_group_names)
-
-    usage_by_tenant_by_day_query = 'filter @message like /ReadCapacityUnits|WriteCapacityUnits/ \
-    | fields tenant_id as TenantId, ReadCapacityUnits.0 as RCapacityUnits, WriteCapacityUnits.0 as WCapacityUnits \
-    | stats sum(RCapacityUnits) as ReadCapacityUnits, sum(WCapacityUnits) as WriteCapacityUnits by TenantId, dateceil(@timestamp, 1d) as timestamp'
-
-    usage_by_tenant_by_day = __query_cloudwatch_logs(logs,  log_group_names, 
-    usage_by_tenant_by_day_query, start_date_time, end_date_time)
-
-    print(usage_by_tenant_by_day)    
-    
-    total_usage_by_day_query = 'filter @message like /ReadCapacityUnits|WriteCapacityUnits/ \
-    | fields ReadCapacityUnits.0 as RCapacityUnits, WriteCapacityUnits.0 as WCapacityUnits \
-    | stats sum(RCapacityUnits) as ReadCapacityUnits, sum(WCapacityUnits) as WriteCapacityUnits by dateceil(@timestamp, 1d) as timestamp'
-    
-    total_usage_by_day = __query_cloudwatch_logs(logs,  log_group_names, 
-    total_usage_by_day_query, start_date_time, end_date_time)
+    usage_by_tenant = __get_usage_by_tenant_by_day([(start_date_time, end_date_time)])[start_date_time]
+    return __write_attribution_items(event, __get_dynamodb_attribution_items(start_date_time, usage_by_tenant, total_dynamodb_cost))
 
-    print(total_usage_by_day)  
-    
-    total_RCU = 0 
-    total_WCU = 0 
-    for result in total_usage_by_day['results'][0]:
-        if 'ReadCapacityUnits' in result['field']:
-            total_RCU = Decimal(result['value'])
-        if 'WriteCapacityUnits' in result['field']:
-            total_WCU = Decimal(result['value'])
-    
-    print (total_RCU)
-    print (total_WCU)
-    
-    if (total_RCU + total_WCU > 0):
-        total_RCU_By_Tenant = 0
-        total_WCU_By_Tenant = 0
-        
-        for result in usage_by_tenant_by_day['results']:
-            for field in result:
-                if 'TenantId' in field['field']:
-                    tenant_id = field['value']
-                if 'ReadCapacityUnits' in field['field']:
-                    total_RCU_By_Tenant = Decimal(field['value'])
-                if 'WriteCapacityUnits' in field['field']:
-                    total_WCU_By_Tenant = Decimal(field['value'])
-            
-            #RCU is about 5 times cheaper
-            tenant_attribution_percentage= (((total_RCU_By_Tenant * 5) + total_WCU_By_Tenant) / ((total_RCU * 5) + total_WCU)) 
-            tenant_dynamodb_cost = tenant_attribution_percentage * total_dynamodb_cost
-            
-            try:
-                response = attribution_table.put_item(
-                    Item=
-                        {
-                            "Date": start_date_time,
-                            "TenantId#ServiceName": tenant_id+"#"+"DynamoDB",
-                            "TenantId": tenant_id, 
-                            "TotalRCU": total_RCU, 
-                            "TenantTotalRCU": total_RCU_By_Tenant, 
-                            "TotalWCU": total_WCU,
-                            "TenantTotalWCU": total_WCU_By_Tenant, 
-                            "TenantAttributionPercentage": tenant_attribution_percentage,
-                            "TenantServiceCost": tenant_dynamodb_cost,
-                            "TotalServiceCost": total_dynamodb_cost
-                        }
-                )
-            except ClientError as e:
-                print(e.response['Error']['Message'])
-                raise Exception('Error adding a product', e)
-            else:
-                print("PutItem succeeded:")
-                
-            tenant_id = 'unknown'
-            total_RCU_By_Tenant = 0.0
-            total_WCU_By_Tenant = 0.0
-        
-    
-    
 #Below function considers number of invocation as the metrics to calculate usage and cost. 
 #You can go granluar by recording duration of each metrics and use that to get more granular
 #Since our functions are basic CRUD this might work as a ball park cost estimate
 def calculate_daily_lambda_attribution_by_tenant(event, context):
-    
-    #Get total dynamodb cost for the given duration
     start_date_time = __get_start_date_time() #current day epoch
     end_date_time =  __get_end_date_time() #next day epoch
     
-    #Get total dynamodb cost for the given duration
+    #Get total lambda cost for the given duration
     total_lambda_cost = __get_total_service_cost('AWSLambda', start_date_time, end_date_time)
 
-    log_group_names = __get_list_of_log_group_names()
-    
-    usage_by_tenant_by_day_query='fields @timestamp, @message \
-        | filter @message like /Request completed/ \
-        | fields tenant_id as TenantId , CountLambdaInvocations.0 As LambdaInvocations, timestamp\
-        | stats count (tenant_id) as CountLambdaInvocations by TenantId, dateceil(@timestamp, 1d) as timestamp'
-    usage_by_tenant_by_day = __query_cloudwatch_logs(logs, log_group_names, usage_by_tenant_by_day_query, start_date_time, end_date_time)
-
-    print(usage_by_tenant_by_day) 
+    usage_by_tenant = __get_usage_by_tenant_by_day([(start_date_time, end_date_time)])[start_date_time]
+    return __write_attribution_items(event, __get_lambda_attribution_items(start_date_time, usage_by_tenant, total_lambda_cost))
+
+def backfill_attribution_by_tenant(event, context):
+    """ Attributes the DynamoDB and Lambda cost of every day of a date range, to recompute days which were
+        missed. Days are attributed BACKFILL_MAX_CONCURRENT_DAYS at a time, with their Logs Insights and
+        Athena queries running concurrently. Attribution items have the same keys as the daily ones and are
+        overwritten, so days can be backfilled again. Completed days are checkpointed, invoking the function
+        again with the same event resumes a backfill which ran out of time.
+
+    Args:
+        event: {"startDate": "2022-10-01", "endDate": "2022-10-31"}, both days are included.
+            Optional "backfillId" to checkpoint under, defaults to the date range.
+            Optional "dryRun": true writes the attribution of all days as one CSV to S3,
+            without writing to the table or checkpointing
+
+    Returns:
+        dict: status, Complete or Incomplete when the function ran out of time, the number of
+            backfilled and remaining days, and the CSV location for dry runs
+    """
+    start_date = __parse_date(event['startDate'])
+    end_date = __parse_date(event['endDate'])
+    if (end_date < start_date):
+        raise Exception('endDate must not be before startDate')
+    backfill_id = event.get('backfillId', event['startDate'] + '_' + event['endDate'])
+    dry_run = bool(event.get('dryRun', False))
+
+    completed_dates = set() if dry_run else __get_backfill_checkpoint(backfill_id)
+    day_windows = [day_window for day_window in __get_day_windows(start_date, end_date) if day_window[0] not in completed_dates]
+    print("Backfill " + backfill_id + ": " + str(len(completed_dates)) + " days completed before, " + str(len(day_windows)) + " days to backfill")
+
+    backfilled_days = 0
+    dry_run_items = []
+    status = 'Complete'
+    for chunk_start in range(0, len(day_windows), BACKFILL_MAX_CONCURRENT_DAYS):
+        if (context is not None and context.get_remaining_time_in_millis() < BACKFILL_MIN_REMAINING_MILLIS):
+            status = 'Incomplete'
+            break
+        chunk = day_windows[chunk_start:chunk_start + BACKFILL_MAX_CONCURRENT_DAYS]
+        attribution_items = __get_attribution_items_by_days(chunk)
+        if dry_run:
+            dry_run_items.extend(attribution_items)
+        else:
+            __batch_write_attribution_items(attribution_items)
+            __add_backfill_checkpoint(backfill_id, [day_window[0] for day_window in chunk])
+        print("Backfilled " + str(len(attribution_items)) + " attribution items for " + str(len(chunk)) + " days")
+        backfilled_days += len(chunk)
+
+    result = {'status': status, 'backfilledDays': backfilled_days, 'remainingDays': len(day_windows) - backfilled_days}
+    if dry_run:
+        result.update(__write_attribution_csv(dry_run_items))
+    return result
+
+def __get_attribution_items_by_days(day_windows):
+    # the Athena queries run in the executor while the logs of the days are queried
+    with ThreadPoolExecutor(max_workers=BACKFILL_MAX_CONCURRENT_DAYS) as executor:
+        dynamodb_costs = [executor.submit(__get_total_service_cost, 'AmazonDynamoDB', start_date_time, end_date_time)
+            for start_date_time, end_date_time in day_windows]
+        lambda_costs = [executor.submit(__get_total_service_cost, 'AWSLambda', start_date_time, end_date_time)
+            for start_date_time, end_date_time in day_windows]
+        usage_by_day = __get_usage_by_tenant_by_day(day_windows)
+
+        attribution_items = []
+        for i, (start_date_time, end_date_time) in enumerate(day_windows):
+            usage_by_tenant = usage_by_day[start_date_time]
+            attribution_items.extend(__get_dynamodb_attribution_items(start_date_time, usage_by_tenant, dynamodb_costs[i].result()))
+            attribution_items.extend(__get_lambda_attribution_items(start_date_time, usage_by_tenant, lambda_costs[i].result()))
+
+    return attribution_items
+
+def __get_backfill_checkpoint(backfill_id):
+    response = attribution_table.get_item(
+        Key={
+            "Date": STATE_ITEMS_DATE,
+            "TenantId#ServiceName": "Backfill#" + backfill_id
+        }
+    )
+    return set(int(date) for date in response.get('Item', {}).get('CompletedDates', []))
 
-    total_usage_by_day_query = 'filter @message like /Request completed/ \
-        | fields CountLambdaInvocations.0 As LambdaInvocations, timestamp\
-        | stats count (tenant_id) as CountLambdaInvocations by dateceil(@timestamp, 1d) as timestamp'
-    
-    total_usage_by_day = __query_cloudwatch_logs(logs,  log_group_names, 
-    total_usage_by_day_query, start_date_time, end_date_time)
+def __add_backfill_checkpoint(backfill_id, dates):
+    attribution_table.update_item(
+        Key={
+            "Date": STATE_ITEMS_DATE,
+            "TenantId#ServiceName": "Backfill#" + backfill_id
+        },
+        UpdateExpression="add CompletedDates :dates",
+        ExpressionAttributeValues={
+            ":dates": set(dates)
+        }
+    )
 
-    print(total_usage_by_day) 
-    
-    total_invocations = 1 #to avoid divide by zero
-    for result in total_usage_by_day['results'][0]:
-        if 'LambdaInvocations' in result['field']:
-            total_invocations = Decimal(result['value'])
-        
+def __parse_date(date):
+    return datetime.strptime(date, '%Y-%m-%d').date()
+
+def __get_day_windows(start_date, end_date):
+    # epochs of the local midnights, like __get_start_date_time
+    day_windows = []
+    date = start_date
+    while date <= end_date:
+        next_date = date + timedelta(days=1)
+        day_windows.append((int(datetime(date.year, date.month, date.day).timestamp()),
+            int(datetime(next_date.year, next_date.month, next_date.day).timestamp())))
+        date = next_date
+    return day_windows
+
+def __get_dynamodb_attribution_items(start_date_time, usage_by_tenant, total_dynamodb_cost):
+    attribution_items = []
+    total_RCU = sum(usage["TenantTotalRCU"] for usage in usage_by_tenant.values())
+    total_WCU = sum(usage["TenantTotalWCU"] for usage in usage_by_tenant.values())
+    print (total_RCU)
+    print (total_WCU)
     
+    if (total_RCU + total_WCU > 0):
+        for tenant_id, usage in usage_by_tenant.items():
+            total_RCU_By_Tenant = usage["TenantTotalRCU"]
+            total_WCU_By_Tenant = usage["TenantTotalWCU"]
+            #RCU is about 5 times cheaper
+            tenant_attribution_percentage= (((total_RCU_By_Tenant * 5) + total_WCU_By_Tenant) / ((total_RCU * 5) + total_WCU)) 
+            tenant_dynamodb_cost = tenant_attribution_percentage * total_dynamodb_cost
+            attribution_items.append(
+                {
+                    "Date": start_date_time,
+                    "TenantId#ServiceName": tenant_id+"#"+"DynamoDB",
+                    "TenantId": tenant_id, 
+                    "TotalRCU": total_RCU, 
+                    "TenantTotalRCU": total_RCU_By_Tenant, 
+                    "TotalWCU": total_WCU,
+                    "TenantTotalWCU": total_WCU_By_Tenant, 
+                    "TenantAttributionPercentage": tenant_attribution_percentage,
+                    "TenantServiceCost": tenant_dynamodb_cost,
+                    "TotalServiceCost": total_dynamodb_cost
+                }
+            )
+    return attribution_items
+
+def __get_lambda_attribution_items(start_date_time, usage_by_tenant, total_lambda_cost):
+    attribution_items = []
+    total_invocations = sum(usage["TenantTotalInvocations"] for usage in usage_by_tenant.values())
     print (total_invocations)
     
     if (total_invocations>0):
-        total_invocations_by_tenant = 0
-        
-        for result in usage_by_tenant_by_day['results']:
-            for field in result:
-                if 'TenantId' in field['field']:
-                    tenant_id = field['value']
-                if 'LambdaInvocations' in field['field']:
-                    total_invocations_by_tenant = Decimal(field['value'])
-                
-            
-            #RCU is about 5 times cheaper
+        for tenant_id, usage in usage_by_tenant.items():
+            total_invocations_by_tenant = usage["TenantTotalInvocations"]
             tenant_attribution_percentage= (total_invocations_by_tenant / total_invocations) 
             tenant_lambda_cost = tenant_attribution_percentage * total_lambda_cost
-            
+            attribution_items.append(
+                {
+                    "Date": start_date_time,
+                    "TenantId#ServiceName": tenant_id+"#"+"AWSLambda",
+                    "TenantId": tenant_id, 
+                    "TotalInvocations": total_invocations, 
+                    "TenantTotalInvocations": total_invocations_by_tenant,
+                    "TenantAttributionPercentage": tenant_attribution_percentage,
+                    "TenantServiceCost": tenant_lambda_cost,
+                    "TotalServiceCost": total_lambda_cost
+                }
+            )
+    return attribution_items
+
+def __write_attribution_items(event, attribution_items):
+    if (isinstance(event, dict) and event.get('dryRun', False)):
+        return __write_attribution_csv(attribution_items)
+    __batch_write_attribution_items(attribution_items)
+    return {'attributionItems': len(attribution_items)}
+
+def __batch_write_attribution_items(attribution_items):
+    """ Writes attribution items with BatchWriteItem in chunks of 25. Unprocessed items are retried
+        with exponential backoff and full jitter.
+    """
+    table_name = attribution_table.name
+    for chunk_start in range(0, len(attribution_items), BATCH_WRITE_MAX_SIZE):
+        pending = [{'PutRequest': {'Item': attribution_item}}
+            for attribution_item in attribution_items[chunk_start:chunk_start + BATCH_WRITE_MAX_SIZE]]
+        attempt = 0
+        while True:
             try:
-                response = attribution_table.put_item(
-                    Item=
-                        {
-                            "Date": start_date_time,
-                            "TenantId#ServiceName": tenant_id+"#"+"AWSLambda",
-                            "TenantId": tenant_id, 
-                            "TotalInvocations": total_invocations, 
-                            "TenantTotalInvocations": total_invocations_by_tenant,
-                            "TenantAttributionPercentage": tenant_attribution_percentage,
-                            "TenantServiceCost": tenant_lambda_cost,
-                            "TotalServiceCost": total_lambda_cost
-                        }
-                )
+                response = dynamodb.batch_write_item(RequestItems={table_name: pending})
             except ClientError as e:
                 print(e.response['Error']['Message'])
-                raise Exception('Error adding a product', e)
-            else:
-                print("PutItem succeeded:")
-            
-            tenant_id = 'unknown'
-            tenant_total_RCU = 0.0
-            tenant_total_WCU = 0.0
+                raise Exception('Error adding attribution items', e)
+            pending = response.get('UnprocessedItems', {}).get(table_name, [])
+            if len(pending) == 0:
+                break
+            if attempt >= BATCH_WRITE_MAX_RETRIES:
+                raise Exception('Attribution items still unprocessed after ' + str(attempt) + ' retries')
+            time.sleep(random.uniform(0, min(BATCH_WRITE_MAX_BACKOFF_SECONDS, BATCH_WRITE_BASE_BACKOFF_SECONDS * (2 ** attempt))))
+            attempt += 1
+    print("BatchWriteItem succeeded for " + str(len(attribution_items)) + " attribution items")
+
+def __write_attribution_csv(attribution_items):
+    csv_file = io.StringIO()
+    writer = csv.DictWriter(csv_file, fieldnames=attribution_csv_columns, restval='')
+    writer.writeheader()
+    writer.writerows(attribution_items)
+    csv_key = 'attribution-dry-run/' + datetime.utcnow().strftime('%Y-%m-%dT%H-%M-%S-%f') + '.csv'
+    s3.put_object(Bucket=ATHENA_S3_OUTPUT, Key=csv_key, Body=csv_file.getvalue().encode('utf-8'), ContentType='text/csv')
+    print("Dry run, " + str(len(attribution_items)) + " attribution items written to s3://" + ATHENA_S3_OUTPUT + "/" + csv_key)
+    return {'dryRun': True, 'attributionItems': len(attribution_items), 'csvLocation': 's3://' + ATHENA_S3_OUTPUT + '/' + csv_key}
+
+def __get_usage_by_tenant_by_day(day_windows):
+    """ Usage of every tenant for each day, from the usage counters, or from the logs for the days
+        the counters do not cover completely. The logs of those days are queried concurrently.
+
+    Args:
+        day_windows (list): (start epoch, end epoch) of the days
+
+    Returns:
+        dict: by start epoch of the day, dict of TenantTotalRCU, TenantTotalWCU and TenantTotalInvocations by tenant id
+    """
+    usage_by_day = {}
+    unaggregated_day_windows = []
+    log_group_names = __get_list_of_log_group_names()
+    counted_day_windows = __get_counted_day_windows(log_group_names, day_windows)
+    for start_date_time, end_date_time in day_windows:
+        if (start_date_time, end_date_time) in counted_day_windows:
+            usage_counters = __get_usage_counters(start_date_time)
+            usage_by_day[start_date_time] = {tenant_id: {
+                    "TenantTotalRCU": Decimal(counters["TenantTotalRCU"]),
+                    "TenantTotalWCU": Decimal(counters["TenantTotalWCU"]),
+                    "TenantTotalInvocations": Decimal(counters["TenantTotalInvocations"])
+                } for tenant_id, counters in usage_counters.items()}
+        else:
+            unaggregated_day_windows.append((start_date_time, end_date_time))
+
+    if unaggregated_day_windows:
+        print( log_group_names)
+        query_results = __query_cloudwatch_logs(logs, log_group_names, usage_by_tenant_query, unaggregated_day_windows)
+        for start_date_time, end_date_time in unaggregated_day_windows:
+            usage_by_day[start_date_time] = __get_usage_by_tenant_from_query_results(query_results[(start_date_time, end_date_time)])
+    return usage_by_day
+
+def __get_counted_day_windows(log_group_names, day_windows):
+    """ Days whose usage counters are complete: every log group with logs of the day was subscribed
+        before the day started. Logs written before a log group was subscribed are not counted.
+
+    Returns:
+        set: (start epoch, end epoch) of the days
+    """
+    subscription_times = __get_subscription_times()
+    creation_times = {log_group_name: __get_log_group_creation_time(log_group_name) for log_group_name in log_group_names}
+    counted_day_windows = set()
+    for start_date_time, end_date_time in day_windows:
+        if all(creation_time is None or creation_time >= end_date_time or 
+                subscription_times.get(log_group_name, end_date_time) <= start_date_time
+                for log_group_name, creation_time in creation_times.items()):
+            counted_day_windows.add((start_date_time, end_date_time))
+    return counted_day_windows
+
+def __get_log_group_creation_time(log_group_name):
+    response = logs.describe_log_groups(logGroupNamePrefix=log_group_name)
+    for log_group in response['logGroups']:
+        if (log_group['logGroupName'] == log_group_name):
+            return log_group['creationTime'] // 1000
+    return None
+
+def __get_usage_by_tenant_from_query_results(query_results):
+    usage_by_tenant = {}
+    for result in query_results['results']:
+        fields = {field['field']: field['value'] for field in result}
+        # lines without tenant are grouped into a row without TenantId
+        if 'TenantId' not in fields:
+            continue
+        usage_by_tenant[fields['TenantId']] = {
+            "TenantTotalRCU": Decimal(fields.get('ReadCapacityUnits', 0)),
+            "TenantTotalWCU": Decimal(fields.get('WriteCapacityUnits', 0)),
+            "TenantTotalInvocations": Decimal(fields.get('LambdaInvocations', 0))
+        }
+    return usage_by_tenant
+
+#Invoked by the subscription filters of the pooled function log groups. Keeps per tenant per day
+#counters of the usage the daily attribution functions divide the service cost by, so they do not
+#have to scan the logs with Logs Insights.
+def aggregate_tenant_usage_from_logs(event, context):
+    log_data = json.loads(gzip.decompress(base64.b64decode(event['awslogs']['data'])))
+    #CloudWatch Logs sends a control message to check the destination when a filter is created
+    if (log_data['messageType'] != 'DATA_MESSAGE'):
+        return
+
+    usage = list(get_tenant_usage_from_log_events(log_data['logEvents']).items())
+    #a failed invocation is retried with the same delivery, which is recorded with the counters it added
+    delivery_id = log_data['logStream'] + "#" + log_data['logEvents'][0]['id']
+    updated = 0
+    for chunk_start in range(0, len(usage), USAGE_TRANSACTION_MAX_SIZE):
+        chunk = usage[chunk_start:chunk_start + USAGE_TRANSACTION_MAX_SIZE]
+        if __add_usage_counters(delivery_id + "#" + str(chunk_start), chunk):
+            updated += len(chunk)
+    print("Usage counters updated for " + str(updated) + " tenant days from " + log_data['logGroup'])
+
+def get_tenant_usage_from_log_events(log_events):
+    """ Aggregates the usage in log events the same way the Logs Insights queries of the attribution
+        functions do: the first value of the ReadCapacityUnits and WriteCapacityUnits metrics of EMF
+        lines, and the number of "Request completed" lines, by tenant and day
+
+    Args:
+        log_events (list): {'timestamp': epoch milliseconds, 'message': log line} dicts
+
+    Returns:
+        dict: counters by (day epoch, tenant id), with TenantTotalRCU, TenantTotalWCU and TenantTotalInvocations
+    """
+    usage = {}
+    for log_event in log_events:
+        message = log_event['message']
+        is_capacity_line = 'ReadCapacityUnits' in message or 'WriteCapacityUnits' in message
+        is_request_line = 'Request completed' in message
+        if not (is_capacity_line or is_request_line):
+            continue
+
+        fields = __get_json_fields(message)
+        tenant_id = fields.get('tenant_id')
+        if tenant_id is None:
+            continue
+
+        date = log_event['timestamp'] // 1000 // SECONDS_PER_DAY * SECONDS_PER_DAY
+        counters = usage.get((date, tenant_id))
+        if counters is None:
+            counters = {"TenantTotalRCU": Decimal(0), "TenantTotalWCU": Decimal(0), "TenantTotalInvocations": 0}
+            usage[(date, tenant_id)] = counters
+        if is_capacity_line:
+            counters["TenantTotalRCU"] += __get_first_metric_value(fields, 'ReadCapacityUnits')
+            counters["TenantTotalWCU"] += __get_first_metric_value(fields, 'WriteCapacityUnits')
+        if is_request_line:
+            counters["TenantTotalInvocations"] += 1
+    return usage
+
+def __get_json_fields(message):
+    # like Logs Insights, fields are discovered in the JSON part of the line
+    start = message.find('{')
+    if start < 0:
+        return {}
+    try:
+        fields = json.loads(message[start:])
+    except ValueError:
+        return {}
+    if not isinstance(fields, dict):
+        return {}
+    return fields
+
+def __get_first_metric_value(fields, metric_name):
+    value = fields.get(metric_name)
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return Decimal(0)
+    return Decimal(str(value))
+
+def __add_usage_counters(delivery_id, usage):
+    """ Adds the usage of a delivery to the counters, in one transaction with a record of the delivery,
+        which fails when the delivery was counted before
+
+    Args:
+        delivery_id (string): log stream, id of the first log event and index of the chunk of the delivery
+        usage (list): ((day epoch, tenant id), counters) of at most USAGE_TRANSACTION_MAX_SIZE tenant days
+
+    Returns:
+        bool: False if the delivery was counted before
+    """
+    transact_items = [{
+        'Put': {
+            'TableName': attribution_table.name,
+            'Item': {
+                "Date": STATE_ITEMS_DATE,
+                "TenantId#ServiceName": "Delivery#" + delivery_id,
+                "TimeToLive": int(time.time()) + DELIVERY_RECORD_SECONDS
+            },
+            'ConditionExpression': "attribute_not_exists(#date)",
+            'ExpressionAttributeNames': {"#date": "Date"}
+        }
+    }]
+    for (date, tenant_id), counters in usage:
+        transact_items.append({
+            'Update': {
+                'TableName': attribution_table.name,
+                'Key': {
+                    "Date": date,
+                    "TenantId#ServiceName": tenant_id+"#"+USAGE_SERVICE_NAME
+                },
+                'UpdateExpression': "set TenantId = :tenantId add TenantTotalRCU :rcu, TenantTotalWCU :wcu, TenantTotalInvocations :invocations",
+                'ExpressionAttributeValues': {
+                    ":tenantId": tenant_id,
+                    ":rcu": counters["TenantTotalRCU"],
+                    ":wcu": counters["TenantTotalWCU"],
+                    ":invocations": counters["TenantTotalInvocations"]
+                }
+            }
+        })
+    try:
+        # the client of the resource serializes the python types like the Table resource
+        attribution_table.meta.client.transact_write_items(TransactItems=transact_items)
+    except ClientError as e:
+        reasons = e.response.get('CancellationReasons', [])
+        if (e.response['Error']['Code'] == 'TransactionCanceledException' and reasons and reasons[0]['Code'] == 'ConditionalCheckFailed'):
+            print("Delivery " + delivery_id + " was counted before")
+            return False
+        print(e.response['Error']['Message'])
+        raise Exception('Error updating usage counters', e)
+    return True
+
+def __get_usage_counters(date):
+    """ Usage counters of all tenants for a day
+
+    Returns:
+        dict: counters by tenant id, empty when the usage of the day was not aggregated
+    """
+    usage_counters = {}
+    query_args = {'KeyConditionExpression': Key('Date').eq(date)}
+    while True:
+        response = attribution_table.query(**query_args)
+        for item in response['Items']:
+            if item["TenantId#ServiceName"].endswith("#"+USAGE_SERVICE_NAME):
+                usage_counters[item["TenantId"]] = item
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return usage_counters
+
+#Scheduled, so log groups of functions which were invoked for the first time get subscribed as well.
+#Putting a filter with the same name again only updates it. The first time a log group was found
+#subscribed is recorded, the usage counters of a day are used only when all log groups were subscribed before it.
+def subscribe_usage_log_groups(event, context):
+    for log_group_name in __get_list_of_log_group_names():
+        try:
+            logs.put_subscription_filter(
+                logGroupName=log_group_name,
+                filterName=USAGE_SUBSCRIPTION_FILTER_NAME,
+                filterPattern=USAGE_SUBSCRIPTION_FILTER_PATTERN,
+                destinationArn=USAGE_AGGREGATOR_FUNCTION_ARN
+            )
+        except ClientError as e:
+            # a log group can have two subscription filters only
+            print(log_group_name + ": " + e.response['Error']['Message'])
+            continue
+        __add_subscription_time(log_group_name, int(time.time()))
+
+def __add_subscription_time(log_group_name, subscribed_at):
+    try:
+        attribution_table.put_item(
+            Item={
+                "Date": STATE_ITEMS_DATE,
+                "TenantId#ServiceName": "Subscription#" + log_group_name,
+                "SubscribedAt": subscribed_at
+            },
+            ConditionExpression="attribute_not_exists(#date)",
+            ExpressionAttributeNames={"#date": "Date"}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def __get_subscription_times():
+    """ Time each log group was first found subscribed
+
+    Returns:
+        dict: epoch seconds by log group name
+    """
+    subscription_times = {}
+    query_args = {'KeyConditionExpression': Key('Date').eq(STATE_ITEMS_DATE) & Key('TenantId#ServiceName').begins_with("Subscription#")}
+    while True:
+        response = attribution_table.query(**query_args)
+        for item in response['Items']:
+            subscription_times[item["TenantId#ServiceName"][len("Subscription#"):]] = int(item["SubscribedAt"])
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return subscription_times
 
 def __get_total_service_cost(servicename, start_date_time, end_date_time):
+    service_costs = __get_service_costs(__get_billing_period(start_date_time))
+    if CUR_BILLING_PERIOD:
+        #the sample CUR file covers a fixed billing period, its total is attributed to every day
+        return service_costs["ServiceCosts"].get(servicename, Decimal(0))
+    return service_costs["DailyServiceCosts"].get(str(start_date_time), {}).get(servicename, Decimal(0))
+
+def __get_billing_period(start_date_time):
+    if CUR_BILLING_PERIOD:
+        return CUR_BILLING_PERIOD
+    return datetime.fromtimestamp(start_date_time).strftime('%Y-%m')
+
+def __get_service_costs(billing_period):
+    """ Cost of every product code in a billing period, in total and by day. Queried from the CUR
+        once per billing period and cached in the attribution table, and in memory for the
+        following calls of the same invocation. The cache of the current billing period expires
+        after CUR_CACHE_SECONDS, since the CUR keeps being updated during the month.
+
+    Returns:
+        dict: ServiceCosts, cost by product code, and DailyServiceCosts, cost by product code by day epoch
+    """
+    with __service_costs_lock:
+        service_costs = __service_costs_by_period.get(billing_period)
+        if (service_costs is None or __is_expired(service_costs)):
+            service_costs = __get_cached_service_costs(billing_period)
+            if (service_costs is None or 'ServiceCosts' not in service_costs or __is_expired(service_costs)):
+                # a query which failed or was stopped is not started again with the same token
+                query_attempt = int(service_costs.get('QueryAttempt', 0)) if service_costs else 0
+                try:
+                    service_costs = __query_service_costs(billing_period, query_attempt)
+                except Exception:
+                    __set_query_attempt(billing_period, query_attempt + 1)
+                    raise
+                attribution_table.put_item(Item=service_costs)
+            __service_costs_by_period[billing_period] = service_costs
+        return service_costs
+
+def __is_expired(service_costs):
+    return 'ExpiresAt' in service_costs and service_costs['ExpiresAt'] <= int(time.time())
+
+def __get_cached_service_costs(billing_period):
+    response = attribution_table.get_item(
+        Key={
+            "Date": STATE_ITEMS_DATE,
+            "TenantId#ServiceName": "CUR#" + billing_period
+        }
+    )
+    return response.get('Item')
 
-    # We need to add more filters for day, month, year, resource ids etc. Below query is because we are just using a sample cur file
-    #Ignoting startTime and endTime filter for now since we have a static/sample cur file
-    
-    query = "SELECT sum(line_item_blended_cost) AS cost FROM costexplorerdb.curoutput WHERE line_item_product_code='{0}'".format(servicename) 
+def __set_query_attempt(billing_period, query_attempt):
+    attribution_table.update_item(
+        Key={
+            "Date": STATE_ITEMS_DATE,
+            "TenantId#ServiceName": "CUR#" + billing_period
+        },
+        UpdateExpression="set QueryAttempt = :queryAttempt",
+        ExpressionAttributeValues={
+            ":queryAttempt": query_attempt
+        }
+    )
 
-    # Execution
+def __query_service_costs(billing_period, query_attempt):
+    year, month = billing_period.split('-')
+    # one scan of the partitions of the billing period for all product codes.
+    # CUR partitions are named year=2022/month=10, months are not zero padded
+    query = "SELECT line_item_product_code, date(line_item_usage_start_date) AS usage_date, \
+        sum(line_item_blended_cost) AS cost FROM costexplorerdb.curoutput \
+        WHERE year='{0}' AND month='{1}' GROUP BY 1, 2".format(int(year), int(month))
+
+    # the same token within a cache period returns the running query, so concurrent runs share it.
+    # The attempt changes the token after a query failed or was stopped.
+    client_request_token = hashlib.sha256((billing_period + '#' + str(int(time.time()) // CUR_CACHE_SECONDS) + '#' + str(query_attempt)).encode('utf-8')).hexdigest()
     response = athena.start_query_execution(
         QueryString=query,
+        ClientRequestToken=client_request_token,
         QueryExecutionContext={
             'Database': 'costexplorerdb'
         },
@@ -197,55 +674,104 @@ def __get_total_service_cost(servicename, start_date_time, end_date_time):
             'OutputLocation': "s3://" + ATHENA_S3_OUTPUT,
         }
     )
-
-    # get query execution id
     query_execution_id = response['QueryExecutionId']
     print(query_execution_id)
-
-    # get execution status
-    for i in range(1, 1 + RETRY_COUNT):
-
-        # get query execution
+    __wait_for_athena_query(query_execution_id)
+
+    service_costs = {}
+    daily_service_costs = {}
+    paginator = athena.get_paginator('get_query_results')
+    is_header = True
+    for result in paginator.paginate(QueryExecutionId=query_execution_id):
+        for row in result['ResultSet']['Rows']:
+            if is_header:
+                is_header = False
+                continue
+            product_code, usage_date, cost = [column.get('VarCharValue') for column in row['Data']]
+            if (product_code is None or cost is None):
+                continue
+            cost = Decimal(cost)
+            service_costs[product_code] = service_costs.get(product_code, Decimal(0)) + cost
+            if usage_date is not None:
+                day = datetime.strptime(usage_date, '%Y-%m-%d')
+                day_costs = daily_service_costs.setdefault(str(int(day.timestamp())), {})
+                day_costs[product_code] = day_costs.get(product_code, Decimal(0)) + cost
+    print(service_costs)
+
+    cached_service_costs = {
+        "Date": STATE_ITEMS_DATE,
+        "TenantId#ServiceName": "CUR#" + billing_period,
+        "ServiceCosts": service_costs,
+        "DailyServiceCosts": daily_service_costs,
+        "QueryAttempt": query_attempt
+    }
+    if (CUR_BILLING_PERIOD == '' and billing_period >= datetime.now().strftime('%Y-%m')):
+        cached_service_costs["ExpiresAt"] = int(time.time()) + CUR_CACHE_SECONDS
+    return cached_service_costs
+
+def __wait_for_athena_query(query_execution_id):
+    # polled with exponential backoff, a grouped query over one billing period usually completes in seconds
+    poll_interval = ATHENA_MIN_POLL_SECONDS
+    deadline = time.time() + ATHENA_QUERY_TIMEOUT_SECONDS
+    while True:
         query_status = athena.get_query_execution(QueryExecutionId=query_execution_id)
-        print (query_status)
         query_execution_status = query_status['QueryExecution']['Status']['State']
-
         if query_execution_status == 'SUCCEEDED':
             print("STATUS:" + query_execution_status)
-            break
-
-        if query_execution_status == 'FAILED':
-            raise Exception("STATUS:" + query_execution_status)
-
+            return
+        if query_execution_status in ('FAILED', 'CANCELLED'):
+            raise Exception("STATUS:" + query_execution_status + " " + query_status['QueryExecution']['Status'].get('StateChangeReason', ''))
+        if time.time() + poll_interval > deadline:
+            athena.stop_query_execution(QueryExecutionId=query_execution_id)
+            raise Exception('TIME OVER')
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, ATHENA_MAX_POLL_SECONDS)
+
+def __query_cloudwatch_logs(logs, log_group_names, query_string, time_windows):
+    """ Runs a Logs Insights query for each time window. The queries run concurrently, up to
+        LOGS_MAX_CONCURRENT_QUERIES at a time, and are polled with a backoff which grows while
+        none of them completes.
+
+    Returns:
+        dict: query results by time window
+    """
+    pending_windows = list(time_windows)
+    running_queries = {}
+    query_results = {}
+    poll_interval = LOGS_MIN_POLL_SECONDS
+    while pending_windows or running_queries:
+        while pending_windows and len(running_queries) < LOGS_MAX_CONCURRENT_QUERIES:
+            start_time, end_time = pending_windows[0]
+            try:
+                query = logs.start_query(logGroupNames=log_group_names,
+                startTime=start_time,
+                endTime=end_time,
+                queryString=query_string)
+            except logs.exceptions.LimitExceededException:
+                # queries of other callers count against the account limit as well
+                if not running_queries:
+                    time.sleep(poll_interval)
+                    poll_interval = min(poll_interval * 2, LOGS_MAX_POLL_SECONDS)
+                break
+            running_queries[pending_windows.pop(0)] = query["queryId"]
+
+        if not running_queries:
+            continue
+        time.sleep(poll_interval)
+        completed = False
+        for time_window, query_id in list(running_queries.items()):
+            results = logs.get_query_results(queryId=query_id)
+            if results['status'] in ('Scheduled', 'Running'):
+                continue
+            if results['status'] != 'Complete':
+                raise Exception('Logs Insights query ' + query_id + ' ended with status ' + results['status'])
+            query_results[time_window] = results
+            del running_queries[time_window]
+            completed = True
+        if completed:
+            poll_interval = LOGS_MIN_POLL_SECONDS
         else:
-            print("STATUS:" + query_execution_status)
-            time.sleep(i)
-    else:
-        athena.stop_query_execution(QueryExecutionId=query_execution_id)
-        raise Exception('TIME OVER')
-
-    # get query results
-    result = athena.get_query_results(QueryExecutionId=query_execution_id)
-    
-    print (result)
-    
-    
-    total_dynamo_db_cost = result['ResultSet']['Rows'][1]['Data'][0]['VarCharValue']
-    print(total_dynamo_db_cost)
-    
-    return Decimal(total_dynamo_db_cost)
-    
-def __query_cloudwatch_logs(logs, log_group_names, query_string, start_time, end_time):
-    query = logs.start_query(logGroupNames=log_group_names,
-    startTime=start_time,
-    endTime=end_time,
-    queryString=query_string)
-
-    query_results = logs.get_query_results(queryId=query["queryId"])
-
-    while query_results['status']=='Running' or query_results['status']=='Scheduled':
-        time.sleep(5)
-        query_results = logs.get_query_results(queryId=query["queryId"])
+            poll_interval = min(poll_interval * 2, LOGS_MAX_POLL_SECONDS)
 
     return query_results
 
@@ -272,38 +798,9 @@ def __get_list_of_log_group_names():
     response_iterator = cloudformation_paginator.paginate(StackName='stack-pooled')
     for stack_resources in response_iterator:
         for resource in stack_resources['StackResourceSummaries']:
-            if (resource["LogicalResourceId"] == "CreateProductFunction"):
+            if (resource["LogicalResourceId"] in usage_function_logical_ids):
                 __add_log_group_name(logs, ''.join([log_group_prefix,resource["PhysicalResourceId"]]), 
                  log_group_names)
-                continue    
-            if (resource["LogicalResourceId"] == "UpdateProductFunction"):
-                __add_log_group_name(logs, ''.join([log_group_prefix,resource["PhysicalResourceId"]]), 
-                 log_group_names) 
-                continue
-            if (resource["LogicalResourceId"] == "GetProductsFunction"):
-                __add_log_group_name(logs, ''.join([log_group_prefix,resource["PhysicalResourceId"]]), 
-                 log_group_names)
-                continue
-            if (resource["LogicalResourceId"] == "DeleteProductFunction"):
-                __add_log_group_name(logs, ''.join([log_group_prefix,resource["PhysicalResourceId"]]), 
-                 log_group_names) 
-                continue         
-            if (resource["LogicalResourceId"] == "CreateOrderFunction"):
-                __add_log_group_name(logs, ''.join([log_group_prefix,resource["PhysicalResourceId"]]), 
-                 log_group_names) 
-                continue
-            if (resource["LogicalResourceId"] == "UpdateOrderFunction"):
-                __add_log_group_name(logs, ''.join([log_group_prefix,resource["PhysicalResourceId"]]), 
-                 log_group_names) 
-                continue
-            if (resource["LogicalResourceId"] == "GetOrdersFunction"):
-                __add_log_group_name(logs, ''.join([log_group_prefix,resource["PhysicalResourceId"]]), 
-                 log_group_names) 
-                continue
-            if (resource["LogicalResourceId"] == "DeleteOrderFunction"):
-                __add_log_group_name(logs, ''.join([log_group_prefix,resource["PhysicalResourceId"]]), 
-                 log_group_names) 
-                continue 
 
     return log_group_names        
 
@@ -0,0 +1,154 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Checks that the usage counters kept by aggregate_tenant_usage_from_logs give the same usage, and
+# the same attribution, as the Logs Insights query they replace. usage_log_events.json holds the log
+# lines of 200 invocations of a pooled function over two days: the EMF lines of metrics_manager, the
+# "Request completed" lines of logger, lines without tenant and Lambda START lines. The lines are
+# replayed through the subscription handler in deliveries of random size, and the Insights results are
+# computed from the same lines the way the query aggregates them. DynamoDB is mocked with moto.
+# Run from this folder with
+#   pip install -r requirements.txt && python -m pytest
+
+import base64
+import gzip
+import json
+import os
+import random
+import re
+import sys
+from decimal import Decimal
+
+import pytest
+
+function_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'TenantUsageAndCost'))
+sys.path[:0] = [function_path]
+
+SECONDS_PER_DAY = 86400
+
+with open(os.path.join(os.path.dirname(__file__), 'usage_log_events.json')) as events_file:
+    LOG_EVENTS = json.load(events_file)
+
+
+@pytest.fixture(scope='module')
+def usage_and_cost():
+    os.environ.update(AWS_DEFAULT_REGION='us-east-1', AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing')
+    import moto
+    with moto.mock_aws():
+        import boto3
+        boto3.resource('dynamodb').create_table(TableName='TenantCostAndUsageAttribution',
+            KeySchema=[{'AttributeName': 'Date', 'KeyType': 'HASH'}, {'AttributeName': 'TenantId#ServiceName', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'Date', 'AttributeType': 'N'}, {'AttributeName': 'TenantId#ServiceName', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        import tenant_usage_and_cost
+        yield tenant_usage_and_cost
+
+def get_day_windows():
+    days = sorted(set(log_event['timestamp'] // 1000 // SECONDS_PER_DAY * SECONDS_PER_DAY for log_event in LOG_EVENTS))
+    return [(day, day + SECONDS_PER_DAY) for day in days]
+
+def get_delivery(log_events):
+    log_data = {'messageType': 'DATA_MESSAGE', 'logGroup': '/aws/lambda/stack-pooled-GetProductsFunction',
+        'logStream': '2026/10/18/[$LATEST]0123456789abcdef', 'logEvents': log_events}
+    return {'awslogs': {'data': base64.b64encode(gzip.compress(json.dumps(log_data).encode('utf-8'))).decode('utf-8')}}
+
+def replay_log_events(usage_and_cost):
+    """ Delivers the lines which pass the subscription filter pattern, in deliveries of 1 to 100 lines.
+        Every fifth delivery is delivered twice, like a retried invocation.
+    """
+    pattern = re.compile('ReadCapacityUnits|WriteCapacityUnits|Request completed')
+    log_events = [log_event for log_event in LOG_EVENTS if pattern.search(log_event['message'])]
+    rng = random.Random(16)
+    position = 0
+    deliveries = 0
+    while position < len(log_events):
+        size = rng.randint(1, 100)
+        delivery = get_delivery(log_events[position:position + size])
+        usage_and_cost.aggregate_tenant_usage_from_logs(delivery, None)
+        if deliveries % 5 == 0:
+            usage_and_cost.aggregate_tenant_usage_from_logs(delivery, None)
+        position += size
+        deliveries += 1
+
+def get_insights_results(start_time, end_time):
+    """ Results of usage_by_tenant_query for a time window, in the format of GetQueryResults
+    """
+    rows = {}
+    for log_event in LOG_EVENTS:
+        message = log_event['message']
+        if not (start_time <= log_event['timestamp'] // 1000 < end_time):
+            continue
+        if not re.search('ReadCapacityUnits|WriteCapacityUnits|Request completed', message):
+            continue
+        try:
+            fields = json.loads(message)
+        except ValueError:
+            fields = {}
+        # stats groups the lines without tenant_id into a row without TenantId
+        row = rows.setdefault(fields.get('tenant_id'), {'ReadCapacityUnits': Decimal(0), 'WriteCapacityUnits': Decimal(0), 'LambdaInvocations': 0})
+        for metric_name in ['ReadCapacityUnits', 'WriteCapacityUnits']:
+            if isinstance(fields.get(metric_name), list):
+                row[metric_name] += Decimal(str(fields[metric_name][0]))
+        row['LambdaInvocations'] += 1 if 'Request completed' in message else 0
+    results = []
+    for tenant_id, row in rows.items():
+        result = [{'field': field, 'value': str(value)} for field, value in row.items()]
+        if tenant_id is not None:
+            result.insert(0, {'field': 'TenantId', 'value': tenant_id})
+        results.append(result)
+    return {'status': 'Complete', 'results': results}
+
+class InsightsLogs:
+    """ Stand-in for the logs client, returns the results of get_insights_results for the window of a query
+    """
+    class exceptions:
+        class LimitExceededException(Exception):
+            pass
+
+    def __init__(self):
+        self.queries = {}
+
+    def start_query(self, logGroupNames, startTime, endTime, queryString):
+        query_id = str(len(self.queries))
+        self.queries[query_id] = (startTime, endTime)
+        return {'queryId': query_id}
+
+    def get_query_results(self, queryId):
+        return get_insights_results(*self.queries[queryId])
+
+def get_usage_by_day(usage_and_cost, monkeypatch, counted):
+    module_functions = vars(usage_and_cost)
+    monkeypatch.setitem(module_functions, '__get_list_of_log_group_names', lambda: ['/aws/lambda/stack-pooled-GetProductsFunction'])
+    monkeypatch.setitem(module_functions, '__get_counted_day_windows', lambda log_group_names, day_windows: set(day_windows) if counted else set())
+    monkeypatch.setattr(usage_and_cost, 'logs', InsightsLogs())
+    monkeypatch.setattr(usage_and_cost, 'LOGS_MIN_POLL_SECONDS', 0)
+    return module_functions['__get_usage_by_tenant_by_day'](get_day_windows())
+
+def test_counters_match_insights_results(usage_and_cost, monkeypatch):
+    replay_log_events(usage_and_cost)
+    counted_usage = get_usage_by_day(usage_and_cost, monkeypatch, counted=True)
+    queried_usage = get_usage_by_day(usage_and_cost, monkeypatch, counted=False)
+
+    assert len(counted_usage) == 2
+    assert counted_usage == queried_usage
+    for day, usage_by_tenant in counted_usage.items():
+        assert len(usage_by_tenant) == 12
+        assert sum(usage['TenantTotalInvocations'] for usage in usage_by_tenant.values()) > 0
+
+    module_functions = vars(usage_and_cost)
+    for get_attribution_items in [module_functions['__get_dynamodb_attribution_items'], module_functions['__get_lambda_attribution_items']]:
+        for day in counted_usage:
+            counted_items = get_attribution_items(day, counted_usage[day], Decimal('100'))
+            queried_items = get_attribution_items(day, queried_usage[day], Decimal('100'))
+            # the counters are read in key order, the query results in the order of the rows
+            assert sorted(counted_items, key=lambda item: item['TenantId#ServiceName']) == \
+                sorted(queried_items, key=lambda item: item['TenantId#ServiceName'])
+
+def test_usage_of_log_events_skips_lines_without_tenant(usage_and_cost):
+    usage = usage_and_cost.get_tenant_usage_from_log_events([
+        {'timestamp': 1000, 'message': json.dumps({'ReadCapacityUnits': [2.5], 'WriteCapacityUnits': [1.0], 'tenant_id': 't1'})},
+        {'timestamp': 2000, 'message': json.dumps({'level': 'INFO', 'message': 'Request completed', 'tenant_id': 't1'})},
+        {'timestamp': 3000, 'message': json.dumps({'level': 'INFO', 'message': 'Request completed without tenant'})},
+        {'timestamp': 4000, 'message': 'START RequestId: 0123 Version: $LATEST'}
+    ])
+    assert usage == {(0, 't1'): {'TenantTotalRCU': Decimal('2.5'), 'TenantTotalWCU': Decimal('1.0'), 'TenantTotalInvocations': 1}}